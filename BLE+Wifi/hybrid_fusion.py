@@ -0,0 +1,191 @@
+# Streaming BLE/WiFi fusion: the online counterpart of align_readings() and the
+# Kalman filter of hybrid_rssi_filter.py, fed reading by reading by the subscriber.
+#
+# Every (device, AP) keeps two small ring buffers (BLE and WiFi readings) and the
+# event times it still has to fuse. Windows are in event time (the publishers'
+# timestamps, as integer epoch ms): an event time is fused once the watermark is
+# FUSION_WINDOW seconds past it, so its +-2 s window cannot change any more.
+# Every source (the publisher whose clock stamped the reading) has its own
+# watermark, its newest event time minus ALLOWED_LATENESS, and the operator's is
+# the lowest of them: a publisher whose clock runs ahead cannot push the others'
+# readings behind the watermark. Readings at or behind it arrive too late for
+# windows that are already fused and are dropped (counted in `late`). Buffers
+# only hold the last few seconds, whatever the session length.
+
+import bisect
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from hybrid_rssi_filter import FUSION_WINDOW
+from kalman_bank import KalmanBank
+from epoch_time import ms_to_text
+
+# Seconds a reading may lag the newest event time and still be fused
+ALLOWED_LATENESS = 3
+# Readings kept per (device, AP, signal); ~10 s of scans at the publishers' rates
+RING_SIZE = 64
+
+
+class _Stream:
+    """Buffered readings and unfused timestamps of one (device, AP)."""
+
+    def __init__(self, ring_size):
+        self.readings = {"BLE": deque(maxlen=ring_size), "WiFi": deque(maxlen=ring_size)}
+        self.pending = []  # Sorted event times (ms) still to fuse
+
+    def window(self, signal_type, center, radius):
+        return [(rssi, latency) for t, rssi, latency in self.readings[signal_type] if abs(t - center) <= radius]
+
+    def evict(self, before):
+        for buffer in self.readings.values():
+            while buffer and buffer[0][0] < before:
+                buffer.popleft()
+
+    def empty(self):
+        return not self.pending and not any(self.readings.values())
+
+
+class FusionOperator:
+    """
+    add() readings as they arrive; it returns the hybrid_filtered_rssi rows
+    (timestamp, ts_ms, ap_key, device_key, filtered_rssi, latency) whose windows closed.
+    window and lateness are in seconds; event times and the watermark are epoch ms.
+    Thread-safe, so tick() can advance the watermark from a timer while no readings come in.
+    """
+
+    def __init__(self, window=FUSION_WINDOW, lateness=ALLOWED_LATENESS, ring_size=RING_SIZE, bank=None):
+        self.window = int(window * 1000)
+        self.lateness = int(lateness * 1000)
+        self.ring_size = ring_size
+        self.bank = bank if bank is not None else KalmanBank()
+        self.streams = {}  # (device_key, ap_key) -> _Stream
+        self.sources = {}  # source -> (newest event time, wall clock when it arrived)
+        self.watermark = None  # Readings at or before it are late
+        self.late = 0
+        self.invalid = 0  # Readings without an event time
+        self.emitted = 0
+        self._lock = threading.Lock()
+
+    def add(self, ts_ms, device_key, ap_key, signal_type, rssi, latency, now=None, source=None):
+        """
+        Buffer one reading (signal_type "BLE" or "WiFi", event time in epoch ms,
+        stamped by the clock of `source`); returns the rows it closed.
+        """
+        if signal_type not in ("BLE", "WiFi"):
+            raise ValueError(f"Unknown signal type: {signal_type}")
+        if ts_ms is None:
+            self.invalid += 1
+            return []
+        t = int(ts_ms)
+        with self._lock:
+            if self.watermark is not None and t <= self.watermark:
+                self.late += 1
+                return []
+            stream = self.streams.get((device_key, ap_key))
+            if stream is None:
+                stream = self.streams[(device_key, ap_key)] = _Stream(self.ring_size)
+            stream.readings[signal_type].append((t, rssi, latency))
+            index = bisect.bisect_left(stream.pending, t)
+            if index == len(stream.pending) or stream.pending[index] != t:
+                stream.pending.insert(index, t)
+            now = time.time() if now is None else now
+            newest = self.sources.get(source)
+            if newest is None or t > newest[0]:
+                self.sources[source] = (t, now)
+            return self._advance(self._source_watermark(now))
+
+    def tick(self, now=None):
+        """
+        Advance the watermark by the wall-clock time since the newest reading
+        arrived, so the last windows close even when the publishers go quiet.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if not self.sources:
+                return []
+            return self._advance(self._source_watermark(now))
+
+    def flush(self):
+        """Fuse everything still pending (end of the stream)."""
+        with self._lock:
+            if not self.sources:
+                return []
+            return self._advance(max(t for t, _ in self.sources.values()) + self.window)
+
+    def _source_watermark(self, now):
+        """Lowest watermark of the sources, each moved on by the wall-clock time since its newest reading arrived."""
+        return min(t + int(max(0.0, now - arrival) * 1000) for t, arrival in self.sources.values()) - self.lateness
+
+    def _advance(self, watermark):
+        if self.watermark is not None and watermark <= self.watermark:
+            return []
+        self.watermark = watermark
+        closed = watermark - self.window  # Event times up to here have complete windows
+
+        fused = []  # (event time, device_key, ap_key, avg_ble, avg_wifi, fused_latency)
+        for key, stream in list(self.streams.items()):
+            done = bisect.bisect_right(stream.pending, closed)
+            for center in stream.pending[:done]:
+                nearby_ble = stream.window("BLE", center, self.window)
+                nearby_wifi = stream.window("WiFi", center, self.window)
+                if nearby_ble and nearby_wifi:
+                    avg_ble = np.mean([r for r, _ in nearby_ble])
+                    avg_wifi = np.mean([r for r, _ in nearby_wifi])
+                    fused_latency = (np.mean([lat for _, lat in nearby_ble]) + np.mean([lat for _, lat in nearby_wifi])) / 2
+                    fused.append((center, key[0], key[1], avg_ble, avg_wifi, fused_latency))
+            del stream.pending[:done]
+            # Later event times are all > closed, so they never look further back than this
+            stream.evict(closed + 1 - self.window)
+            if stream.empty():
+                del self.streams[key]
+
+        if not fused:
+            return []
+        # One bank update per signal for every window this advance closed
+        filtered_ble = self.bank.update([(device_key, ap_key, "BLE") for _, device_key, ap_key, _, _, _ in fused],
+                                        [avg_ble for _, _, _, avg_ble, _, _ in fused]).tolist()
+        filtered_wifi = self.bank.update([(device_key, ap_key, "WiFi") for _, device_key, ap_key, _, _, _ in fused],
+                                         [avg_wifi for _, _, _, _, avg_wifi, _ in fused]).tolist()
+        self.emitted += len(fused)
+        return [
+            (ms_to_text(center), center, ap_key, device_key, (ble_rssi + wifi_rssi) / 2, float(fused_latency))
+            for (center, device_key, ap_key, _, _, fused_latency), ble_rssi, wifi_rssi
+            in zip(fused, filtered_ble, filtered_wifi)
+        ]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "streams": len(self.streams),
+                "buffered": sum(len(b) for s in self.streams.values() for b in s.readings.values()),
+                "pending": sum(len(s.pending) for s in self.streams.values()),
+                "sources": len(self.sources),
+                "emitted": self.emitted,
+                "late": self.late,
+                "invalid": self.invalid,
+                "watermark": None if self.watermark is None else ms_to_text(self.watermark),
+            }
+
+
+def start_ticker(operator, emit, interval=1.0, stop=None):
+    """
+    Daemon thread calling emit(rows) with whatever operator.tick() closes,
+    every interval seconds until the threading.Event `stop` is set.
+    """
+    stop = stop or threading.Event()
+
+    def tick_forever():
+        while not stop.wait(interval):
+            try:
+                rows = operator.tick()
+                if rows:
+                    emit(rows)
+            except Exception as e:
+                print(f"Fusion tick failed: {e}")
+
+    thread = threading.Thread(target=tick_forever, name="fusion-tick", daemon=True)
+    thread.start()
+    return thread
@@ -1,13 +1,23 @@
+import argparse
 import os
+import sys
 import sqlite3
 import numpy as np
-from datetime import datetime
-from scipy.optimize import least_squares
 
 # Constants
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE = os.path.join(BASE_DIR, "positioning.db")
 
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from identity import ap_names, device_names
+from epoch_time import ms_to_isoformat
+from trilateration import linear_positions, solve_positions
+from fingerprint import RadioMap, build_radio_map, reference_points
+from grid_solver import GRID_CELL, GridSolver
+from windowing import WINDOW_MS, known_windows, resample_windows, window_dicts
+from estimator_state import load_estimator_watermarks, read_since, reopened_windows, store_estimates
+from hybrid_rssi_filter import ensure_filtered_table
+
 AP_COORDINATES = {
     "RPi_AP_XY": (4.96, 0),
     "RPi_AP_Pierre": (4.96, 8.06),
@@ -15,6 +25,12 @@ AP_COORDINATES = {
     "RPi_AP_Alicia": (0, 0),
 }
 
+# Incremental mode keeps its per-device watermarks under this name
+ESTIMATOR_NAME = "hybrid_estimated_positions"
+
+# The room: positions are kept inside it
+FLOOR_BOUNDS = ([0, 0], [4.96, 8.06])
+
 # Fixed RSSI-to-distance parameters (as requested)
 A = -55.525   # Reference RSSI at 1m
 n = 0.735     # Path-loss exponent
@@ -23,149 +39,183 @@ def rssi_to_distance(rssi):
     """Convert RSSI to distance using fixed parameters A and n."""
     return 10 ** ((A - rssi) / (10 * n))
 
-def robust_trilateration(ap_positions, distances):
-    """Weighted nonlinear least-squares trilateration."""
-    points = np.array(ap_positions)
-    dists = np.array(distances)
-    weights = 1.0 / (dists + 0.1)  # Closer APs have higher weight
-
-    def cost_fn(point):
-        return weights * (np.linalg.norm(points - point, axis=1) - dists)
-
-    try:
-        bounds = ([0, 0], [4.96, 8.06]) 
-        result = least_squares(
-            cost_fn,
-            x0=np.median(points, axis=0),
-            bounds=bounds,
-            loss='soft_l1',
-            max_nfev=200
-        )
-        return result.x if result.success else None
-    except Exception as e:
-        print(f"Trilateration failed: {e}")
-        return None
-
-def weighted_trilateration(ap_positions, distances):
-    """Linear, weighted approach."""
-    A, b, weights = [], [], []
-    for i in range(1, len(ap_positions)):
-        x0, y0 = ap_positions[0]
-        xi, yi = ap_positions[i]
-        di_sq = distances[i]**2 - distances[0]**2
-        A.append([2*(xi - x0), 2*(yi - y0)])
-        b.append(di_sq - (xi**2 + yi**2 - x0**2 - y0**2))
-        weights.append(1 / (distances[i] + 1e-6))
-
-    try:
-        A, b, W = np.array(A), np.array(b), np.diag(weights)
-        x = np.linalg.inv(A.T @ W @ A) @ A.T @ W @ b
-        return x
-    except:
-        return None
-
-def fetch_grouped_rssi(device_name, time_window=2):
-    """Fetch RSSI readings for a device, grouped by timestamp windows."""
+def robust_trilateration(ap_points, distances):
+    """
+    Weighted nonlinear least-squares trilateration of every window at once
+    (common/trilateration.py; closer APs have higher weight): K x 3 AP
+    positions and distances -> (K positions, converged).
+    """
+    points = np.asarray(ap_points, dtype=float)
+    return solve_positions(points, distances, np.median(points, axis=1), loss='soft_l1', bounds=FLOOR_BOUNDS,
+                           max_iterations=200)
+
+def weighted_trilateration(ap_points, distances):
+    """Linear, weighted approach for a batch; collinear AP subsets come back unsolved."""
+    return linear_positions(ap_points, distances)  # Cached AP-subset geometry (common/trilateration.py)
+
+def grid_positions(ap_coordinates, rssi, ap_keys, cell=GRID_CELL):
+    """
+    Grid-likelihood fixes of K x APs windows (common/grid_solver.py): every cell
+    of FLOOR_BOUNDS scored by one matrix product, the most likely one refined.
+    """
+    columns = [column for column, key in enumerate(ap_keys) if key in ap_coordinates]
+    solver = GridSolver([ap_coordinates[ap_keys[column]] for column in columns], A, n, bounds=FLOOR_BOUNDS, cell=cell)
+    return solver.locate(rssi[:, columns])
+
+# Filtered readings of one device in event-time order (index plans: tests/test_query_plans.py)
+DEVICE_ROWS_SQL = """
+    SELECT ts_ms, ap_key, filtered_rssi
+    FROM hybrid_filtered_rssi
+    WHERE device_key = ?
+    ORDER BY ts_ms ASC, ap_key ASC
+"""
+
+# Filtered readings of every device from an epoch-ms time on, for incremental runs
+RECENT_ROWS_SQL = """
+    SELECT device_key, ts_ms, ap_key, filtered_rssi
+    FROM hybrid_filtered_rssi
+    WHERE ts_ms >= ?
+    ORDER BY ts_ms ASC, ap_key ASC
+"""
+
+# hybrid_estimated_positions layout ({table}: a full run writes a new table that then replaces it)
+POSITION_TABLE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        device_name TEXT,
+        x REAL,
+        y REAL,
+        timestamp DATETIME,
+        ts_ms INTEGER,
+        method TEXT,
+        UNIQUE(device_name, timestamp)
+    )
+"""
+
+# Positions of a window are replaced when an incremental run solves it again
+UPSERT_POSITION_SQL = """
+    INSERT INTO {table} (device_name, x, y, timestamp, ts_ms, method)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (device_name, timestamp) DO UPDATE SET x = excluded.x, y = excluded.y,
+        ts_ms = excluded.ts_ms, method = excluded.method
+"""
+
+def fetch_grouped_rssi(device_keys, window_ms=WINDOW_MS, since=None):
+    """
+    RSSI readings of the devices resampled onto window_ms windows (common/windowing.py):
+    ((device keys K, mid ts_ms K, RSSI K x APs, AP keys), {device key: newest ts_ms read}).
+    since: only the readings from that epoch ms on, of every device if device_keys is None.
+    """
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT timestamp, ap_id, filtered_rssi 
-        FROM hybrid_filtered_rssi
-        WHERE device_name = ?
-        ORDER BY timestamp ASC
-    """, (device_name,))
-    raw_data = cursor.fetchall()
+    readings = []
+    if since is None:
+        for device_key in device_keys:
+            cursor.execute(DEVICE_ROWS_SQL, (device_key,))
+            readings += [(device_key, ap_key, ts_ms, rssi) for ts_ms, ap_key, rssi in cursor.fetchall()]  # Integer epoch ms
+    else:
+        cursor.execute(RECENT_ROWS_SQL, (since,))
+        wanted = None if device_keys is None else set(device_keys)
+        readings = [(device_key, ap_key, ts_ms, rssi) for device_key, ts_ms, ap_key, rssi in cursor.fetchall()
+                    if wanted is None or device_key in wanted]
     conn.close()
+    latest = {}
+    for device_key, _, ts_ms, _ in readings:
+        latest[device_key] = max(ts_ms, latest.get(device_key, ts_ms))
+    return resample_windows(readings, window_ms), latest
 
-    grouped = []
-    for ts, ap_id, rssi in raw_data:
-        ts_dt = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
-        grouped.append((ts_dt, ap_id, rssi))
-    
-    # Group readings within ±time_window seconds
-    windowed = []
-    i = 0
-    while i < len(grouped):
-        ts_i, ap_i, rssi_i = grouped[i]
-        window = {ap_i: rssi_i}
-        timestamps = [ts_i]
-        j = i + 1
-        while j < len(grouped):
-            ts_j, ap_j, rssi_j = grouped[j]
-            if abs((ts_j - ts_i).total_seconds()) <= time_window:
-                window[ap_j] = rssi_j
-                timestamps.append(ts_j)
-                j += 1
-            else:
-                break
-        if len(window) == 3:  # Require ≥3 APs for trilateration
-            mid_ts = min(timestamps) + (max(timestamps) - min(timestamps)) / 2
-            windowed.append((mid_ts, window))
-        i = j
-    return windowed
-
-def estimate_positions():
-    """Main function to estimate and store positions."""
+def build_fingerprints(window_ms=WINDOW_MS):
+    """Radio map (common/fingerprint.py) from the windows of the surveyed devices in ground_truth_positions."""
     conn = sqlite3.connect(DATABASE)
+    ensure_filtered_table(conn)
+    surveyed = reference_points(conn)
+    names = device_names(conn)
+    surveyed_keys = [key for key, device in names.items() if device in surveyed]
+    (device_keys, _, rssi, ap_keys), _ = fetch_grouped_rssi(surveyed_keys, window_ms)
+    ap_name = ap_names(conn)
+    samples = [(ap_rssi, *surveyed[names[device_key]])
+               for device_key, ap_rssi in zip(device_keys, window_dicts(rssi, [ap_name[key] for key in ap_keys]))]
+    fingerprints = build_radio_map(conn, samples)
+    conn.close()
+    print(f"Radio map: {fingerprints} fingerprints from {len(samples)} windows of {len(surveyed)} surveyed devices.")
+    return fingerprints
+
+def estimate_positions(method="robust", grid_cell=GRID_CELL, window_ms=WINDOW_MS, incremental=False):
+    """
+    Main function to estimate and store positions (method: 'robust' trilateration, 'fingerprint' or 'grid').
+    incremental: keep the stored positions and only solve the windows from the trailing one of every
+    device on (common/estimator_state.py).
+    """
+    conn = sqlite3.connect(DATABASE)
+    ensure_filtered_table(conn)  # Keyed table, view and index, also on a database filtered before they existed
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT device_name, ap_id, timestamp, filtered_rssi 
-        FROM hybrid_filtered_rssi 
-        LIMIT 10
-    """)
-    # print("Sample RSSI data:")
-    # for row in cursor.fetchall():
-    #     print(row)
-
-    # Drop and recreate the hybrid_estimated_positions table
-    cursor.execute("DROP TABLE IF EXISTS hybrid_estimated_positions")
-
-    cursor.execute("""
-        CREATE TABLE hybrid_estimated_positions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            device_name TEXT,
-            x REAL,
-            y REAL,
-            timestamp DATETIME,
-            method TEXT,
-            UNIQUE(device_name, timestamp)
-        )
-    """)
-    
-    # Get all devices with Kalman-filtered RSSI
-    cursor.execute("SELECT DISTINCT device_name FROM hybrid_filtered_rssi")
-    devices = [row[0] for row in cursor.fetchall()]
-
-    for device in devices:
-        rssi_groups = fetch_grouped_rssi(device)
-
-        for ts, ap_rssi in rssi_groups:
-            ap_positions, distances = [], []
-            for ap_id, rssi in ap_rssi.items():
-                if ap_id in AP_COORDINATES:
-                    ap_positions.append(AP_COORDINATES[ap_id])
-                    distances.append(rssi_to_distance(rssi))
-
-            if len(ap_positions) == 3:
-                position = robust_trilateration(ap_positions, distances)
-                method = "robust"
-
-                if position is None:
-                    position = weighted_trilateration(ap_positions, distances)
-                    method = "weighted_fallback"
-
-                if position is not None:
-                    x, y = position[0], position[1]
-                    ts_str = ts.strftime("%Y-%m-%d %H:%M:%S")
-                    cursor.execute("""
-                        INSERT OR IGNORE INTO hybrid_estimated_positions
-                        (device_name, x, y, timestamp, method)
-                        VALUES (?, ?, ?, ?, ?)
-                    """, (device, x, y, ts_str, method))
-
-    conn.commit()
+
+    # Get all devices with Kalman-filtered RSSI (incremental: those with readings since the watermarks)
+    watermarks = load_estimator_watermarks(conn, ESTIMATOR_NAME, window_ms) if incremental else {}
+    since = read_since(watermarks, window_ms)
+    if since is None:
+        cursor.execute("SELECT DISTINCT device_key FROM hybrid_filtered_rssi")
+        devices = [row[0] for row in cursor.fetchall()]
+    else:
+        devices = None
+    names = device_names(conn)
+    ap_name = ap_names(conn)
+    ap_coordinates = {key: AP_COORDINATES[name] for key, name in ap_name.items() if name in AP_COORDINATES}
+
+    # Windows of every device with three known APs (not yet closed at the watermarks), solved in one batch
+    (device_keys, window_ts, rssi, ap_keys), latest = fetch_grouped_rssi(devices, window_ms, since)
+    rows, columns = known_windows(rssi, ap_keys, ap_coordinates)
+    reopened = reopened_windows(device_keys[rows], window_ts[rows], window_ms, watermarks)
+    rows, columns = rows[reopened], columns[reopened]
+    coordinates = np.array([ap_coordinates.get(key, (np.nan, np.nan)) for key in ap_keys], dtype=float).reshape(-1, 2)
+    ap_points = coordinates[columns]
+    window_distances = rssi_to_distance(rssi[rows[:, None], columns])
+    windows = [(names[device_key], int(ts)) for device_key, ts in zip(device_keys[rows], window_ts[rows])]
+
+    if method == "fingerprint":
+        radio_map = RadioMap.load(conn)
+        if not len(radio_map):
+            conn.close()
+            raise RuntimeError("No radio map; run with --build-radio-map first")
+        positions, solved = radio_map.locate(window_dicts(rssi[rows], [ap_name[key] for key in ap_keys]))
+        methods = ["fingerprint"] * len(windows)
+    elif method == "grid":
+        positions, solved = grid_positions(ap_coordinates, rssi[rows], ap_keys, grid_cell)
+        methods = ["grid"] * len(windows)
+    else:
+        if windows:
+            positions, converged = robust_trilateration(ap_points, window_distances)
+        else:
+            positions, converged = np.empty((0, 2)), np.empty(0, dtype=bool)
+        solved = converged.copy()
+        fallback = np.flatnonzero(~converged)
+        if len(fallback):
+            positions[fallback], solved[fallback] = weighted_trilateration(ap_points[fallback], window_distances[fallback])
+        methods = ["robust" if robust else "weighted_fallback" for robust in converged]
+
+    # One batch of upserts, committed with the watermarks of the readings they came from; a full run
+    # swaps them in for the stored positions once all are written
+    store_estimates(conn, ESTIMATOR_NAME, "hybrid_estimated_positions", POSITION_TABLE_SCHEMA, UPSERT_POSITION_SQL,
+                    [(device, float(position[0]), float(position[1]), ms_to_isoformat(ts), ts, method)
+                     for (device, ts), position, ok, method in zip(windows, positions, solved, methods) if ok],
+                    latest, window_ms, replace=not incremental)
     conn.close()
     print("Position estimation completed.") 
 
 if __name__ == "__main__":
-    estimate_positions()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Estimate device positions from the fused, filtered RSSI.")
+    parser.add_argument("--method", choices=["robust", "fingerprint", "grid"], default="robust",
+                        help="Robust trilateration, weighted k-NN in the radio map, or grid likelihood")
+    parser.add_argument("--grid-cell", type=float, default=GRID_CELL, help="Cell edge (m) of --method grid")
+    parser.add_argument("--window", type=float, default=WINDOW_MS / 1000, help="Width (s) of the windows readings are grouped in")
+    parser.add_argument("--build-radio-map", action="store_true",
+                        help="Build the radio map from the surveyed devices (ground_truth_positions) and exit")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only solve the windows after the last run's watermarks, keeping the stored positions")
+    args = parser.parse_args()
+    window_ms = int(round(args.window * 1000))
+
+    if args.build_radio_map:
+        build_fingerprints(window_ms)
+    else:
+        estimate_positions(args.method, args.grid_cell, window_ms, args.incremental)
\ No newline at end of file
@@ -1,14 +1,24 @@
 import os
+import sys
+import argparse
 import sqlite3
 import numpy as np
-from collections import defaultdict
-from datetime import datetime
 
 # Database path
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE = os.path.join(BASE_DIR, "positioning.db")
 
-# Kalman Filter class
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from run_storage import current_run_id, ensure_run_partitioning
+import shards
+from identity import IdentityResolver, ensure_identity_columns
+from migrations import migrate
+from kalman_bank import KalmanBank
+from parallel_filter import (DEFAULT_CHUNK_SIZE, RANGES_PER_WORKER, fetch_chunks, key_ranges, open_writer,
+                             run_partitioned)
+from epoch_time import TEXT_TO_MS_SQL, ensure_epoch_columns
+
+# Kalman Filter class (one reading at a time; batches go through KalmanBank)
 class KalmanFilter:
     def __init__(self, process_variance=1e-3, measurement_variance=2.0):
         self.x = -70
@@ -23,126 +33,281 @@ class KalmanFilter:
         self.P *= (1 - K)
         return self.x
 
-# Global Kalman filter store
-kalman_filters = {}
-
-def get_kalman_filter(device_name, ap_id):
-    key = (device_name, ap_id)
-    if key not in kalman_filters:
-        kalman_filters[key] = KalmanFilter()
-    return kalman_filters[key]
-
-def normalize_device_name(name):
-    name = name.strip()
-    if "MSStick" in name:
-        name = name.replace("MSStick", "M5Stick")
-    if "_BLE_" in name:
-        base_name = name.split("_BLE_")[-1]
-        if "SeeShen" in base_name:
-            base_name = "KeeShen"
-        return f"M5_{base_name}"
-    if "CPlus-" in name:
-        return f"M5_{name.split('CPlus-')[-1]}"
-    return name
-
-def normalize_ap_id(ap_id):
-    ap_id = ap_id.strip().lower()
-    mapping = {
-        "xypi": "RPi_AP_XY",
-        "aliciapi": "RPi_AP_Alicia",
-        "enthong": "RPi_AP_EnThong",
-        "pierre": "RPi_AP_Pierre",
-        "rpi_hybrid_pierre": "RPi_AP_Pierre",
-        "rpi_hybrid_alicia": "RPi_AP_Alicia",
-        "rpi_hybrid_xinyi": "RPi_AP_XY",
-        "rpi_hybrid_enthong": "RPi_AP_EnThong"
-    }
-    return mapping.get(ap_id, ap_id)
+# Global Kalman filter store, keyed by (device_key, ap_key, signal_type)
+kalman_bank = KalmanBank()
+
+# BLE and WiFi readings of a (device, AP) within this many seconds of a timestamp are fused
+FUSION_WINDOW = 2
+
+# Raw BLE and WiFi readings of one run in time order (index plans: tests/test_query_plans.py)
+RAW_ROWS_SQL = """
+    SELECT timestamp, ap_key, device_key, rssi, latency, 'BLE' AS signal_type, ts_ms FROM ble_rssi WHERE run_id = ?
+    UNION ALL
+    SELECT timestamp, ap_key, device_key, rssi, latency, 'WiFi' AS signal_type, ts_ms FROM wifi_rssi WHERE run_id = ?
+    ORDER BY timestamp ASC
+"""
+
+# The same rows for the (device, AP) keys first..last only, for the parallel backfill,
+# read along the (run_id, device_key, ap_key) indexes (each key's rows in time order)
+RAW_RANGE_SQL = """
+    SELECT timestamp, ap_key, device_key, rssi, latency, 'BLE' AS signal_type, ts_ms FROM ble_rssi
+    WHERE run_id = ? AND (device_key, ap_key) BETWEEN (?, ?) AND (?, ?)
+    UNION ALL
+    SELECT timestamp, ap_key, device_key, rssi, latency, 'WiFi' AS signal_type, ts_ms FROM wifi_rssi
+    WHERE run_id = ? AND (device_key, ap_key) BETWEEN (?, ?) AND (?, ?)
+    ORDER BY device_key ASC, ap_key ASC, timestamp ASC
+"""
+
+# Raw rows per (device, AP) of one run, to split the parallel backfill into even key ranges
+KEY_COUNTS_SQL = """
+    SELECT device_key, ap_key, COUNT(*) FROM (
+        SELECT device_key, ap_key FROM ble_rssi WHERE run_id = ?
+        UNION ALL
+        SELECT device_key, ap_key FROM wifi_rssi WHERE run_id = ?
+    )
+    WHERE device_key IS NOT NULL AND ap_key IS NOT NULL
+    GROUP BY device_key, ap_key
+    ORDER BY device_key, ap_key
+"""
+
+INSERT_FILTERED_SQL = """
+    INSERT OR IGNORE INTO hybrid_filtered_rssi
+    (timestamp, ts_ms, ap_key, device_key, filtered_rssi, latency)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+FILTERED_TABLE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp DATETIME,
+        ts_ms INTEGER,
+        ap_key INTEGER,
+        device_key INTEGER,
+        filtered_rssi REAL,
+        latency REAL,
+        UNIQUE(ts_ms, ap_key, device_key)
+    )
+"""
+
+def upgrade_named_table(conn):
+    """
+    Rewrite a hybrid_filtered_rssi of an older database, keyed by ap_id /
+    device_name TEXT, into the keyed table above: aliases resolved once, ts_ms
+    from the TEXT timestamp, in one transaction. No-op for a keyed table.
+    """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(hybrid_filtered_rssi)")]
+    if not columns or "device_key" in columns:
+        return
+    resolver = IdentityResolver(conn)
+    for (device_name,) in conn.execute("SELECT DISTINCT device_name FROM hybrid_filtered_rssi WHERE device_name IS NOT NULL").fetchall():
+        resolver.device_key(device_name)
+    for (ap_id,) in conn.execute("SELECT DISTINCT ap_id FROM hybrid_filtered_rssi WHERE ap_id IS NOT NULL").fetchall():
+        resolver.ap_key(ap_id)
+
+    conn.execute("BEGIN")
+    conn.execute("DROP VIEW IF EXISTS hybrid_filtered_rssi_named")
+    conn.execute("DROP TABLE IF EXISTS hybrid_filtered_rssi_keyed")
+    conn.execute(FILTERED_TABLE_SCHEMA.format(table="hybrid_filtered_rssi_keyed"))
+    conn.execute(f"""
+        INSERT OR IGNORE INTO hybrid_filtered_rssi_keyed (timestamp, ts_ms, ap_key, device_key, filtered_rssi, latency)
+        SELECT f.timestamp, {TEXT_TO_MS_SQL.format(column='f.timestamp')}, a.ap_key, d.device_key, f.filtered_rssi, f.latency
+        FROM hybrid_filtered_rssi f
+        JOIN ap_aliases a ON a.alias = f.ap_id
+        JOIN device_aliases d ON d.alias = f.device_name
+        ORDER BY f.id
+    """)
+    conn.execute("DROP TABLE hybrid_filtered_rssi")
+    conn.execute("ALTER TABLE hybrid_filtered_rssi_keyed RENAME TO hybrid_filtered_rssi")
+    conn.commit()
+
+def ensure_filtered_table(conn):
+    """
+    hybrid_filtered_rssi and its named view, if missing (also used by the
+    subscriber's streaming fusion and the estimator); an older name-keyed table is upgraded first.
+    """
+    upgrade_named_table(conn)
+    conn.execute(FILTERED_TABLE_SCHEMA.format(table="hybrid_filtered_rssi"))
+
+    # Same rows with the canonical names, for the evaluation scripts
+    conn.execute("""
+        CREATE VIEW IF NOT EXISTS hybrid_filtered_rssi_named AS
+        SELECT f.id, f.timestamp, a.name AS ap_id, d.name AS device_name, f.filtered_rssi, f.latency, f.ts_ms
+        FROM hybrid_filtered_rssi f
+        JOIN access_points a ON a.ap_key = f.ap_key
+        JOIN devices d ON d.device_key = f.device_key
+    """)
+    migrate(conn, ["hybrid_filtered_rssi"])  # Covering index for the estimator's per-device reads
 
 def create_tables():
     conn = sqlite3.connect(DATABASE)
+    ensure_run_partitioning(conn, ["ble_rssi", "wifi_rssi"])
+    # Resolves any raw rows stored without device/AP keys (aliases are resolved once)
+    ensure_identity_columns(conn, ["ble_rssi", "wifi_rssi"])
+    ensure_epoch_columns(conn, ["ble_rssi", "wifi_rssi"])
     cursor = conn.cursor()
 
     # Drop the table if it exists
+    cursor.execute("DROP VIEW IF EXISTS hybrid_filtered_rssi_named")
     cursor.execute("DROP TABLE IF EXISTS hybrid_filtered_rssi")
 
-    cursor.execute("""
-        CREATE TABLE hybrid_filtered_rssi (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME,
-            ap_id TEXT,
-            device_name TEXT,
-            filtered_rssi REAL,
-            latency REAL,
-            UNIQUE(timestamp, ap_id, device_name)
-        )
-    """)
+    ensure_filtered_table(conn)
     conn.commit()
     conn.close()
 
-def fetch_raw_rssi():
-    conn = sqlite3.connect(DATABASE)
+def fetch_raw_rssi(run_id=None):
+    conn = shards.connect(DATABASE)  # Reads across shard files when ingestion is sharded
     cursor = conn.cursor()
-    cursor.execute(""" 
-        SELECT timestamp, ap_id, mac, device_name, rssi, latency, 'BLE' AS signal_type FROM ble_rssi 
-        UNION ALL 
-        SELECT timestamp, ap_id, mac, device_name, rssi, latency, 'WiFi' AS signal_type FROM wifi_rssi 
-        ORDER BY timestamp ASC
-    """)
+    if run_id is None:
+        run_id = current_run_id(conn)
+    cursor.execute(RAW_ROWS_SQL, (run_id, run_id))
     data = cursor.fetchall()
     conn.close()
     return data
 
-def merge_and_filter_rssi():
-    create_tables()
-    raw_data = fetch_raw_rssi()
-
-    grouped = defaultdict(list)
-    for timestamp, ap_id, _, device_name, rssi, latency, signal_type in raw_data:
-        ap_id = normalize_ap_id(ap_id)
-        device_name = normalize_device_name(device_name)
-        ts_dt = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
-        grouped[(device_name, ap_id)].append((ts_dt, rssi, latency, signal_type))
-
-    filtered_entries = []
-
-    for (device_name, ap_id), readings in grouped.items():
-        ble = [(ts, rssi, lat) for ts, rssi, lat, t in readings if t == 'BLE']
-        wifi = [(ts, rssi, lat) for ts, rssi, lat, t in readings if t == 'WiFi']
+def window_means(positions, columns, centers, radius=FUSION_WINDOW):
+    """
+    Readings within radius of every center: (counts, [mean of each column]).
+    positions must be sorted; means of empty windows are NaN. Windows of the
+    same length are summed row-wise with np.add.reduce, the same summation as
+    np.mean over the window, so the means are bit-identical to it.
+    """
+    lo = np.searchsorted(positions, centers - radius, side="left")
+    hi = np.searchsorted(positions, centers + radius, side="right")
+    counts = hi - lo
+    means = [np.full(len(centers), np.nan) for _ in columns]
+    for length in np.unique(counts[counts > 0]):
+        windows = np.flatnonzero(counts == length)
+        index = lo[windows][:, None] + np.arange(length)
+        for mean, column in zip(means, columns):
+            mean[windows] = np.add.reduce(column[index], axis=1) / length
+    return counts, means
 
-        all_timestamps = sorted(set([ts for ts, _, _ in ble] + [ts for ts, _, _ in wifi]))
+def align_readings(raw_data, radius=FUSION_WINDOW):
+    """
+    Pair up the BLE and WiFi readings of every (device, AP): at each event time
+    either signal was seen, average each signal's RSSI and latency over the
+    readings within radius seconds, and keep the event times that have both.
 
-        for ts in all_timestamps:
-            nearby_ble = [(rssi, lat) for ts_ble, rssi, lat in ble if abs((ts_ble - ts).total_seconds()) <= 2]
-            nearby_wifi = [(rssi, lat) for ts_wifi, rssi, lat in wifi if abs((ts_wifi - ts).total_seconds()) <= 2]
+    Event times are the integer ts_ms of the rows, so windows are integer
+    comparisons at millisecond resolution. Every (device, AP) is laid out on its
+    own stretch of one time axis, so all keys are aligned at once with
+    np.searchsorted over sorted arrays (O(n log n)) instead of scanning every
+    reading of the key per timestamp.
+    Returns [(timestamp, ts_ms, ap_key, device_key, avg_ble, avg_wifi, fused_latency)]
+    grouped by (device, AP) in order of first reading, then by time.
+    """
+    if not raw_data:
+        return []
+    timestamps, ap_keys, device_keys, rssi, latency, signal_types, ts_ms = zip(*raw_data)
+    key_ids = {}
+    key_of_row = np.fromiter((key_ids.setdefault(key, len(key_ids)) for key in zip(device_keys, ap_keys)),
+                             dtype=np.int64, count=len(raw_data))
+    ms = np.array(ts_ms, dtype=np.int64)
+    ms -= ms.min()
+    radius = int(radius * 1000)
+    # A gap of well over radius between keys keeps windows from reaching into the next key
+    positions = key_of_row * (int(ms.max()) + 2 * radius + 1) + ms
+    rssi = np.array(rssi, dtype=float)
+    latency = np.array(latency, dtype=float)
+    signal_types = np.array(signal_types)
 
-            if nearby_ble and nearby_wifi:
-                avg_ble = np.mean([r for r, _ in nearby_ble])
-                avg_wifi = np.mean([r for r, _ in nearby_wifi])
-                avg_ble_lat = np.mean([lat for _, lat in nearby_ble])
-                avg_wifi_lat = np.mean([lat for _, lat in nearby_wifi])
-                fused_latency = (avg_ble_lat + avg_wifi_lat) / 2
+    # Every timestamp of a key that has a reading of either signal, oldest first
+    rows = np.concatenate([np.flatnonzero(signal_types == "BLE"), np.flatnonzero(signal_types == "WiFi")])
+    centers, first = np.unique(positions[rows], return_index=True)
+    center_rows = rows[first]
 
-                ble_kf = get_kalman_filter(device_name, ap_id + "_BLE")
-                wifi_kf = get_kalman_filter(device_name, ap_id + "_WiFi")
+    averages = []
+    for signal_type in ("BLE", "WiFi"):
+        signal_rows = np.flatnonzero(signal_types == signal_type)
+        # Stable, so readings of the same millisecond stay in query order
+        signal_rows = signal_rows[np.argsort(positions[signal_rows], kind="stable")]
+        averages.append(window_means(positions[signal_rows], [rssi[signal_rows], latency[signal_rows]], centers, radius))
+    (ble_counts, (avg_ble, avg_ble_lat)), (wifi_counts, (avg_wifi, avg_wifi_lat)) = averages
+    fused_latency = (avg_ble_lat + avg_wifi_lat) / 2
 
-                filtered_ble = ble_kf.update(avg_ble)
-                filtered_wifi = wifi_kf.update(avg_wifi)
+    fused = np.flatnonzero((ble_counts > 0) & (wifi_counts > 0))
+    return [
+        (timestamps[row], ts_ms[row], ap_keys[row], device_keys[row], ble, wifi, lat)
+        for row, ble, wifi, lat in zip(center_rows[fused].tolist(), avg_ble[fused].tolist(),
+                                        avg_wifi[fused].tolist(), fused_latency[fused].tolist())
+    ]
 
-                fused_rssi = (filtered_ble + filtered_wifi) / 2
+def filter_aligned(aligned, bank):
+    """Kalman-filter align_readings() output into hybrid_filtered_rssi rows."""
+    # Each key's averages go through the bank in one batch, in time order
+    filtered_ble = bank.update([(device_key, ap_key, "BLE") for _, _, ap_key, device_key, _, _, _ in aligned],
+                               [avg_ble for _, _, _, _, avg_ble, _, _ in aligned]).tolist()
+    filtered_wifi = bank.update([(device_key, ap_key, "WiFi") for _, _, ap_key, device_key, _, _, _ in aligned],
+                                [avg_wifi for _, _, _, _, _, avg_wifi, _ in aligned]).tolist()
+    return [
+        (ts_str, ts_ms, ap_key, device_key, (ble_rssi + wifi_rssi) / 2, fused_latency)
+        for (ts_str, ts_ms, ap_key, device_key, _, _, fused_latency), ble_rssi, wifi_rssi
+        in zip(aligned, filtered_ble, filtered_wifi)
+    ]
 
-                ts_str = ts.strftime("%Y-%m-%d %H:%M:%S")
-                filtered_entries.append((ts_str, ap_id, device_name, fused_rssi, fused_latency))
+def merge_and_filter_rssi(run_id=None):
+    create_tables()
+    raw_data = fetch_raw_rssi(run_id)
+    filtered_entries = filter_aligned(align_readings(raw_data), kalman_bank)
 
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
-    cursor.executemany("""
-        INSERT OR IGNORE INTO hybrid_filtered_rssi
-        (timestamp, ap_id, device_name, filtered_rssi, latency)
-        VALUES (?, ?, ?, ?, ?)
-    """, filtered_entries)
+    cursor.executemany(INSERT_FILTERED_SQL, filtered_entries)
     conn.commit()
     conn.close()
 
+def filter_key_range(database, run_id, chunk_size, first_key, last_key):
+    """Parallel backfill worker: the hybrid_filtered_rssi rows of the (device, AP) keys first_key..last_key."""
+    conn = shards.connect(database)  # Read-only here; the parent process does the inserts
+    params = (run_id,) + tuple(first_key) + tuple(last_key)
+    cursor = conn.execute(RAW_RANGE_SQL, params + params)
+    # A key's windows need all of its readings, so the chunks are only the read buffer
+    raw_data = [row for chunk in fetch_chunks(cursor, chunk_size) for row in chunk]
+    conn.close()
+    return filter_aligned(align_readings(raw_data), KalmanBank())
+
+def merge_and_filter_rssi_parallel(run_id=None, workers=4, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    merge_and_filter_rssi() for large backfills: the (device, AP) keys are
+    split into ranges of about equal row counts, aligned and filtered by
+    `workers` processes, and every row is inserted here through one connection.
+    """
+    create_tables()
+    conn = sqlite3.connect(DATABASE)
+    # Each range task reads its keys only
+    migrate(conn, ["ble_rssi", "wifi_rssi"], ["idx_ble_rssi_run_keys", "idx_wifi_rssi_run_keys"])
+    conn.close()
+    conn = shards.connect(DATABASE)
+    if run_id is None:
+        run_id = current_run_id(conn)
+    key_counts = [((device_key, ap_key), count)
+                  for device_key, ap_key, count in conn.execute(KEY_COUNTS_SQL, (run_id, run_id))]
+    conn.close()
+    ranges = key_ranges(key_counts, workers * RANGES_PER_WORKER)
+
+    writer = open_writer(DATABASE)
+
+    def write(filtered_entries):
+        changes_before = writer.total_changes
+        writer.executemany(INSERT_FILTERED_SQL, filtered_entries)
+        writer.commit()
+        return writer.total_changes - changes_before
+
+    try:
+        return run_partitioned(filter_key_range, (DATABASE, run_id, chunk_size), ranges, workers, write)
+    finally:
+        writer.close()
+
 if __name__ == "__main__":
-    merge_and_filter_rssi()
+    parser = argparse.ArgumentParser(description="Fuse and Kalman-filter the BLE and WiFi RSSI of one run.")
+    parser.add_argument("--run", type=int, default=None, help="Run id to filter (default: latest run)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Filter in this many processes, split by (device, AP) (default: in this process)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Raw rows each worker reads at a time")
+    args = parser.parse_args()
+
+    if args.workers:
+        merge_and_filter_rssi_parallel(args.run, args.workers, args.chunk_size)
+    else:
+        merge_and_filter_rssi(args.run)
@@ -1,12 +1,26 @@
 import paho.mqtt.client as mqtt
-import json
 import time
 import sqlite3
+import os
+import sys
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from write_queue import WriteBehindQueue
+from rssi_codec import decode_readings
+from run_storage import ensure_run_partitioning, start_run, expire_runs_in_background
+from identity import ensure_identity_columns
+from metrics import IngestMetrics
+from clock_sync import ECHO_TOPIC, ClockSync, reading_sender, start_pinger
+from epoch_time import ensure_epoch_columns, reading_ms
+from hybrid_rssi_filter import ensure_filtered_table
+from hybrid_fusion import FusionOperator, start_ticker
+from kalman_store import KalmanStateStore
 
 # MQTT Config
 MQTT_BROKER = "keshleepi.local"  # Use hostname
 MQTT_PORT = 8883  # TLS port
-MQTT_TOPICS = [("wifi/rssi", 0), ("ble/rssi", 0)]
+MQTT_TOPICS = [("wifi/rssi", 0), ("ble/rssi", 0), (ECHO_TOPIC, 0)]
 MQTT_USERNAME = "team19"
 MQTT_PASSWORD = "test123"
 
@@ -15,6 +29,9 @@ CA_CERT = "certs/ca.crt"
 CLIENT_CERT = "certs/client.crt"
 CLIENT_KEY = "certs/client.key"
 
+# Prometheus-style metrics on http://localhost:9103/metrics (0 disables)
+METRICS_PORT = 9103
+
 # SQLite DB
 DATABASE = "positioning.db"
 conn = sqlite3.connect(DATABASE, check_same_thread=False)
@@ -29,7 +46,11 @@ CREATE TABLE IF NOT EXISTS wifi_rssi (
     mac TEXT,
     device_name TEXT,
     rssi INTEGER,
-    latency REAL
+    latency REAL,
+    run_id INTEGER NOT NULL DEFAULT 0,
+    device_key INTEGER,
+    ap_key INTEGER,
+    ts_ms INTEGER
 )
 """)
 
@@ -41,7 +62,11 @@ CREATE TABLE IF NOT EXISTS ble_rssi (
     mac TEXT,
     device_name TEXT,
     rssi INTEGER,
-    latency REAL
+    latency REAL,
+    run_id INTEGER NOT NULL DEFAULT 0,
+    device_key INTEGER,
+    ap_key INTEGER,
+    ts_ms INTEGER
 )
 """)
 
@@ -89,18 +114,66 @@ CREATE TABLE IF NOT EXISTS ble_filtered_rssi (
 
 conn.commit()
 
-# === Cleanup: Clear data on startup ===
-tables_to_clear = [
-    "wifi_rssi", "ble_rssi",
-    "wifi_estimated_positions", "ble_estimated_positions",
-    "wifi_filtered_rssi", "ble_filtered_rssi"
-]
+# === Start a new run instead of wiping the tables ===
+# Every raw row is stamped with run_id; older runs are kept and only the
+# oldest beyond KEEP_RUNS are expired in the background
+KEEP_RUNS = 10
+RAW_TABLES = ["wifi_rssi", "ble_rssi"]
+ensure_run_partitioning(conn, RAW_TABLES)
+RUN_ID = start_run(conn, "hybrid_subscriber")
+print(f"Started run {RUN_ID} (keeping the last {KEEP_RUNS} runs).")
+expire_runs_in_background(DATABASE, RAW_TABLES, KEEP_RUNS)
+
+# === Device/AP names are resolved to integer keys once per spelling, here at ingest ===
+identity = ensure_identity_columns(conn, RAW_TABLES)
+# === Integer epoch-ms event time next to the text timestamp (common/epoch_time.py) ===
+ensure_epoch_columns(conn, RAW_TABLES)
+
+# === Write-behind queue: inserts are batched and committed off the MQTT network thread ===
+metrics = IngestMetrics()
+write_queue = WriteBehindQueue(DATABASE, max_batch=500, max_delay=0.5, metrics=metrics).start()
+metrics.track_queue_depth(write_queue.qsize)
 
-for table in tables_to_clear:
-    cursor.execute(f"DELETE FROM {table}")
-    cursor.execute(f"DELETE FROM sqlite_sequence WHERE name='{table}'")
+# === Streaming fusion (hybrid_fusion.py): fused, Kalman-filtered rows are written to
+# hybrid_filtered_rssi as soon as their +-2 s window closes, instead of after a
+# hybrid_rssi_filter.py batch run (which rebuilds the table from the raw rows) ===
+STREAMING_FUSION = True
+ensure_filtered_table(conn)
 conn.commit()
-print("Cleared all tables on startup.")
+# Kalman filters of tags idle for FUSION_STATE_TTL seconds, or the least recently
+# used beyond FUSION_MAX_FILTERS, are checkpointed to kalman_state and dropped
+# from memory (common/kalman_store.py); a returning tag resumes from its checkpoint
+FUSION_STATE_TTL = 15 * 60
+FUSION_MAX_FILTERS = 20000
+fusion_state = KalmanStateStore(sqlite3.connect(DATABASE, check_same_thread=False, timeout=30), "hybrid_fusion",
+                                max_keys=FUSION_MAX_FILTERS, ttl=FUSION_STATE_TTL)
+fusion = FusionOperator(bank=fusion_state)
+INSERT_FUSED_SQL = """INSERT OR IGNORE INTO hybrid_filtered_rssi (timestamp, ts_ms, ap_key, device_key, filtered_rssi, latency)
+                       VALUES (?, ?, ?, ?, ?, ?)"""
+SIGNAL_TYPES = {"ble_rssi": "BLE", "wifi_rssi": "WiFi"}
+
+def write_fused(fused_rows):
+    if fused_rows and not write_queue.put_many(INSERT_FUSED_SQL, fused_rows):
+        print(f"Write queue full, dropped {len(fused_rows)} fused reading(s).")
+
+if STREAMING_FUSION:
+    metrics.registry.gauge("fusion_buffered_readings", "Readings held in the fusion ring buffers",
+                           lambda: fusion.stats()["buffered"])
+    metrics.registry.gauge("fusion_late_readings", "Readings that arrived behind the watermark and were not fused",
+                           lambda: fusion.late)
+    metrics.registry.gauge("fusion_emitted_rows", "Fused rows written to hybrid_filtered_rssi",
+                           lambda: fusion.emitted)
+    metrics.registry.gauge("fusion_kalman_filters", "Kalman filters held in memory by the fusion",
+                           lambda: len(fusion_state))
+    fusion_ticker_stop = threading.Event()
+    fusion_ticker = start_ticker(fusion, write_fused, stop=fusion_ticker_stop)
+
+# Publisher clock offsets (common/clock_sync.py): pings go out every few seconds
+# and stored latency is corrected by the offset of the clock that stamped the reading
+clock = ClockSync()
+metrics.track_clock(clock)
+if METRICS_PORT:
+    metrics.serve(METRICS_PORT)
 
 # === MQTT Callbacks ===
 def on_connect(client, userdata, flags, rc):
@@ -111,21 +184,15 @@ def on_connect(client, userdata, flags, rc):
         print(f"Connection failed with code {rc}")
 
 def on_message(client, userdata, msg):
+    if msg.topic == ECHO_TOPIC:
+        clock.handle_echo(msg.payload, time.time())
+        return
+    metrics.messages.inc(msg.topic)
     try:
-        data = json.loads(msg.payload.decode())
+        readings = decode_readings(msg.payload)  # Binary reading, per-scan batch or JSON
         topic = msg.topic
 
-        receive_time = time.time()
-        send_time = float(data.get("timestamp_epoch", receive_time))
-        latency = receive_time - send_time
-
-        if "mac_address" in data and "device_name" in data and "rssi" in data:
-            timestamp = data.get("timestamp", time.strftime("%Y-%m-%d %H:%M:%S"))
-            ap_id = data.get("ap_id", "Unknown")
-            mac = data["mac_address"]
-            device_name = data["device_name"]
-            rssi = int(data["rssi"])
-
+        if readings:
             if topic == "wifi/rssi":
                 table = "wifi_rssi"
             elif topic == "ble/rssi":
@@ -134,18 +201,53 @@ def on_message(client, userdata, msg):
                 print(f"Unknown topic: {topic}")
                 return
 
-            cursor.execute(
-                f"""INSERT INTO {table} (timestamp, ap_id, mac, device_name, rssi, latency)
-                    VALUES (?, ?, ?, ?, ?, ?)""",
-                (timestamp, ap_id, mac, device_name, rssi, latency)
+            receive_time = time.time()
+            rows = []
+            for timestamp, send_time, ap_id, mac, device_name, rssi in readings:
+                if send_time is None:
+                    latency = 0.0
+                else:
+                    latency = clock.correct_latency(receive_time - send_time, receive_time,
+                                                  reading_sender(topic, ap_id, device_name))
+                metrics.latency_seconds.observe(latency)
+                metrics.readings.inc(topic, ap_id)
+                ts_ms = reading_ms(timestamp, send_time, receive_time)
+                if timestamp is None:
+                    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+                rows.append((timestamp, ap_id, mac, device_name, rssi, latency, RUN_ID,
+                             identity.device_key(device_name), identity.ap_key(ap_id), ts_ms))
+
+            # A whole scan batch is queued as one slot and written by one executemany
+            queued = write_queue.put_many(
+                f"""INSERT INTO {table} (timestamp, ap_id, mac, device_name, rssi, latency, run_id, device_key, ap_key, ts_ms)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                rows
             )
-            conn.commit()
-            print(f"Stored [{table}]: {timestamp} | AP: {ap_id} | MAC: {mac} | Device: {device_name} | RSSI: {rssi} | Latency: {latency:.3f}s")
+            if queued:
+                for timestamp, ap_id, mac, device_name, rssi, latency, _, _, _, _ in rows:
+                    print(f"Queued [{table}]: {timestamp} | AP: {ap_id} | MAC: {mac} | Device: {device_name} | RSSI: {rssi} | Latency: {latency:.3f}s")
+            else:
+                print(f"Write queue full, dropped {len(rows)} [{table}] reading(s).")
+
+            if STREAMING_FUSION:
+                fused_rows = []
+                for _, ap_id, _, device_name, rssi, latency, _, device_key, ap_key, ts_ms in rows:
+                    if rssi is not None:
+                        # Each publisher clock has its own watermark (hybrid_fusion.py)
+                        fused_rows += fusion.add(ts_ms, device_key, ap_key, SIGNAL_TYPES[table], rssi, latency,
+                                                 source=reading_sender(topic, ap_id, device_name))
+                write_fused(fused_rows)
         else:
             print("Missing fields in MQTT payload.")
 
-    except json.JSONDecodeError:
-        print("JSON Decode Error!")
+    except ValueError as e:
+        metrics.decode_errors.inc(msg.topic)
+        print(f"Payload Decode Error! ({e})")
+    except sqlite3.Error as e:
+        # New device/AP spellings are registered on this thread (fusion needs the keys
+        # here); if SQLite fails, e.g. locked by the writer, the message is dropped
+        metrics.key_errors.inc(msg.topic)
+        print(f"Key Store Error, message dropped! ({e})")
     except Exception as e:
         print(f"Unexpected Error: {e}")
 
@@ -159,4 +261,22 @@ client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
 client.on_connect = on_connect
 client.on_message = on_message
 client.connect(MQTT_BROKER, MQTT_PORT, 60)
-client.loop_forever()
+start_pinger(clock, client.publish)
+
+try:
+    client.loop_forever()
+except KeyboardInterrupt:
+    print("Stopping subscriber...")
+finally:
+    client.disconnect()
+    if STREAMING_FUSION:
+        # No tick may touch the Kalman filters while they are flushed and checkpointed
+        fusion_ticker_stop.set()
+        fusion_ticker.join()
+        write_fused(fusion.flush())  # Windows still open at shutdown
+        print("Fusion stats:", fusion.stats())
+        fusion_state.checkpoint()  # The next session resumes every filter
+        print("Kalman state stats:", fusion_state.stats())
+    write_queue.close()
+    print("Write queue stats:", write_queue.stats())
+    print("Clock offsets:", clock.stats())
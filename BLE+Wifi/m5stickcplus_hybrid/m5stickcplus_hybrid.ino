@@ -4,6 +4,7 @@
 #include <PubSubClient.h>
 #include <ArduinoJson.h>
 #include <time.h>
+#include <sys/time.h>
 #include <BLEDevice.h>
 #include <BLEUtils.h>
 #include <BLEBeacon.h>
@@ -19,10 +20,20 @@ const int mqtt_port = 8883;  // Use port 8883 for secure MQTT
 const char* mqtt_user = "team19";
 const char* mqtt_password = "test123";
 const char* mqtt_topic_wifi = "wifi/rssi";
+// Clock offset ping/echo, see common/clock_sync.py
+const char* mqtt_topic_ping = "clock/ping";
+const char* mqtt_topic_echo = "clock/echo";
 
 // === Device Identity ===
 const char* DEVICE_NAME = "M5StickCPlus-XinYi";
 
+// === Payload format ===
+// 1 = compact 20-byte binary reading (format v1, see common/rssi_codec.py), 0 = JSON
+#define USE_BINARY_PAYLOAD 1
+#define READING_V1_SIZE 20
+// Index of DEVICE_NAME in DEVICE_NAMES in common/rssi_codec.py. CHANGE THIS FOR EACH M5STICK
+const uint16_t DEVICE_CODE = 10;
+
 // === BLE Beacon UUID (per team/personal) ===
 #define BEACON_UUID "12345678-9012-3456-7890-1234567890AB"
 
@@ -170,6 +181,7 @@ void connectToMQTT() {
   while (!client.connected()) {
     if (client.connect(DEVICE_NAME, mqtt_user, mqtt_password)) {
       M5.Lcd.println("MQTT Connected");
+      client.subscribe(mqtt_topic_ping);
     } else {
       M5.Lcd.printf("MQTT failed (%d)\n", client.state());
       delay(2000);
@@ -177,6 +189,35 @@ void connectToMQTT() {
   }
 }
 
+// Epoch seconds with sub-second resolution (time(nullptr) is whole seconds)
+double epochNow() {
+  struct timeval tv;
+  gettimeofday(&tv, nullptr);
+  return tv.tv_sec + tv.tv_usec / 1e6;
+}
+
+// Clock ping from the ingest host: echo it with our receive / send times
+// so it can estimate this stick's clock offset (common/clock_sync.py)
+void onMqttMessage(char* topic, byte* message, unsigned int length) {
+  double receivedAt = epochNow();
+  if (strcmp(topic, mqtt_topic_ping) != 0) return;
+
+  StaticJsonDocument<192> ping;
+  if (deserializeJson(ping, message, length)) return;
+
+  StaticJsonDocument<256> echo;
+  echo["session"] = ping["session"];
+  echo["seq"] = ping["seq"];
+  echo["t0"] = ping["t0"];
+  echo["t1"] = receivedAt;
+  echo["sender"] = DEVICE_NAME;
+  echo["t2"] = epochNow();
+
+  char payload[256];
+  serializeJson(echo, payload);
+  client.publish(mqtt_topic_echo, payload);
+}
+
 String getTimestamp() {
   time_t now = time(nullptr);
   struct tm* t = localtime(&now);
@@ -187,6 +228,33 @@ String getTimestamp() {
   return String(timestamp);
 }
 
+// Dictionary code of an AP SSID (index in AP_NAMES in common/rssi_codec.py), 0 if unknown
+uint8_t apCodeForSsid(const String& ssidName) {
+  if (ssidName == "RPi_AP_Alicia") return 5;
+  if (ssidName == "RPi_AP_XY") return 6;
+  if (ssidName == "RPi_AP_EnThong") return 7;
+  if (ssidName == "RPi_AP_Pierre") return 8;
+  if (ssidName == "RPi_Hybrid_Alicia") return 9;
+  if (ssidName == "RPi_Hybrid_XY") return 10;
+  if (ssidName == "RPi_Hybrid_XinYi") return 11;
+  if (ssidName == "RPi_Hybrid_EnThong") return 12;
+  if (ssidName == "RPi_Hybrid_Pierre") return 13;
+  return 0;
+}
+
+// Binary reading v1, little-endian: header, flags, ap code, device code (u16),
+// BSSID (6 bytes), rssi (i8), timestamp_epoch (double)
+void encodeReading(uint8_t* buf, uint8_t apCode, const uint8_t* bssid, int rssi, double timestampEpoch) {
+  buf[0] = 0xA1;  // Format v1
+  buf[1] = 0x01;  // BSSIDStr() is upper-case
+  buf[2] = apCode;
+  buf[3] = DEVICE_CODE & 0xFF;
+  buf[4] = DEVICE_CODE >> 8;
+  memcpy(buf + 5, bssid, 6);
+  buf[11] = (int8_t)constrain(rssi, -128, 127);
+  memcpy(buf + 12, &timestampEpoch, sizeof(double));  // ESP32 is little-endian IEEE 754
+}
+
 void setup() {
   M5.begin();
   M5.Lcd.setRotation(3);  // Landscape
@@ -199,6 +267,7 @@ void setup() {
 
   connectToWiFi();
   client.setServer(mqtt_server, mqtt_port);
+  client.setCallback(onMqttMessage);
   connectToMQTT();
   startBLEBeacon();
 
@@ -228,19 +297,26 @@ void loop() {
 
       String bssid = WiFi.BSSIDstr(i);
       int rssi = WiFi.RSSI(i);
-      time_t now = time(nullptr);
-
-      DynamicJsonDocument doc(256);
-      doc["timestamp"] = getTimestamp();
-      doc["timestamp_epoch"] = now;
-      doc["ap_id"] = ssidName;
-      doc["mac_address"] = bssid;
-      doc["device_name"] = DEVICE_NAME;
-      doc["rssi"] = rssi;
-
-      char payload[256];
-      serializeJson(doc, payload);
-      client.publish(mqtt_topic_wifi, payload);
+      double now = epochNow();
+
+      uint8_t apCode = USE_BINARY_PAYLOAD ? apCodeForSsid(ssidName) : 0;
+      if (apCode != 0) {
+        uint8_t payload[READING_V1_SIZE];
+        encodeReading(payload, apCode, WiFi.BSSID(i), rssi, now);
+        client.publish(mqtt_topic_wifi, payload, READING_V1_SIZE);
+      } else {
+        DynamicJsonDocument doc(256);
+        doc["timestamp"] = getTimestamp();
+        doc["timestamp_epoch"] = now;
+        doc["ap_id"] = ssidName;
+        doc["mac_address"] = bssid;
+        doc["device_name"] = DEVICE_NAME;
+        doc["rssi"] = rssi;
+
+        char payload[256];
+        serializeJson(doc, payload);
+        client.publish(mqtt_topic_wifi, payload);
+      }
 
       // Display SSID name
       M5.Lcd.setTextSize(1);
@@ -254,5 +330,10 @@ void loop() {
     }
   }
 
-  delay(6000);
+  // Wait for the next scan while still answering clock pings
+  unsigned long nextScan = millis() + 6000;
+  while ((long)(nextScan - millis()) > 0) {
+    client.loop();
+    delay(10);
+  }
 }
@@ -1,8 +1,14 @@
 import paho.mqtt.client as mqtt
-import json
 import time
 from bluepy.btle import Scanner
 import socket
+import os
+import sys
+
+# rssi_codec.py and clock_sync.py are copied next to this script on the Pi; ../common in the repo
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from rssi_codec import encode_batch, encode_reading, encode_json_reading
+from clock_sync import answer_pings
 
 # === MQTT Broker Configuration ===
 MQTT_BROKER = "keshleepi.local"  # Use hostname
@@ -16,6 +22,10 @@ CA_CERT = "certs/ca.crt"
 CLIENT_CERT = "certs/client.crt"
 CLIENT_KEY = "certs/client.key"
 
+# Payload format: "batch" (one binary message per scan), "binary" (one 20-byte
+# message per reading) or "json" (for subscribers not yet updated)
+PAYLOAD_FORMAT = "batch"
+
 
 # === MAC address to device name mapping ===
 DEVICE_NAME_MAP = {
@@ -36,29 +46,49 @@ AP_IDENTIFIER = socket.gethostname()
 mqtt_client = mqtt.Client()
 mqtt_client.tls_set(ca_certs=CA_CERT, certfile=CLIENT_CERT, keyfile=CLIENT_KEY)
 mqtt_client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
+
+def on_connect(client, userdata, flags, rc):
+    if rc == 0:
+        # Echo the ingest host's clock pings so it can correct latency for this Pi's clock
+        answer_pings(client, AP_IDENTIFIER)
+
+mqtt_client.on_connect = on_connect
 mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
+# Network thread: answers pings (and keeps the connection alive) while the scan blocks
+mqtt_client.loop_start()
 
 # === BLE Scanner ===
 scanner = Scanner()
 
+def publish_reading(timestamp_epoch, mac, device_name, rssi):
+    payload = None
+    if PAYLOAD_FORMAT != "json":
+        payload = encode_reading(timestamp_epoch, AP_IDENTIFIER, mac, device_name, rssi)
+    if payload is None:
+        # Unknown device/AP for the binary dictionary, fall back to JSON
+        payload = encode_json_reading(timestamp_epoch, AP_IDENTIFIER, mac, device_name, rssi)
+
+    mqtt_client.publish(MQTT_TOPIC, payload)
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp_epoch))
+    print(f"Published to MQTT: {timestamp} | AP: {AP_IDENTIFIER} | MAC: {mac} | Device: {device_name} | RSSI: {rssi} ({len(payload)} bytes)")
+
 while True:
     devices = scanner.scan(5.0)
+    timestamp_epoch = time.time()
+    readings = []
     for dev in devices:
         mac = dev.addr.lower()
         if mac in TARGET_MACS:
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-            timestamp_epoch = time.time()
-            device_name = DEVICE_NAME_MAP.get(mac, "Unknown")
-
-            payload = {
-                "timestamp": timestamp,
-                "timestamp_epoch": timestamp_epoch,
-                "ap_id": AP_IDENTIFIER,
-                "mac_address": mac,
-                "device_name": device_name,
-                "rssi": dev.rssi
-            }
-
-            mqtt_client.publish(MQTT_TOPIC, json.dumps(payload))
-            print(f"Published to MQTT: {payload}")
+            readings.append((mac, DEVICE_NAME_MAP.get(mac, "Unknown"), dev.rssi))
+
+    if PAYLOAD_FORMAT == "batch" and readings:
+        # One message (one MQTT/TLS frame) for the whole scan
+        payload, rejected = encode_batch(timestamp_epoch, AP_IDENTIFIER, readings)
+        if payload is not None:
+            mqtt_client.publish(MQTT_TOPIC, payload)
+            print(f"Published to MQTT: batch of {len(readings) - len(rejected)} readings from {AP_IDENTIFIER} ({len(payload)} bytes)")
+        readings = rejected  # Readings the batch could not dictionary-code go out one by one
+
+    for mac, device_name, rssi in readings:
+        publish_reading(timestamp_epoch, mac, device_name, rssi)
     time.sleep(2)
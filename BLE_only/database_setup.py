@@ -13,7 +13,10 @@ cursor.execute("""
         mac TEXT NOT NULL,
         device_name TEXT NOT NULL,
         rssi INTEGER NOT NULL,
-        latency REAL
+        latency REAL,
+        run_id INTEGER NOT NULL DEFAULT 0,
+        device_key INTEGER,
+        ap_key INTEGER
     )
 """)
 
@@ -1,15 +1,23 @@
+import argparse
 import os
+import sys
 import sqlite3
 import numpy as np
-from scipy.optimize import least_squares
-from datetime import datetime
-from collections import defaultdict
-from rssi_filter import rssi_to_distance
 
 # Database path
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE = os.path.join(BASE_DIR, "positioning.db")
 
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from rssi_filter import rssi_to_distance
+from epoch_time import ms_to_isoformat
+from trilateration import linear_positions, solve_positions
+from fingerprint import RadioMap, build_radio_map, reference_points
+from grid_solver import GRID_CELL, GridSolver
+from windowing import WINDOW_MS, known_windows, resample_windows, window_dicts
+from estimator_state import load_estimator_watermarks, read_since, reopened_windows, store_estimates
+from migrations import migrate
+
 # AP coordinates
 AP_COORDINATES = {
     "xypi": (4.96, 0),
@@ -18,171 +26,195 @@ AP_COORDINATES = {
     "aliciapi": (0, 0)
 }
 
-# Create estimated_positions table with device_name
-def create_position_table():
+# Log-distance model of rssi_to_distance(): RSSI at 1 m and path-loss exponent
+PATH_LOSS_A, PATH_LOSS_N = -55.525, 0.73529100890785
+
+# The room: grid fixes are searched inside it
+FLOOR_BOUNDS = ([0, 0], [4.96, 8.06])
+
+# Filtered readings in event-time order (index plans: tests/test_query_plans.py)
+FILTERED_ROWS_SQL = """
+    SELECT mac, device_name, ap_id, ts_ms, filtered_rssi
+    FROM filtered_rssi
+    ORDER BY ts_ms ASC, ap_id ASC, mac ASC
+"""
+
+# The same from an epoch-ms time on, for incremental runs
+FILTERED_ROWS_SINCE_SQL = """
+    SELECT mac, device_name, ap_id, ts_ms, filtered_rssi
+    FROM filtered_rssi
+    WHERE ts_ms >= ?
+    ORDER BY ts_ms ASC, ap_id ASC, mac ASC
+"""
+
+# Incremental mode keeps its per-MAC watermarks under this name
+ESTIMATOR_NAME = "estimated_positions"
+
+# Positions of a window are replaced when an incremental run solves it again
+UPSERT_POSITION_SQL = """
+    INSERT INTO {table} (mac, device_name, x, y, timestamp, ts_ms, method)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (mac, timestamp) DO UPDATE SET device_name = excluded.device_name, x = excluded.x,
+        y = excluded.y, ts_ms = excluded.ts_ms, method = excluded.method
+"""
+
+# estimated_positions layout ({table}: a full run writes a new table that then replaces it)
+POSITION_TABLE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        mac TEXT,
+        device_name TEXT,
+        x REAL,
+        y REAL,
+        timestamp DATETIME,
+        ts_ms INTEGER,
+        method TEXT,
+        UNIQUE(mac, timestamp)
+    )
+"""
+
+# Filtered RSSI of every MAC (from epoch-ms `since` on, if set) resampled onto window_ms windows
+# (common/windowing.py): (macs K, ts_ms K, RSSI K x APs, AP ids), the device name of every MAC
+# and the newest ts_ms read of every MAC
+def fetch_grouped_rssi(window_ms=WINDOW_MS, since=None):
     conn = sqlite3.connect(DATABASE)
+    migrate(conn, ["filtered_rssi"])  # ts_ms and its index, on a database filtered before they existed
     cursor = conn.cursor()
-
-     # Drop the table if it exists
-    cursor.execute("DROP TABLE IF EXISTS estimated_positions")
-    print(f"Dropped estimated_positions table...")
-
-    cursor.execute("""
-        CREATE TABLE estimated_positions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            mac TEXT,
-            device_name TEXT,
-            x REAL,
-            y REAL,
-            timestamp DATETIME,
-            UNIQUE(mac, timestamp)
-        )
-    """)
-    conn.commit()
+    if since is None:
+        cursor.execute(FILTERED_ROWS_SQL)
+    else:
+        cursor.execute(FILTERED_ROWS_SINCE_SQL, (since,))
+    raw_data = cursor.fetchall()
     conn.close()
 
-# Group RSSI readings by MAC within ±2s window
-def fetch_grouped_rssi():
+    mac_device_name = {mac: device_name for mac, device_name, _, _, _ in raw_data}
+    latest = {mac: ts_ms for mac, _, _, ts_ms, _ in raw_data}  # Rows come in event-time order
+    windows = resample_windows([(mac, ap_id, ts_ms, rssi) for mac, _, ap_id, ts_ms, rssi in raw_data], window_ms)
+    return windows, mac_device_name, latest
+
+# Nonlinear least squares trilateration of every window at once (common/trilateration.py):
+# K x 3 AP positions and distances -> K positions and whether each converged
+def improved_trilateration(ap_points, distances):
+    points = np.asarray(ap_points, dtype=float)
+    initial = np.mean(points, axis=1)
+    return solve_positions(points, distances, initial, loss='soft_l1')  # Keep this if you still want robust loss
+
+# Linear fallback trilateration of a batch: AP-subset geometry is cached and
+# collinear subsets come back unsolved (common/trilateration.py)
+def weighted_trilateration(ap_points, distances):
+    return linear_positions(ap_points, distances)
+
+# Fingerprint radio map (common/fingerprint.py) from the windows of the surveyed tags in ground_truth_positions
+def build_fingerprints(window_ms=WINDOW_MS):
+    (macs, _, rssi, aps), mac_device_name, _ = fetch_grouped_rssi(window_ms)
     conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT mac, device_name, ap_id, timestamp, filtered_rssi
-        FROM filtered_rssi
-        ORDER BY timestamp ASC
-    """)
-    raw_data = cursor.fetchall()
+    surveyed = reference_points(conn)
+    samples = [(ap_rssi, *surveyed[mac_device_name[mac]])
+               for mac, ap_rssi in zip(macs, window_dicts(rssi, aps)) if mac_device_name[mac] in surveyed]
+    fingerprints = build_radio_map(conn, samples)
     conn.close()
+    print(f"Radio map: {fingerprints} fingerprints from {len(samples)} windows of {len(surveyed)} surveyed tags.")
+    return fingerprints
 
-    grouped = defaultdict(list)
-    for mac, device_name, ap_id, ts, rssi in raw_data:
-        ts_dt = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
-        grouped[mac].append((ts_dt, ap_id, rssi, device_name))
-
-    windowed_data = {}
-    mac_device_name = {}
-
-    for mac, readings in grouped.items():
-        readings.sort()
-        i = 0
-        while i < len(readings):
-            ts_i, ap_i, rssi_i, dev_name = readings[i]
-            window = {ap_i: rssi_i}
-            timestamps = [ts_i]
-            j = i + 1
-
-            while j < len(readings):
-                ts_j, ap_j, rssi_j, _ = readings[j]
-                if (ts_j - ts_i).total_seconds() <= 3:
-                    window[ap_j] = rssi_j
-                    timestamps.append(ts_j)
-                    j += 1
-                else:
-                    break
-
-            if len(window) == 3:
-                mid_ts = min(timestamps) + (max(timestamps) - min(timestamps)) / 2
-                ts_str = mid_ts.isoformat()
-
-                if mac not in windowed_data:
-                    windowed_data[mac] = {}
-                    mac_device_name[mac] = dev_name
-
-                windowed_data[mac][ts_str] = window
-                i = j  # Skip overlapping
-            else:
-                i += 1
-
-    return windowed_data, mac_device_name
-
-# Nonlinear least squares trilateration
-def improved_trilateration(ap_positions, distances):
-    points = np.array(ap_positions)
-    dists = np.array(distances)
-    weights = 1.0 / (dists + 0.1)
-
-    def residuals(point):
-        return weights * (np.linalg.norm(points - point, axis=1) - dists)
-
-    try:
-        initial = np.mean(points, axis=0)
-        result = least_squares(
-            residuals,
-            x0=initial,
-            loss='soft_l1'  # Keep this if you still want robust loss
-        )
-        return result.x if result.success else (None, None)
-    except:
-        return None, None
-
-# Linear fallback trilateration
-def weighted_trilateration(ap_positions, distances):
-    A, b, weights = [], [], []
-    for i in range(1, len(ap_positions)):
-        x0, y0 = ap_positions[0]
-        xi, yi = ap_positions[i]
-        di_sq = distances[i]**2 - distances[0]**2
-        A.append([2 * (xi - x0), 2 * (yi - y0)])
-        b.append(di_sq - (xi**2 + yi**2 - x0**2 - y0**2))
-        weights.append(1 / (distances[i] + 1e-6))
-    try:
-        A, b, W = np.array(A), np.array(b), np.diag(weights)
-        x = np.linalg.inv(A.T @ W @ A) @ A.T @ W @ b
-        return x
-    except:
-        return None, None
-
-# Estimate positions from grouped RSSI data
-def estimate_positions():
-    grouped, mac_device_name = fetch_grouped_rssi()
+# Weighted k-NN lookup of a batch of windows in the radio map
+def fingerprint_positions(window_rssi):
+    conn = sqlite3.connect(DATABASE)
+    radio_map = RadioMap.load(conn)
+    conn.close()
+    if not len(radio_map):
+        raise RuntimeError("No radio map; run with --build-radio-map first")
+    return radio_map.locate(window_rssi)
+
+# Grid-likelihood fixes of a batch of windows (K x APs RSSI, common/grid_solver.py):
+# every cell of FLOOR_BOUNDS scored by one matrix product, the most likely one refined
+def grid_positions(rssi, aps, cell=GRID_CELL):
+    columns = [column for column, ap in enumerate(aps) if ap in AP_COORDINATES]
+    solver = GridSolver([AP_COORDINATES[aps[column]] for column in columns], PATH_LOSS_A, PATH_LOSS_N,
+                        bounds=FLOOR_BOUNDS, cell=cell)
+    return solver.locate(rssi[:, columns])
+
+# Estimate positions from grouped RSSI data (method: 'trilateration', 'fingerprint' or 'grid');
+# incremental: only the windows from the trailing one of every MAC on (common/estimator_state.py).
+# Returns the positions and the newest ts_ms read of every MAC
+def estimate_positions(method="trilateration", grid_cell=GRID_CELL, window_ms=WINDOW_MS, incremental=False):
+    watermarks = {}
+    if incremental:
+        conn = sqlite3.connect(DATABASE)
+        watermarks = load_estimator_watermarks(conn, ESTIMATOR_NAME, window_ms)
+        conn.close()
+    (macs, window_ts, rssi, aps), mac_device_name, latest = fetch_grouped_rssi(window_ms, read_since(watermarks, window_ms))
     estimated = {}
 
-    for mac, time_groups in grouped.items():
-        device_name = mac_device_name.get(mac, "Unknown")
-        for timestamp, ap_rssi in time_groups.items():
-            ap_positions, distances = [], []
-            for ap_id, rssi in ap_rssi.items():
-                if ap_id in AP_COORDINATES:
-                    ap_positions.append(AP_COORDINATES[ap_id])
-                    distances.append(rssi_to_distance(rssi))
-
-            if len(ap_positions) == 3:
-                result = improved_trilateration(ap_positions, distances)
-                if result is None or len(result) != 2:
-                    result = weighted_trilateration(ap_positions, distances)
-
-                if result is not None and len(result) == 2:
-                    x, y = float(result[0]), float(result[1])
-                    estimated[(mac, timestamp)] = (x, y, device_name)
-                #     print(f"Estimated: MAC={mac}, Name={device_name}, X={x:.2f}, Y={y:.2f}, Time={timestamp}")
-                # else:
-                #     print(f"Failed to estimate for MAC={mac} at {timestamp}")
-
-    return estimated
-
-# Store estimated positions to DB
-def store_positions(positions):
+    # Windows with three known APs (not yet closed at the watermarks), solved in one batch
+    rows, columns = known_windows(rssi, aps, AP_COORDINATES)
+    reopened = reopened_windows(macs[rows], window_ts[rows], window_ms, watermarks)
+    rows, columns = rows[reopened], columns[reopened]
+    if not len(rows):
+        return estimated, latest
+    coordinates = np.array([AP_COORDINATES.get(ap, (np.nan, np.nan)) for ap in aps], dtype=float).reshape(-1, 2)
+    ap_points = coordinates[columns]
+    window_distances = rssi_to_distance(rssi[rows[:, None], columns])
+    windows = [(mac, ms_to_isoformat(ts_ms), mac_device_name.get(mac, "Unknown"), int(ts_ms))
+               for mac, ts_ms in zip(macs[rows], window_ts[rows])]
+
+    if method == "fingerprint":
+        positions, solved = fingerprint_positions(window_dicts(rssi[rows], aps))
+        methods = ["fingerprint"] * len(windows)
+    elif method == "grid":
+        positions, solved = grid_positions(rssi[rows], aps, grid_cell)
+        methods = ["grid"] * len(windows)
+    else:
+        positions, converged = improved_trilateration(ap_points, window_distances)
+        solved = converged.copy()
+        fallback = np.flatnonzero(~converged)
+        if len(fallback):
+            positions[fallback], solved[fallback] = weighted_trilateration(ap_points[fallback], window_distances[fallback])
+        methods = ["trilateration" if ok else "weighted_fallback" for ok in converged]
+
+    for (mac, timestamp, device_name, ts_ms), result, ok, window_method in zip(windows, positions, solved, methods):
+        if ok:
+            x, y = float(result[0]), float(result[1])
+            estimated[(mac, timestamp)] = (x, y, device_name, ts_ms, window_method)
+        #     print(f"Estimated: MAC={mac}, Name={device_name}, X={x:.2f}, Y={y:.2f}, Time={timestamp}")
+        # else:
+        #     print(f"Failed to estimate for MAC={mac} at {timestamp}")
+
+    return estimated, latest
+
+# Store estimated positions to DB in one batch of upserts, with the watermarks of the readings they came from;
+# replace=True (full run) swaps them in for the stored table once all are written
+def store_positions(positions, latest=None, window_ms=WINDOW_MS, replace=False):
     if not positions:
         print("No new positions to store.")
-        return
     conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    for (mac, timestamp), (x, y, device_name) in positions.items():
-        cursor.execute("""
-            INSERT OR IGNORE INTO estimated_positions (mac, device_name, x, y, timestamp)
-            VALUES (?, ?, ?, ?, ?)
-        """, (mac, device_name, x, y, timestamp))
-        # print(f"→ Stored: MAC={mac}, Name={device_name}, X={x:.2f}, Y={y:.2f}, Timestamp={timestamp}")
-    conn.commit()
+    store_estimates(conn, ESTIMATOR_NAME, "estimated_positions", POSITION_TABLE_SCHEMA, UPSERT_POSITION_SQL,
+                    [(mac, device_name, x, y, timestamp, ts_ms, method)
+                     for (mac, timestamp), (x, y, device_name, ts_ms, method) in positions.items()],
+                    latest or {}, window_ms, replace)
     conn.close()
     # print(f"{len(positions)} new positions stored.\n")
 
 # Entry point
 if __name__ == "__main__":
-    create_position_table()
+    parser = argparse.ArgumentParser(description="Estimate BLE tag positions from the filtered RSSI.")
+    parser.add_argument("--method", choices=["trilateration", "fingerprint", "grid"], default="trilateration",
+                        help="Log-distance trilateration, weighted k-NN in the radio map, or grid likelihood")
+    parser.add_argument("--grid-cell", type=float, default=GRID_CELL, help="Cell edge (m) of --method grid")
+    parser.add_argument("--window", type=float, default=WINDOW_MS / 1000, help="Width (s) of the windows readings are grouped in")
+    parser.add_argument("--build-radio-map", action="store_true",
+                        help="Build the radio map from the surveyed tags (ground_truth_positions) and exit")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only solve the windows after the last run's watermarks, keeping the stored positions")
+    args = parser.parse_args()
+    window_ms = int(round(args.window * 1000))
+
+    if args.build_radio_map:
+        build_fingerprints(window_ms)
+        raise SystemExit
     print("==== Estimating Positions ====")
     try:
-        results = estimate_positions()
-        store_positions(results)
+        results, latest = estimate_positions(args.method, args.grid_cell, window_ms, args.incremental)
+        store_positions(results, latest, window_ms, replace=not args.incremental)
         print("==== Done ====")
     except Exception as ex:
         print("Error:", ex)
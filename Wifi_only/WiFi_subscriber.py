@@ -1,7 +1,17 @@
 import paho.mqtt.client as mqtt
-import json
 import time
 import sqlite3
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from write_queue import WriteBehindQueue
+from rssi_codec import decode_readings
+from run_storage import ensure_run_partitioning, start_run, expire_runs_in_background
+from identity import ensure_identity_columns
+from metrics import IngestMetrics
+from clock_sync import ECHO_TOPIC, ClockSync, start_pinger
+from epoch_time import ensure_epoch_columns, reading_ms
 
 # MQTT Config
 MQTT_BROKER = "192.168.33.148"  # Update if needed
@@ -10,58 +20,90 @@ MQTT_TOPIC = "wifi/rssi"
 MQTT_USERNAME = "team19"
 MQTT_PASSWORD = "test123"
 
+# Prometheus-style metrics on http://localhost:9102/metrics (0 disables)
+METRICS_PORT = 9102
+
 # Database SQLite
 DATABASE = "positioning.db"
 conn = sqlite3.connect(DATABASE, check_same_thread=False)
 cursor = conn.cursor()
 
-# Cleanup: Remove all rows from relevant tables on start
-try:
-    tables_to_clear = ["wifi_rssi", "wifi_estimated_positions", "wifi_filtered_rssi"]
-    for table in tables_to_clear:
-        cursor.execute(f"DELETE FROM {table}")
-        cursor.execute("DELETE FROM sqlite_sequence WHERE name=?", (table,))
-    conn.commit()
-    print("Cleared wifi_rssi, estimated_positions, and filtered_rssi tables.")
-except Exception as e:
-    print(f"Failed to clear tables: {e}")
+# Start a new run instead of wiping the tables: every raw row is stamped with
+# run_id, older runs are kept and only the oldest beyond KEEP_RUNS are expired
+KEEP_RUNS = 10
+ensure_run_partitioning(conn, ["wifi_rssi"])
+RUN_ID = start_run(conn, "WiFi_subscriber")
+print(f"Started run {RUN_ID} (keeping the last {KEEP_RUNS} runs).")
+expire_runs_in_background(DATABASE, ["wifi_rssi"], KEEP_RUNS)
+
+# Device/AP names are resolved to integer keys once per spelling, here at ingest
+identity = ensure_identity_columns(conn, ["wifi_rssi"])
+# Integer epoch-ms event time next to the text timestamp (common/epoch_time.py)
+ensure_epoch_columns(conn, ["wifi_rssi"])
+
+# Write-behind queue: inserts are batched and committed off the MQTT network thread
+metrics = IngestMetrics()
+write_queue = WriteBehindQueue(DATABASE, max_batch=500, max_delay=0.5, metrics=metrics).start()
+metrics.track_queue_depth(write_queue.qsize)
+
+# Publisher clock offsets (common/clock_sync.py): pings go out every few seconds
+# and stored latency is corrected by the offset of the clock that stamped the reading
+clock = ClockSync()
+metrics.track_clock(clock)
+if METRICS_PORT:
+    metrics.serve(METRICS_PORT)
+INSERT_SQL = "INSERT INTO wifi_rssi (timestamp, ap_id, mac, device_name, rssi, latency, run_id, device_key, ap_key, ts_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
 
 # MQTT Callbacks
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print("Connected to MQTT Broker")
-        client.subscribe(MQTT_TOPIC)
+        client.subscribe([(MQTT_TOPIC, 0), (ECHO_TOPIC, 0)])
     else:
         print(f"Connection failed with code {rc}")
 
 def on_message(client, userdata, msg):
+    if msg.topic == ECHO_TOPIC:
+        clock.handle_echo(msg.payload, time.time())
+        return
+    metrics.messages.inc(msg.topic)
     try:
-        data = json.loads(msg.payload.decode())
-        print("Received MQTT Data:", data)
-
-        if "mac_address" in data and "device_name" in data and "rssi" in data:
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-            ap_id = data.get("ap_id", "Unknown")
-            mac = data["mac_address"]
-            device_name = data["device_name"]
-            rssi = int(data["rssi"])
+        readings = decode_readings(msg.payload)  # Binary reading, per-scan batch or JSON
+        print("Received MQTT Data:", readings)
+        if not readings:
+            print("Warning: Unexpected MQTT message format!")
+            return
 
-            receive_time = time.time()  # When message is received
-            send_time = float(data.get("timestamp_epoch", receive_time))  # fallback in case it's missing
-            latency = receive_time - send_time
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        receive_time = time.time()  # When message is received
+        rows = []
+        for sent_timestamp, send_time, ap_id, mac, device_name, rssi in readings:
+            if send_time is None:
+                latency = 0.0  # fallback in case it's missing
+            else:
+                latency = clock.correct_latency(receive_time - send_time, receive_time, device_name)
             print(f"Latency: {latency:.3f} seconds")
+            metrics.latency_seconds.observe(latency)
+            metrics.readings.inc(msg.topic, ap_id)
+            rows.append((sent_timestamp or timestamp, ap_id, mac, device_name, rssi, latency, RUN_ID,
+                         identity.device_key(device_name), identity.ap_key(ap_id),
+                         reading_ms(sent_timestamp, send_time, receive_time)))
 
-            cursor.execute(
-                "INSERT INTO wifi_rssi (timestamp, ap_id, mac, device_name, rssi, latency) VALUES (?, ?, ?, ?, ?, ?)",
-                (data["timestamp"], ap_id, mac, device_name, rssi, latency)
-            )
-            conn.commit()
-            print(f"Stored: {timestamp} | AP: {ap_id} | MAC: {mac} | Device: {device_name} | RSSI: {rssi} dBm")
+        # A whole scan batch is queued as one slot and written by one executemany
+        if write_queue.put_many(INSERT_SQL, rows):
+            for _, ap_id, mac, device_name, rssi, _, _, _, _, _ in rows:
+                print(f"Queued: {timestamp} | AP: {ap_id} | MAC: {mac} | Device: {device_name} | RSSI: {rssi} dBm")
         else:
-            print("Warning: Unexpected MQTT message format!")
+            print(f"Warning: write queue full, {len(rows)} reading(s) dropped!")
 
-    except json.JSONDecodeError:
-        print("Error: Received non-JSON data!")
+    except ValueError as e:
+        metrics.decode_errors.inc(msg.topic)
+        print(f"Error: Received undecodable payload! ({e})")
+    except sqlite3.Error as e:
+        # A new device/AP spelling is registered on this (network) thread; if SQLite
+        # fails, e.g. locked by the writer, the message is dropped, not the connection
+        metrics.key_errors.inc(msg.topic)
+        print(f"Error: Could not store device/AP keys, message dropped! ({e})")
 
 # Start MQTT Client
 client = mqtt.Client()
@@ -69,6 +111,15 @@ client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
 client.on_connect = on_connect
 client.on_message = on_message
 client.connect(MQTT_BROKER, MQTT_PORT, 60)
+start_pinger(clock, client.publish)
 
 # Start listening
-client.loop_forever()
+try:
+    client.loop_forever()
+except KeyboardInterrupt:
+    print("Stopping subscriber...")
+finally:
+    client.disconnect()
+    write_queue.close()
+    print("Write queue stats:", write_queue.stats())
+    print("Clock offsets:", clock.stats())
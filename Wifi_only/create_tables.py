@@ -12,7 +12,10 @@ CREATE TABLE IF NOT EXISTS wifi_rssi (
     ap_id TEXT,
     mac TEXT,
     device_name TEXT,
-    rssi INTEGER
+    rssi INTEGER,
+    run_id INTEGER NOT NULL DEFAULT 0,
+    device_key INTEGER,
+    ap_key INTEGER
 )
 """)
 
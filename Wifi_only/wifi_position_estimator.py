@@ -1,14 +1,23 @@
+import argparse
 import os
+import sys
 import sqlite3
 import numpy as np
-from scipy.optimize import least_squares
-from datetime import datetime
-from wifi_rssi_filter import rssi_to_distance
 
 # 1) Database path
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE = os.path.join(BASE_DIR, "positioning.db")
 
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from wifi_rssi_filter import rssi_to_distance
+from epoch_time import ms_to_isoformat
+from trilateration import linear_positions, solve_positions
+from fingerprint import RadioMap, build_radio_map, reference_points
+from grid_solver import GRID_CELL, GridSolver
+from windowing import WINDOW_MS, known_windows, resample_windows, window_dicts
+from estimator_state import load_estimator_watermarks, read_since, reopened_windows, store_estimates
+from migrations import migrate
+
 # 2) AP coordinates for each ap_id in your DB.
 #    Make sure these keys match what's actually in your "ap_id" column.
 AP_COORDINATES = {
@@ -18,197 +27,264 @@ AP_COORDINATES = {
     "RPi_AP_Alicia": (0, 0)
 }
 
-def create_position_table():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    # Drop and recreate wifi_estimated_positions table
-    cursor.execute("DROP TABLE IF EXISTS wifi_estimated_positions")
-
-    cursor.execute("""
-        CREATE TABLE wifi_estimated_positions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            mac TEXT,
-            x REAL,
-            y REAL,
-            timestamp DATETIME,
-            device_name TEXT,
-            UNIQUE(mac, timestamp)
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-
-# 3) Fetch & group RSSI values per device_name using ±2s window
-def fetch_grouped_rssi():
+#    Log-distance model of rssi_to_distance(): RSSI at 1 m and path-loss exponent
+PATH_LOSS_A, PATH_LOSS_N = -55.525, 0.73529100890785
+
+#    The room: grid fixes are searched inside it
+FLOOR_BOUNDS = ([0, 0], [4.96, 8.06])
+
+# Incremental mode keeps its per-device watermarks under this name
+ESTIMATOR_NAME = "wifi_estimated_positions"
+
+# Positions of a window are replaced when an incremental run solves it again. Devices
+# can report the same MAC, so a window is keyed by its device too: every device keeps
+# its own fix, however the readings were split between runs
+UPSERT_POSITION_SQL = """
+    INSERT INTO {table} (mac, x, y, timestamp, device_name, ts_ms, method)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (mac, timestamp, device_name) DO UPDATE SET x = excluded.x, y = excluded.y,
+        ts_ms = excluded.ts_ms, method = excluded.method
+"""
+
+# wifi_estimated_positions layout ({table}: a full run writes a new table that then replaces it)
+POSITION_TABLE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        mac TEXT,
+        x REAL,
+        y REAL,
+        timestamp DATETIME,
+        device_name TEXT,
+        ts_ms INTEGER,
+        method TEXT,
+        UNIQUE(mac, timestamp, device_name)
+    )
+"""
+
+
+# Filtered readings in event-time order (index plans: tests/test_query_plans.py)
+FILTERED_ROWS_SQL = """
+    SELECT device_name, mac, ap_id, ts_ms, filtered_rssi
+    FROM wifi_filtered_rssi
+    ORDER BY ts_ms ASC, ap_id ASC, mac ASC, device_name ASC
+"""
+
+# The same from an epoch-ms time on, for incremental runs
+FILTERED_ROWS_SINCE_SQL = """
+    SELECT device_name, mac, ap_id, ts_ms, filtered_rssi
+    FROM wifi_filtered_rssi
+    WHERE ts_ms >= ?
+    ORDER BY ts_ms ASC, ap_id ASC, mac ASC, device_name ASC
+"""
+
+# 3) Fetch the filtered RSSI of every device_name, resampled onto window_ms
+#    windows (common/windowing.py): (device names K, ts_ms K, RSSI K x APs, AP ids),
+#    and the MAC time index of the same readings; only those from epoch-ms `since` on, if set
+def fetch_grouped_rssi(window_ms=WINDOW_MS, since=None):
     conn = sqlite3.connect(DATABASE)
+    migrate(conn, ["wifi_filtered_rssi"])  # ts_ms and its index, on a database filtered before they existed
     cursor = conn.cursor()
 
     # Pull data from your wifi_filtered_rssi table:
-    cursor.execute("""
-        SELECT device_name, mac, ap_id, timestamp, filtered_rssi
-        FROM wifi_filtered_rssi
-        ORDER BY timestamp ASC
-    """)
+    if since is None:
+        cursor.execute(FILTERED_ROWS_SQL)
+    else:
+        cursor.execute(FILTERED_ROWS_SINCE_SQL, (since,))
     raw_data = cursor.fetchall()
     conn.close()
 
-    # Group by device_name => { "M5StickCPlus-KeeShen": [(datetime, ap_id, rssi), ...], ... }
-    grouped = {}
-    for device_name, mac, ap_id, ts, rssi in raw_data:
-        # If timestamps are "YYYY-MM-DD HH:MM:SS":
-        ts_dt = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
-        grouped.setdefault(device_name, []).append((ts_dt, ap_id, rssi))
-
-    # Bucket into ±2s windows => {device_name: {timestamp: {ap_id: rssi, ...}}, ...}
-    windowed_data = {}
-    for device_name, readings in grouped.items():
-        used = set()
-        # Sort by datetime
-        readings.sort(key=lambda x: x[0])
-
-        for i, (ts_i, ap_i, rssi_i) in enumerate(readings):
-            if i in used:
-                continue
-
-            # Start a window from this reading
-            window = {ap_i: rssi_i}
-            timestamps = [ts_i]
-
-            # Collect subsequent readings if within 2s
-            for j in range(i + 1, len(readings)):
-                ts_j, ap_j, rssi_j = readings[j]
-                if abs((ts_j - ts_i).total_seconds()) <= 2:
-                    window[ap_j] = rssi_j
-                    timestamps.append(ts_j)
-                    used.add(j)
-
-            # Keep only if == 3 APs in this time window
-            if len(window) == 3:
-                # Calculate a "midpoint" timestamp
-                min_t, max_t = min(timestamps), max(timestamps)
-                mid_ts = min_t + (max_t - min_t) / 2
-                ts_str = mid_ts.strftime("%Y-%m-%d %H:%M:%S")
-
-                if device_name not in windowed_data:
-                    windowed_data[device_name] = {}
-                windowed_data[device_name][ts_str] = window
-
-    return windowed_data
+    windows = resample_windows([(device_name, ap_id, ts_ms, rssi) for device_name, _, ap_id, ts_ms, rssi in raw_data],
+                               window_ms)
+    return windows, build_mac_index(raw_data)
+
+
+def build_mac_index(raw_data):
+    """{device_name: (ts_ms array, MACs)} of the filtered readings, sorted by time then MAC."""
+    readings = {}
+    for device_name, mac, _, ts_ms, _ in raw_data:
+        readings.setdefault(device_name, []).append((ts_ms, mac))
+    index = {}
+    for device_name, rows in readings.items():
+        rows.sort()
+        index[device_name] = (np.array([ts_ms for ts_ms, _ in rows], dtype=np.int64), [mac for _, mac in rows])
+    return index
+
+
+def find_macs(mac_index, device_names, window_ts, window_ms=WINDOW_MS):
+    """
+    MAC of each window: that of the device's reading closest in time, the
+    earlier one on a tie, within window_ms (else None). A binary search per
+    window in the index of build_mac_index(), instead of a query.
+    """
+    macs = [None] * len(window_ts)
+    window_ts = np.asarray(window_ts, dtype=np.int64)
+    device_names = np.asarray(device_names, dtype=object)
+    for device_name in set(device_names) & set(mac_index):
+        times, device_macs = mac_index[device_name]
+        windows = np.flatnonzero(device_names == device_name)
+        t = window_ts[windows]
+        after = np.searchsorted(times, t, side="right")  # First reading later than t
+        before = np.maximum(after - 1, 0)
+        later = np.minimum(after, len(times) - 1)
+        gap_before = np.where(after > 0, t - times[before], np.iinfo(np.int64).max)
+        gap_after = np.where(after < len(times), times[later] - t, np.iinfo(np.int64).max)
+        # The first reading at the chosen time (the old query returned them in time order)
+        chosen = np.where(gap_before <= gap_after, np.searchsorted(times, times[before], side="left"), later)
+        for window, reading, gap in zip(windows, chosen, np.minimum(gap_before, gap_after)):
+            if gap <= window_ms:
+                macs[window] = device_macs[reading]
+    return macs
 
 
 # 4) Trilateration methods
-def improved_trilateration(ap_positions, distances):
-    """Nonlinear least-squares solution."""
-    points = np.array(ap_positions)
-    dists = np.array(distances)
-    # Weight shorter distances more heavily
-    weights = 1.0 / (dists + 0.1)
+def improved_trilateration(ap_points, distances):
+    """Nonlinear least-squares solution of every window at once: (K positions, converged)."""
+    points = np.asarray(ap_points, dtype=float)
+    # Weight shorter distances more heavily (common/trilateration.py)
+    initial = np.mean(points, axis=1)
+    return solve_positions(points, distances, initial, loss='linear')
 
-    def residuals(point):
-        return weights * (np.linalg.norm(points - point, axis=1) - dists)
 
-    try:
-        initial = np.mean(points, axis=0)
-        result = least_squares(residuals, initial, method='trf')
-        return result.x if result.success else (None, None)
-    except:
-        return (None, None)
-
-
-def weighted_trilateration(ap_positions, distances):
-    """Linear, weighted approach."""
-    A, b, weights = [], [], []
-    for i in range(1, len(ap_positions)):
-        x0, y0 = ap_positions[0]
-        xi, yi = ap_positions[i]
-        di_sq = distances[i]**2 - distances[0]**2
-        A.append([2*(xi - x0), 2*(yi - y0)])
-        b.append(di_sq - (xi**2 + yi**2 - x0**2 - y0**2))
-        weights.append(1 / (distances[i] + 1e-6))
+def weighted_trilateration(ap_points, distances):
+    """Linear, weighted approach for a batch; collinear AP subsets come back unsolved."""
+    return linear_positions(ap_points, distances)  # Cached AP-subset geometry (common/trilateration.py)
 
-    try:
-        A, b, W = np.array(A), np.array(b), np.diag(weights)
-        x = np.linalg.inv(A.T @ W @ A) @ A.T @ W @ b
-        return x
-    except:
-        return (None, None)
+
+# 5) Fingerprinting (common/fingerprint.py)
+def build_fingerprints(window_ms=WINDOW_MS):
+    """Radio map from the windows of the surveyed devices in ground_truth_positions."""
+    (device_names, _, rssi, aps), _ = fetch_grouped_rssi(window_ms)
+    conn = sqlite3.connect(DATABASE)
+    surveyed = reference_points(conn)
+    samples = [(ap_rssi_dict, *surveyed[device_name])
+               for device_name, ap_rssi_dict in zip(device_names, window_dicts(rssi, aps)) if device_name in surveyed]
+    fingerprints = build_radio_map(conn, samples)
+    conn.close()
+    print(f"Radio map: {fingerprints} fingerprints from {len(samples)} windows of {len(surveyed)} surveyed devices.")
+    return fingerprints
 
 
-# 5) Estimating positions
-def estimate_positions():
-    windowed = fetch_grouped_rssi()
+def fingerprint_positions(window_rssi):
+    """Weighted k-NN lookup of a batch of windows in the radio map."""
+    conn = sqlite3.connect(DATABASE)
+    radio_map = RadioMap.load(conn)
+    conn.close()
+    if not len(radio_map):
+        raise RuntimeError("No radio map; run with --build-radio-map first")
+    return radio_map.locate(window_rssi)
+
+
+def grid_positions(rssi, aps, cell=GRID_CELL):
+    """Grid-likelihood fixes of K x APs windows: every cell of FLOOR_BOUNDS scored at once (common/grid_solver.py)."""
+    columns = [column for column, ap in enumerate(aps) if ap in AP_COORDINATES]
+    solver = GridSolver([AP_COORDINATES[aps[column]] for column in columns], PATH_LOSS_A, PATH_LOSS_N,
+                        bounds=FLOOR_BOUNDS, cell=cell)
+    return solver.locate(rssi[:, columns])
+
+
+# 6) Estimating positions (method: 'trilateration', 'fingerprint' or 'grid'); incremental:
+#    only the windows from the trailing one of every device on (common/estimator_state.py).
+#    Returns the positions and the newest ts_ms read of every device
+def estimate_positions(method="trilateration", grid_cell=GRID_CELL, window_ms=WINDOW_MS, incremental=False):
+    watermarks = {}
+    if incremental:
+        conn = sqlite3.connect(DATABASE)
+        watermarks = load_estimator_watermarks(conn, ESTIMATOR_NAME, window_ms)
+        conn.close()
+    (device_names, window_ts, rssi, aps), mac_index = fetch_grouped_rssi(window_ms, read_since(watermarks, window_ms))
+    latest = {device_name: int(times[-1]) for device_name, (times, _) in mac_index.items()}
     estimated = {}
 
-    for device_name, time_groups in windowed.items():
-        for ts_str, ap_rssi_dict in time_groups.items():
-            ap_positions, distances = [], []
-            for ap_id, rssi in ap_rssi_dict.items():
-                if ap_id in AP_COORDINATES:
-                    ap_positions.append(AP_COORDINATES[ap_id])
-                    dist = rssi_to_distance(rssi)
-                    distances.append(dist)
-
-            if len(ap_positions) == 3:
-                result = improved_trilateration(ap_positions, distances)
-                if result is None or len(result) != 2:
-                    result = weighted_trilateration(ap_positions, distances)
-
-                if result is not None and len(result) == 2:
-                    x, y = float(result[0]), float(result[1])
-                    mac = find_mac_for_device_at_time(device_name, ts_str)
-                    if mac:
-                        estimated[(device_name, mac, ts_str)] = (x, y)
-                        # print(f"{device_name} ({mac}) @ {ts_str}: X={x:.2f}, Y={y:.2f}")
-                    else:
-                        print(f"No MAC found for {device_name} @ {ts_str}")
-                else:
-                    print(f"Trilateration failed for {device_name} @ {ts_str}")
-
-    return estimated
-
-
-# 6) Store results
-def store_positions(positions):
+    # Windows with three known APs (not yet closed at the watermarks), solved in one batch
+    rows, columns = known_windows(rssi, aps, AP_COORDINATES)
+    reopened = reopened_windows(device_names[rows], window_ts[rows], window_ms, watermarks)
+    rows, columns = rows[reopened], columns[reopened]
+    if not len(rows):
+        return estimated, latest
+    coordinates = np.array([AP_COORDINATES.get(ap, (np.nan, np.nan)) for ap in aps], dtype=float).reshape(-1, 2)
+    ap_points = coordinates[columns]
+    window_distances = rssi_to_distance(rssi[rows[:, None], columns])
+    windows = [(device_name, ms_to_isoformat(ts_ms), int(ts_ms)) for device_name, ts_ms in zip(device_names[rows], window_ts[rows])]
+    window_macs = find_macs(mac_index, device_names[rows], window_ts[rows], window_ms)
+
+    if method == "fingerprint":
+        positions, solved = fingerprint_positions(window_dicts(rssi[rows], aps))
+        methods = ["fingerprint"] * len(windows)
+    elif method == "grid":
+        positions, solved = grid_positions(rssi[rows], aps, grid_cell)
+        methods = ["grid"] * len(windows)
+    else:
+        positions, converged = improved_trilateration(ap_points, window_distances)
+        solved = converged.copy()
+        fallback = np.flatnonzero(~converged)
+        if len(fallback):
+            positions[fallback], solved[fallback] = weighted_trilateration(ap_points[fallback], window_distances[fallback])
+        methods = ["trilateration" if ok else "weighted_fallback" for ok in converged]
+
+    for (device_name, ts_str, ts_ms), mac, result, ok, window_method in zip(windows, window_macs, positions, solved, methods):
+        if ok:
+            x, y = float(result[0]), float(result[1])
+            if mac:
+                estimated[(device_name, mac, ts_str)] = (x, y, ts_ms, window_method)
+                # print(f"{device_name} ({mac}) @ {ts_str}: X={x:.2f}, Y={y:.2f}")
+            else:
+                print(f"No MAC found for {device_name} @ {ts_str}")
+        else:
+            print(f"Trilateration failed for {device_name} @ {ts_str}")
+
+    return estimated, latest
+
+
+def has_window_key(conn):
+    """
+    Whether wifi_estimated_positions is missing or has the UNIQUE(mac, timestamp,
+    device_name) of the upserts; older tables lack it, or drop devices sharing a MAC.
+    """
+    indexes = conn.execute("PRAGMA index_list(wifi_estimated_positions)").fetchall()
+    if not indexes and not conn.execute("PRAGMA table_info(wifi_estimated_positions)").fetchall():
+        return True
+    return any(index[2] and [row[2] for row in conn.execute(f"PRAGMA index_info({index[1]})")]
+               == ["mac", "timestamp", "device_name"] for index in indexes)
+
+
+# 7) Store results: one batch of upserts, committed with the watermarks of the readings they came from;
+#    replace=True (full run) swaps them in for the stored table once all are written
+def store_positions(positions, latest=None, window_ms=WINDOW_MS, replace=False):
     if not positions:
         print("No new positions to store.")
-        return
 
     conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    for (device_name, mac, ts_str), (x, y) in positions.items():
-        cursor.execute("""
-            INSERT OR IGNORE INTO wifi_estimated_positions (mac, x, y, timestamp, device_name)
-            VALUES (?, ?, ?, ?, ?)
-        """, (mac, x, y, ts_str, device_name))
-        # print(f"→ Stored: {device_name} ({mac}) @ {ts_str} => X={x:.2f}, Y={y:.2f}")
-
-    conn.commit()
+    if not replace and not has_window_key(conn):
+        conn.close()
+        raise RuntimeError("wifi_estimated_positions has an older key; run once without --incremental to rebuild it")
+    store_estimates(conn, ESTIMATOR_NAME, "wifi_estimated_positions", POSITION_TABLE_SCHEMA, UPSERT_POSITION_SQL,
+                    [(mac, x, y, ts_str, device_name, ts_ms, method)
+                     for (device_name, mac, ts_str), (x, y, ts_ms, method) in positions.items()],
+                    latest or {}, window_ms, replace)
     conn.close()
     # print(f"{len(positions)} new positions stored.")
 
-def find_mac_for_device_at_time(device_name, timestamp_str):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT mac FROM wifi_filtered_rssi
-        WHERE device_name = ?
-        AND ABS(strftime('%s', timestamp) - strftime('%s', ?)) <= 2
-        ORDER BY ABS(strftime('%s', timestamp) - strftime('%s', ?)) ASC
-        LIMIT 1
-    """, (device_name, timestamp_str, timestamp_str))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
-
-# 7) Main
+# 8) Main
 if __name__ == "__main__":
-    create_position_table()
+    parser = argparse.ArgumentParser(description="Estimate WiFi device positions from the filtered RSSI.")
+    parser.add_argument("--method", choices=["trilateration", "fingerprint", "grid"], default="trilateration",
+                        help="Log-distance trilateration, weighted k-NN in the radio map, or grid likelihood")
+    parser.add_argument("--grid-cell", type=float, default=GRID_CELL, help="Cell edge (m) of --method grid")
+    parser.add_argument("--window", type=float, default=WINDOW_MS / 1000, help="Width (s) of the windows readings are grouped in")
+    parser.add_argument("--build-radio-map", action="store_true",
+                        help="Build the radio map from the surveyed devices (ground_truth_positions) and exit")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only solve the windows after the last run's watermarks, keeping the stored positions")
+    args = parser.parse_args()
+    window_ms = int(round(args.window * 1000))
+
+    if args.build_radio_map:
+        build_fingerprints(window_ms)
+        raise SystemExit
     print("==== Estimating Positions ====")
     try:
-        results = estimate_positions()
-        store_positions(results)
+        results, latest = estimate_positions(args.method, args.grid_cell, window_ms, args.incremental)
+        store_positions(results, latest, window_ms, replace=not args.incremental)
         print("==== Done ====")
     except Exception as ex:
         print("Error:", ex)
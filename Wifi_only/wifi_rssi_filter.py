@@ -2,16 +2,29 @@ import sqlite3
 import numpy as np
 import time
 import os
+import sys
+import argparse
 
 # Database path
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE = os.path.join(BASE_DIR, "../Wifi_only/positioning.db")
 
-# Kalman Filter for RSSI Smoothing
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from run_storage import current_run_id, ensure_run_partitioning
+import shards
+from migrations import migrate
+from filter_state import ensure_filter_state, fetch_new_rows, load_watermarks, reset_filter_state, save_filter_state
+from kalman_bank import KalmanBank
+from kalman_store import KalmanStateStore
+from parallel_filter import (DEFAULT_CHUNK_SIZE, RANGES_PER_WORKER, fetch_chunks, key_ranges, open_writer,
+                             run_partitioned)
+from epoch_time import ensure_epoch_columns
+
+# Kalman Filter for RSSI Smoothing (one reading at a time; batches go through KalmanBank)
 class KalmanFilter:
-    def __init__(self, process_variance=1e-3, measurement_variance=2.0):
-        self.x = -70  # Initial state estimate (RSSI starting point)
-        self.P = 1.0   # Initial estimate uncertainty
+    def __init__(self, process_variance=1e-3, measurement_variance=2.0, x=-70, P=1.0):
+        self.x = x  # Initial state estimate (RSSI starting point)
+        self.P = P   # Initial estimate uncertainty
         self.Q = process_variance  # Process variance
         self.R = measurement_variance  # Measurement variance
     
@@ -25,11 +38,51 @@ class KalmanFilter:
         self.P *= (1 - K)
         return self.x
 
-# Initialize Kalman Filters for each beacon
-kalman_filters = {}
+# Kalman filters of every beacon, keyed by MAC, stepped a whole batch at a time
+kalman_bank = KalmanBank()
+
+# Incremental mode keeps its Kalman state and raw-id watermark under this name
+FILTER_NAME = "wifi_filtered_rssi"
+
+# Raw rows of one run that have no filtered row yet, oldest first as the Kalman filters
+# step through them (index plans: tests/test_query_plans.py)
+UNFILTERED_ROWS_SQL = """
+    SELECT r.id, r.timestamp, r.ap_id, r.mac, r.device_name, r.rssi, r.ts_ms
+    FROM wifi_rssi r
+    LEFT JOIN wifi_filtered_rssi f 
+        ON r.timestamp = f.timestamp 
+        AND r.ap_id = f.ap_id 
+        AND r.mac = f.mac 
+        AND r.device_name = f.device_name
+    WHERE r.run_id = ? AND f.id IS NULL
+    ORDER BY r.timestamp ASC, r.id ASC
+"""
+
+INSERT_FILTERED_SQL = """
+    INSERT OR IGNORE INTO wifi_filtered_rssi (timestamp, ap_id, mac, device_name, filtered_rssi, ts_ms)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# The same rows for the MACs first..last only, for the parallel backfill: each
+# MAC's rows still come in the order above, read along its (run_id, mac) index
+UNFILTERED_RANGE_SQL = """
+    SELECT r.id, r.timestamp, r.ap_id, r.mac, r.device_name, r.rssi, r.ts_ms
+    FROM wifi_rssi r
+    LEFT JOIN wifi_filtered_rssi f 
+        ON r.timestamp = f.timestamp 
+        AND r.ap_id = f.ap_id 
+        AND r.mac = f.mac 
+        AND r.device_name = f.device_name
+    WHERE r.run_id = ? AND f.id IS NULL AND r.mac BETWEEN ? AND ?
+    ORDER BY r.mac ASC, r.timestamp ASC, r.id ASC
+"""
+
+# Raw rows per MAC of one run, to split the parallel backfill into even MAC ranges
+MAC_COUNTS_SQL = "SELECT mac, COUNT(*) FROM wifi_rssi WHERE run_id = ? AND mac IS NOT NULL GROUP BY mac ORDER BY mac"
 
 # Creating necessary tables
-def create_tables():
+def create_tables(reset=True):
+    """reset=True rebuilds the filtered table (full run); incremental runs keep it."""
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
     
@@ -44,32 +97,33 @@ def create_tables():
             rssi REAL
         )
     """)
+    ensure_run_partitioning(conn, ["wifi_rssi"])
+    ensure_epoch_columns(conn, ["wifi_rssi"])
 
-    # Drop and recreate wifi_filtered_rssi table
-    cursor.execute("DROP TABLE IF EXISTS wifi_filtered_rssi")
+    ensure_filter_state(conn)
+    if reset:
+        # Drop and recreate wifi_filtered_rssi table, and forget the incremental state with it
+        cursor.execute("DROP TABLE IF EXISTS wifi_filtered_rssi")
+        reset_filter_state(conn, FILTER_NAME)
     
     # Create filtered_rssi table if it doesn't exist
     cursor.execute("""
-        CREATE TABLE wifi_filtered_rssi (
+        CREATE TABLE IF NOT EXISTS wifi_filtered_rssi (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             timestamp DATETIME,
             ap_id TEXT,
             mac TEXT,
             device_name TEXT,
             filtered_rssi REAL,
+            ts_ms INTEGER,
             UNIQUE(timestamp, ap_id, mac)
         )
     """)
     
+    migrate(conn, ["wifi_filtered_rssi"])  # Indexes for the anti-join and the estimator reads
     conn.commit()
     conn.close()
 
-def kalman_filter_rssi(mac, rssi):
-    """Apply Kalman filter to smooth RSSI values for a specific MAC address"""
-    if mac not in kalman_filters:
-        kalman_filters[mac] = KalmanFilter()
-    return kalman_filters[mac].update(rssi)
-
 # RSSI to Distance Conversion using Log-Distance Path Loss Model
 def rssi_to_distance(rssi, A=-55.525, n=0.73529100890785):
     """
@@ -119,22 +173,14 @@ def calibrate_rssi_model(known_distance_measurements):
         return -59, 3.0  # Default values
 
 # Fetch Latest Raw RSSI Values
-def fetch_raw_rssi():
-    conn = sqlite3.connect(DATABASE)
+def fetch_raw_rssi(run_id=None):
+    conn = shards.connect(DATABASE)  # Reads across shard files when ingestion is sharded
     cursor = conn.cursor()
+    if run_id is None:
+        run_id = current_run_id(conn)
     
-    # Get only entries we haven't processed yet
-    cursor.execute("""
-        SELECT r.id, r.timestamp, r.ap_id, r.mac, r.device_name, r.rssi 
-        FROM wifi_rssi r
-        LEFT JOIN wifi_filtered_rssi f 
-            ON r.timestamp = f.timestamp 
-            AND r.ap_id = f.ap_id 
-            AND r.mac = f.mac 
-            AND r.device_name = f.device_name
-        WHERE f.id IS NULL
-        ORDER BY r.timestamp DESC
-    """)
+    # Get only entries of this run we haven't processed yet
+    cursor.execute(UNFILTERED_ROWS_SQL, (run_id,))
     
     data = cursor.fetchall()
     conn.close()
@@ -148,10 +194,7 @@ def batch_store_filtered_rssi(filtered_data):
     conn = sqlite3.connect(DATABASE)
     
     # Use executemany for batch inserts
-    conn.executemany("""
-        INSERT OR IGNORE INTO wifi_filtered_rssi (timestamp, ap_id, mac, device_name, filtered_rssi)
-        VALUES (?, ?, ?, ?, ?)
-    """, filtered_data)
+    conn.executemany(INSERT_FILTERED_SQL, filtered_data)
     
     rows_affected = conn.total_changes
     conn.commit()
@@ -159,25 +202,130 @@ def batch_store_filtered_rssi(filtered_data):
     
     return rows_affected
 
+# Kalman-filter raw rows (as UNFILTERED_ROWS_SQL returns them) into filtered-table rows
+def filter_rows(raw_data, bank):
+    # Same readings per MAC, in the same order, as one KalmanFilter.update() per row
+    filtered = bank.update([entry[3] for entry in raw_data], [entry[5] for entry in raw_data])
+    filtered_data = []
+    for entry, filtered_rssi in zip(raw_data, filtered.tolist()):
+        rssi_id, timestamp, ap_id, mac, device_name, rssi, ts_ms = entry
+        filtered_data.append((timestamp, ap_id, mac, device_name, filtered_rssi, ts_ms))
+    return filtered_data
+
 # Process RSSI Filtering
-def process_rssi():
-    raw_data = fetch_raw_rssi()
+def process_rssi(run_id=None):
+    raw_data = fetch_raw_rssi(run_id)
     if not raw_data:
         print("No new RSSI data to filter.")
         return 0
     
-    filtered_data = []
-    for entry in raw_data:
-        rssi_id, timestamp, ap_id, mac, device_name, rssi = entry
-        filtered_rssi = kalman_filter_rssi(mac, rssi)
-        filtered_data.append((timestamp, ap_id, mac, device_name, filtered_rssi))
+    filtered_data = filter_rows(raw_data, kalman_bank)
     
     rows_stored = batch_store_filtered_rssi(filtered_data)
     return rows_stored
 
+# Parallel backfill worker: the filtered rows of the MACs first_mac..last_mac
+def filter_mac_range(database, run_id, chunk_size, first_mac, last_mac):
+    conn = shards.connect(database)  # Read-only here; the parent process does the inserts
+    cursor = conn.execute(UNFILTERED_RANGE_SQL, (run_id, first_mac, last_mac))
+    bank = KalmanBank()  # Every MAC starts from x = -70, as in a full run
+    filtered_data = []
+    for raw_data in fetch_chunks(cursor, chunk_size):
+        filtered_data += filter_rows(raw_data, bank)  # The bank carries each MAC over to the next chunk
+    conn.close()
+    return filtered_data
+
+# Parallel RSSI Filtering
+def process_rssi_parallel(run_id=None, workers=4, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Full run of process_rssi() for large backfills: the MACs are split into
+    ranges of about equal row counts, filtered by `workers` processes, and
+    every filtered row is inserted here through one connection.
+    """
+    conn = sqlite3.connect(DATABASE)
+    migrate(conn, ["wifi_rssi"], ["idx_wifi_rssi_run_mac"])  # Each range task reads its MACs only
+    conn.close()
+    conn = shards.connect(DATABASE)
+    if run_id is None:
+        run_id = current_run_id(conn)
+    mac_counts = conn.execute(MAC_COUNTS_SQL, (run_id,)).fetchall()
+    conn.close()
+    ranges = key_ranges(mac_counts, workers * RANGES_PER_WORKER)
+    if not ranges:
+        print("No new RSSI data to filter.")
+        return 0
+
+    writer = open_writer(DATABASE)
+
+    def write(filtered_data):
+        changes_before = writer.total_changes
+        writer.executemany(INSERT_FILTERED_SQL, filtered_data)
+        writer.commit()
+        return writer.total_changes - changes_before
+
+    try:
+        return run_partitioned(filter_mac_range, (DATABASE, run_id, chunk_size), ranges, workers, write)
+    finally:
+        writer.close()
+
+# Incremental RSSI Filtering
+def process_rssi_incremental():
+    """
+    Filter only the raw rows added since the last incremental run (every run),
+    oldest first, continuing each Kalman filter from its stored state.
+    """
+    conn = shards.connect(DATABASE)  # Reads across shard files when ingestion is sharded
+    ensure_filter_state(conn)
+    columns = ["timestamp", "ap_id", "mac", "device_name", "rssi", "ts_ms"]
+    raw_data, watermarks = fetch_new_rows(conn, "wifi_rssi", columns, load_watermarks(conn, FILTER_NAME))
+    if not raw_data:
+        print("No new RSSI data to filter.")
+        conn.close()
+        return 0
+
+    bank = KalmanStateStore(conn, FILTER_NAME)  # Loads the stored state of only the MACs in these rows
+    filtered = bank.update([entry[3] for entry in raw_data], [entry[5] for entry in raw_data])
+    last_rows = {}
+    filtered_data = []
+    for entry, filtered_rssi in zip(raw_data, filtered.tolist()):
+        rssi_id, timestamp, ap_id, mac, device_name, rssi, ts_ms = entry
+        last_rows[mac] = (rssi_id, timestamp)
+        filtered_data.append((timestamp, ap_id, mac, device_name, filtered_rssi, ts_ms))
+
+    # Filtered rows, Kalman state and watermarks go in together
+    states = {key: bank.state(key) + (last_id, last_timestamp) for key, (last_id, last_timestamp) in last_rows.items()}
+    changes_before = conn.total_changes
+    conn.executemany(INSERT_FILTERED_SQL, filtered_data)
+    rows_stored = conn.total_changes - changes_before
+    save_filter_state(conn, FILTER_NAME, states, watermarks)
+    conn.commit()
+    conn.close()
+    return rows_stored
+
 if __name__ == "__main__":
-    create_tables()                   # Create the tables if they don't exist
-    rows_stored = process_rssi()     # Fetch & filter new RSSI data
+    parser = argparse.ArgumentParser(description="Kalman-filter the raw WiFi RSSI of one run.")
+    parser.add_argument("--run", type=int, default=None, help="Run id to filter (default: latest run)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only filter raw rows added since the last incremental run, keeping the Kalman state")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Filter a full run in this many processes, split by MAC (default: in this process)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Raw rows each worker reads at a time")
+    args = parser.parse_args()
+    if args.incremental and args.run is not None:
+        parser.error("--incremental filters new rows of every run; it cannot be combined with --run")
+    if args.incremental and args.workers:
+        parser.error("--workers is for full runs; it cannot be combined with --incremental")
+
+    if args.incremental:
+        create_tables(reset=False)
+        rows_stored = process_rssi_incremental()  # Only rows above the watermark
+    else:
+        create_tables()                   # Create the tables if they don't exist
+        if args.workers:
+            rows_stored = process_rssi_parallel(args.run, args.workers, args.chunk_size)
+        else:
+            rows_stored = process_rssi(args.run)     # Fetch & filter new RSSI data
     print(f"Rows stored: {rows_stored}")
 
 
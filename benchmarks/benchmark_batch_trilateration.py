@@ -0,0 +1,140 @@
+# Trilateration of every window: the per-window scipy.optimize.least_squares
+# calls the estimators used to make vs one solve_positions() batch
+# (common/trilateration.py). The windows are those of the shipped BLE, WiFi and
+# hybrid recordings, repeated --scale times to stand in for a long replay.
+# scipy only runs on the first --scipy-windows windows (its time per window is
+# extrapolated to the rest), and both fixes are compared on those.
+#
+# python benchmark_batch_trilateration.py
+# python benchmark_batch_trilateration.py --scale 1000 --scipy-windows 5000
+
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+from scipy.optimize import least_squares
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from migrations import migrate
+from trilateration import solve_positions
+from windowing import window_dicts
+
+# Solver settings of each estimator: (loss, bounds, starting point)
+ESTIMATORS = {
+    "BLE": ("soft_l1", None, "mean"),
+    "WiFi": ("linear", None, "mean"),
+    "hybrid": ("soft_l1", ([0, 0], [4.96, 8.06]), "median"),
+}
+
+
+def least_squares_fix(points, distances, loss, bounds, start):
+    """One window, the way the estimators solved it before solve_positions()."""
+    weights = 1.0 / (distances + 0.1)
+
+    def residuals(point):
+        return weights * (np.linalg.norm(points - point, axis=1) - distances)
+
+    x0 = np.mean(points, axis=0) if start == "mean" else np.median(points, axis=0)
+    if bounds is None:
+        return least_squares(residuals, x0=x0, loss=loss).x
+    return least_squares(residuals, x0=x0, bounds=bounds, loss=loss, max_nfev=200).x
+
+
+def windows_of(directory, filter_module, module, collect):
+    """
+    (K x 3 x 2 AP positions, K x 3 distances) of the recording in `directory`,
+    filtered again and read from a copy.
+    """
+    workdir = tempfile.mkdtemp(prefix="batch_trilateration_")
+    try:
+        sys.path.insert(0, os.path.join(BASE_DIR, "..", directory))
+        rssi_filter = __import__(filter_module)
+        estimator = __import__(module)
+        database = shutil.copy(os.path.join(BASE_DIR, "..", directory, "positioning.db"), workdir)
+        rssi_filter.DATABASE = estimator.DATABASE = database
+        if hasattr(rssi_filter, "merge_and_filter_rssi"):
+            rssi_filter.merge_and_filter_rssi()  # Rebuilds hybrid_filtered_rssi
+        else:
+            rssi_filter.create_tables()
+            rssi_filter.process_rssi()
+        conn = sqlite3.connect(database)
+        migrate(conn)  # ts_ms of the tables the filter does not rebuild
+        conn.close()
+        ap_points, distances = [], []
+        for ap_rssi, coordinates in collect(estimator):
+            known = [(coordinates[ap], estimator.rssi_to_distance(rssi)) for ap, rssi in ap_rssi.items() if ap in coordinates]
+            if len(known) == 3:
+                ap_points.append([position for position, _ in known])
+                distances.append([distance for _, distance in known])
+        return np.array(ap_points, dtype=float), np.array(distances, dtype=float)
+    finally:
+        sys.path.pop(0)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def ble_windows(estimator):
+    (_, _, rssi, aps), _, _ = estimator.fetch_grouped_rssi()
+    return [(ap_rssi, estimator.AP_COORDINATES) for ap_rssi in window_dicts(rssi, aps)]
+
+
+def wifi_windows(estimator):
+    (_, _, rssi, aps), _ = estimator.fetch_grouped_rssi()
+    return [(ap_rssi, estimator.AP_COORDINATES) for ap_rssi in window_dicts(rssi, aps)]
+
+
+def hybrid_windows(estimator):
+    conn = sqlite3.connect(estimator.DATABASE)
+    coordinates = {key: estimator.AP_COORDINATES[name] for key, name in estimator.ap_names(conn).items()
+                   if name in estimator.AP_COORDINATES}
+    devices = [row[0] for row in conn.execute("SELECT DISTINCT device_key FROM hybrid_filtered_rssi")]
+    conn.close()
+    (_, _, rssi, ap_keys), _ = estimator.fetch_grouped_rssi(devices)
+    return [(ap_rssi, coordinates) for ap_rssi in window_dicts(rssi, ap_keys)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-window least_squares and batch trilateration.")
+    parser.add_argument("--scale", type=int, default=100, help="Times the recorded windows are repeated")
+    parser.add_argument("--scipy-windows", type=int, default=2000, help="Windows solved with least_squares")
+    args = parser.parse_args()
+
+    recordings = {
+        "BLE": windows_of("BLE_only", "rssi_filter", "position_estimator", ble_windows),
+        "WiFi": windows_of("Wifi_only", "wifi_rssi_filter", "wifi_position_estimator", wifi_windows),
+        "hybrid": windows_of("BLE+Wifi", "hybrid_rssi_filter", "hybrid_position_estimator", hybrid_windows),
+    }
+
+    print(f"{'estimator':<10}{'windows':>10}{'scipy s':>10}{'batch s':>10}{'speed-up':>10}{'max diff m':>12}{'> 1 cm':>8}")
+    for name, (ap_points, distances) in recordings.items():
+        loss, bounds, start = ESTIMATORS[name]
+        ap_points = np.tile(ap_points, (args.scale, 1, 1))
+        distances = np.tile(distances, (args.scale, 1))
+        count = len(distances)
+
+        checked = min(count, args.scipy_windows)
+        begin = time.perf_counter()
+        reference = np.array([least_squares_fix(ap_points[k], distances[k], loss, bounds, start) for k in range(checked)])
+        scipy_seconds = (time.perf_counter() - begin) * count / checked
+
+        begin = time.perf_counter()
+        x0 = np.mean(ap_points, axis=1) if start == "mean" else np.median(ap_points, axis=1)
+        positions, converged = solve_positions(ap_points, distances, x0, loss=loss, bounds=bounds,
+                                               max_iterations=200)
+        batch_seconds = time.perf_counter() - begin
+
+        differences = np.linalg.norm(positions[:checked] - reference, axis=1)
+        print(f"{name:<10}{count:>10}{scipy_seconds:>10.1f}{batch_seconds:>10.2f}{scipy_seconds / batch_seconds:>10.0f}"
+              f"{differences.max():>12.4f}{int(np.sum(differences > 0.01)):>8}")
+        stalled = np.linalg.norm(reference - x0[:checked], axis=1) < 1e-6
+        if np.any(stalled & (differences > 0.01)):
+            print(f"  {int(np.sum(stalled & (differences > 0.01)))} of those: least_squares never left its "
+                  f"starting point (an AP, where the range has no gradient)")
+        if not converged.all():
+            print(f"  {int(np.sum(~converged))} windows did not converge, not even with least_squares "
+                  f"(linear fallback in the estimator)")
@@ -0,0 +1,97 @@
+# Micro-benchmark: JSON vs compact binary RSSI payloads vs per-scan batches.
+# Reports bytes on the wire and decode time per reading for readings taken
+# from the recorded databases.
+#
+# python benchmark_codec.py
+# python benchmark_codec.py --messages 50000
+
+import argparse
+import calendar
+import os
+import sqlite3
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from rssi_codec import decode_reading, decode_readings, encode_batch, encode_json_reading, encode_reading
+
+SOURCES = [
+    (os.path.join(BASE_DIR, "../BLE_only/positioning.db"), "ble_rssi"),
+    (os.path.join(BASE_DIR, "../Wifi_only/positioning.db"), "wifi_rssi"),
+]
+
+
+def load_readings(limit):
+    readings = []
+    for db_path, table in SOURCES:
+        conn = sqlite3.connect(db_path)
+        rows = conn.execute(f"SELECT timestamp, ap_id, mac, device_name, rssi FROM {table} LIMIT ?", (limit,)).fetchall()
+        conn.close()
+        for ts, ap_id, mac, device_name, rssi in rows:
+            epoch = calendar.timegm(time.strptime(ts, "%Y-%m-%d %H:%M:%S")) + 0.123456
+            readings.append((epoch, ap_id, mac, device_name, rssi))
+    return readings
+
+
+def make_scans(readings, tags_per_scan):
+    """Group readings into per-AP scans of tags_per_scan readings, as a Pi would publish them."""
+    by_ap = {}
+    for epoch, ap_id, mac, device_name, rssi in readings:
+        by_ap.setdefault(ap_id, []).append((epoch, mac, device_name, rssi))
+    payloads = []
+    for ap_id, ap_readings in by_ap.items():
+        for i in range(0, len(ap_readings), tags_per_scan):
+            chunk = ap_readings[i:i + tags_per_scan]
+            payload, rejected = encode_batch(chunk[0][0], ap_id, [(m, d, r) for _, m, d, r in chunk])
+            assert payload is not None and not rejected
+            payloads.append((payload, len(chunk)))
+    return payloads
+
+
+def time_decode(payloads, repeat, decode=decode_reading):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for payload in payloads:
+            decode(payload)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare JSON and binary RSSI payloads.")
+    parser.add_argument("--messages", type=int, default=20000, help="Readings per source database")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    readings = load_readings(args.messages)
+    json_payloads = [encode_json_reading(*r).encode() for r in readings]
+    binary_payloads = [encode_reading(*r) for r in readings]
+    if any(p is None for p in binary_payloads):
+        raise SystemExit("Some recorded readings are not in the binary dictionary")
+
+    # Both formats must decode to the same reading
+    for j, b in zip(json_payloads[:1000], binary_payloads[:1000]):
+        jr, br = decode_reading(j), decode_reading(b)
+        assert jr[2:] == br[2:] and abs(jr[1] - br[1]) < 1e-6, (jr, br)
+
+    n = len(readings)
+    rows = [
+        ("json", sum(len(p) for p in json_payloads) / n, time_decode(json_payloads, args.repeat) / n, 1.0),
+        ("binary", sum(len(p) for p in binary_payloads) / n, time_decode(binary_payloads, args.repeat) / n, 1.0),
+    ]
+    for tags in (5, 100):
+        scans = make_scans(readings, tags)
+        payloads = [p for p, _ in scans]
+        rows.append((
+            f"batch/{tags}",
+            sum(len(p) for p in payloads) / n,
+            time_decode(payloads, args.repeat, decode_readings) / n,
+            n / len(payloads),
+        ))
+
+    print(f"Readings: {n}")
+    print(f"{'format':<10}{'bytes/reading':>15}{'decode us/reading':>20}{'readings/msg':>15}")
+    for name, size, seconds, per_msg in rows:
+        print(f"{name:<10}{size:>15.1f}{seconds * 1e6:>20.2f}{per_msg:>15.1f}")
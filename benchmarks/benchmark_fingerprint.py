@@ -0,0 +1,76 @@
+# Fingerprint lookup on a store-sized radio map: a per-window brute-force scan
+# of every fingerprint vs RadioMap.locate() (common/fingerprint.py), which
+# batch-queries one cKDTree per AP set. The radio map is synthetic: --points
+# surveyed points on a --size floor and --aps APs, with fingerprints and
+# windows from the estimators' log-distance model plus noise. Both lookups
+# must return the same positions.
+#
+# python benchmark_fingerprint.py
+# python benchmark_fingerprint.py --points 20000 --windows 100000 --aps 12
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from fingerprint import DEFAULT_K, RadioMap
+
+# Log-distance model of the estimators
+A, N = -55.525, 0.735
+
+
+def expected_rssi(positions, aps, rng, noise):
+    distances = np.linalg.norm(positions[:, None, :] - aps[None, :, :], axis=2)
+    return A - 10 * N * np.log10(np.maximum(distances, 0.1)) + rng.normal(0, noise, distances.shape)
+
+
+def brute_force(windows, fingerprints, positions, k):
+    """The k nearest fingerprints of every window by a full scan, inverse-distance weighted."""
+    located = np.empty((len(windows), 2))
+    for index, window in enumerate(windows):
+        distances = np.sqrt(np.sum((fingerprints - window) ** 2, axis=1))
+        nearest = np.argsort(distances, kind="stable")[:k]
+        weights = 1.0 / (distances[nearest] + 1e-6)
+        located[index] = weights @ positions[nearest] / weights.sum()
+    return located
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare brute-force and k-d tree fingerprint lookup.")
+    parser.add_argument("--points", type=int, default=10000, help="Surveyed points in the radio map")
+    parser.add_argument("--windows", type=int, default=20000, help="Windows to locate")
+    parser.add_argument("--aps", type=int, default=8)
+    parser.add_argument("--size", type=float, nargs=2, default=[60.0, 40.0], help="Floor size in m")
+    parser.add_argument("--brute-windows", type=int, default=2000, help="Windows located by the full scan")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    size = np.array(args.size)
+    aps = rng.uniform(0, 1, (args.aps, 2)) * size
+    ap_names = [f"AP{i:02d}" for i in range(args.aps)]
+    surveyed = rng.uniform(0, 1, (args.points, 2)) * size
+    fingerprints = expected_rssi(surveyed, aps, rng, noise=1.0)
+    radio_map = RadioMap({",".join(ap_names): [(vector, tuple(point)) for vector, point in zip(fingerprints, surveyed)]})
+
+    truth = rng.uniform(0, 1, (args.windows, 2)) * size
+    observed = expected_rssi(truth, aps, rng, noise=3.0)
+    windows = [dict(zip(ap_names, vector)) for vector in observed.tolist()]
+    print(f"Fingerprints: {len(radio_map)}  APs: {args.aps}  Windows: {args.windows}")
+
+    begin = time.perf_counter()
+    located, found = radio_map.locate(windows, k=DEFAULT_K)
+    tree_seconds = time.perf_counter() - begin
+
+    checked = min(args.windows, args.brute_windows)
+    begin = time.perf_counter()
+    reference = brute_force(observed[:checked], fingerprints, surveyed, DEFAULT_K)
+    brute_seconds = (time.perf_counter() - begin) * args.windows / checked
+
+    difference = np.abs(located[:checked] - reference).max()
+    print(f"brute force: {brute_seconds:.1f} s (extrapolated)   k-d tree batch: {tree_seconds:.2f} s   "
+          f"speed-up: {brute_seconds / tree_seconds:.0f}x")
+    print(f"max difference: {difference:.1e} m   located: {int(found.sum())}")
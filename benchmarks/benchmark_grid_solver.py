@@ -0,0 +1,103 @@
+# Per-fix latency of the hybrid estimator's solvers: scipy.optimize.least_squares
+# per window (what the estimators used to run), the solve_positions() batch
+# (common/trilateration.py) and GridSolver (common/grid_solver.py). Windows are
+# synthetic: a tag anywhere in the 4.96 x 8.06 m room, heard by 3 of its 4 APs
+# with the log-distance model plus --noise dB. One window at a time gives the
+# latency distribution; the whole set at once gives the batch throughput.
+#
+# python benchmark_grid_solver.py
+# python benchmark_grid_solver.py --windows 50000 --noise 4 --cell 0.05
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from scipy.optimize import least_squares
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from grid_solver import GRID_CELL, GridSolver
+from trilateration import solve_positions
+
+# Room, APs and log-distance model of the hybrid estimator
+BOUNDS = ([0, 0], [4.96, 8.06])
+APS = np.array([(4.96, 0), (4.96, 8.06), (0, 8.06), (0, 0)])
+A, N = -55.525, 0.735
+
+
+def rssi_to_distance(rssi):
+    return 10 ** ((A - rssi) / (10 * N))
+
+
+def least_squares_fix(points, distances):
+    """One window, the way robust_trilateration() solved it before solve_positions()."""
+    weights = 1.0 / (distances + 0.1)
+
+    def residuals(point):
+        return weights * (np.linalg.norm(points - point, axis=1) - distances)
+
+    return least_squares(residuals, x0=np.median(points, axis=0), bounds=BOUNDS, loss="soft_l1", max_nfev=200).x
+
+
+def latencies(fix, count):
+    """Seconds per call of fix(k) for the first count windows (after one warm-up call)."""
+    fix(0)
+    seconds = np.empty(count)
+    for k in range(count):
+        begin = time.perf_counter()
+        fix(k)
+        seconds[k] = time.perf_counter() - begin
+    return seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-fix latency of iterative and grid-likelihood solvers.")
+    parser.add_argument("--windows", type=int, default=20000)
+    parser.add_argument("--noise", type=float, default=3.0, help="RSSI noise (dB) of the synthetic windows")
+    parser.add_argument("--cell", type=float, default=GRID_CELL, help="Grid cell edge (m)")
+    parser.add_argument("--latency-windows", type=int, default=2000, help="Windows fixed one at a time")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    truth = rng.uniform(0, 1, (args.windows, 2)) * BOUNDS[1]
+    rssi = A - 10 * N * np.log10(np.maximum(np.linalg.norm(truth[:, None] - APS[None], axis=2), 0.1))
+    rssi += rng.normal(0, args.noise, rssi.shape)
+    rssi[np.arange(args.windows), rng.integers(0, len(APS), args.windows)] = np.nan  # 3 of 4 APs heard
+    heard = np.isfinite(rssi)
+    points = np.array([APS[row] for row in heard])
+    distances = rssi_to_distance(rssi[heard].reshape(args.windows, 3))
+
+    begin = time.perf_counter()
+    solver = GridSolver(APS, A, N, bounds=BOUNDS, cell=args.cell)
+    table_seconds = time.perf_counter() - begin
+    print(f"Windows: {args.windows}  noise: {args.noise} dB  grid: {solver.shape[0]} x {solver.shape[1]} cells "
+          f"(tables built in {table_seconds * 1000:.1f} ms)")
+
+    checked = min(args.windows, args.latency_windows)
+    runs = {
+        "least_squares": latencies(lambda k: least_squares_fix(points[k], distances[k]), checked),
+        "solve_positions": latencies(lambda k: solve_positions(points[k:k + 1], distances[k:k + 1], np.median(
+            points[k:k + 1], axis=1), bounds=BOUNDS, max_iterations=200), checked),
+        "grid": latencies(lambda k: solver.locate(rssi[k:k + 1]), checked),
+    }
+
+    begin = time.perf_counter()
+    batch, converged = solve_positions(points, distances, np.median(points, axis=1), bounds=BOUNDS, max_iterations=200)
+    batch_seconds = time.perf_counter() - begin
+    begin = time.perf_counter()
+    grid, _ = solver.locate(rssi)
+    grid_seconds = time.perf_counter() - begin
+    reference = np.array([least_squares_fix(points[k], distances[k]) for k in range(checked)])
+    fixes = {"least_squares": reference, "solve_positions": batch[:checked], "grid": grid[:checked]}
+    batch_time = {"least_squares": np.sum(runs["least_squares"]) * args.windows / checked,
+                  "solve_positions": batch_seconds, "grid": grid_seconds}
+
+    print(f"{'solver':<17}{'p50 ms':>9}{'p99 ms':>9}{'p99.9 ms':>10}{'batch s':>10}{'error m':>9}")
+    for name, seconds in runs.items():
+        p50, p99, p999 = np.percentile(seconds, [50, 99, 99.9]) * 1000
+        error = np.mean(np.linalg.norm(fixes[name] - truth[:checked], axis=1))
+        print(f"{name:<17}{p50:>9.3f}{p99:>9.3f}{p999:>10.3f}{batch_time[name]:>10.2f}{error:>9.2f}")
+    print(f"solve_positions: {int(np.sum(~converged))} windows did not converge, not even with least_squares "
+          f"(linear fallback in the estimator)")
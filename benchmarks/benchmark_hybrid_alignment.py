@@ -0,0 +1,115 @@
+# BLE/WiFi alignment of the hybrid filter: the per-timestamp scan it used to do
+# (every reading of the key checked against every timestamp, O(n^2) per key)
+# vs align_readings() in BLE+Wifi/hybrid_rssi_filter.py (np.searchsorted over
+# sorted arrays). Runs on the shipped BLE+Wifi/positioning.db and on longer
+# sessions made by replaying it back to back, and checks both give identical
+# output wherever the scan is run.
+#
+# python benchmark_hybrid_alignment.py
+# python benchmark_hybrid_alignment.py --scales 1 10 100 --scan-scales 1 2 4
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "BLE+Wifi"))
+import hybrid_rssi_filter
+from hybrid_rssi_filter import FUSION_WINDOW, align_readings
+
+
+def align_readings_scan(raw_data):
+    """The alignment as merge_and_filter_rssi() did it before align_readings()."""
+    grouped = defaultdict(list)
+    for timestamp, ap_key, device_key, rssi, latency, signal_type, _ in raw_data:
+        ts_dt = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+        grouped[(device_key, ap_key)].append((ts_dt, rssi, latency, signal_type))
+
+    aligned = []
+    for (device_key, ap_key), readings in grouped.items():
+        ble = [(ts, rssi, lat) for ts, rssi, lat, t in readings if t == 'BLE']
+        wifi = [(ts, rssi, lat) for ts, rssi, lat, t in readings if t == 'WiFi']
+        all_timestamps = sorted(set([ts for ts, _, _ in ble] + [ts for ts, _, _ in wifi]))
+        for ts in all_timestamps:
+            nearby_ble = [(rssi, lat) for ts_ble, rssi, lat in ble if abs((ts_ble - ts).total_seconds()) <= FUSION_WINDOW]
+            nearby_wifi = [(rssi, lat) for ts_wifi, rssi, lat in wifi if abs((ts_wifi - ts).total_seconds()) <= FUSION_WINDOW]
+            if nearby_ble and nearby_wifi:
+                avg_ble = np.mean([r for r, _ in nearby_ble])
+                avg_wifi = np.mean([r for r, _ in nearby_wifi])
+                fused_latency = (np.mean([lat for _, lat in nearby_ble]) + np.mean([lat for _, lat in nearby_wifi])) / 2
+                aligned.append((ts.strftime("%Y-%m-%d %H:%M:%S"), ap_key, device_key, avg_ble, avg_wifi, fused_latency))
+    return aligned
+
+
+def load_session():
+    """Raw rows of the latest run, read the way the filter reads them, from a copy of the shipped database."""
+    workdir = tempfile.mkdtemp(prefix="hybrid_alignment_")
+    try:
+        hybrid_rssi_filter.DATABASE = shutil.copy(hybrid_rssi_filter.DATABASE, workdir)
+        hybrid_rssi_filter.create_tables()  # Adds the run / identity columns of older databases
+        return hybrid_rssi_filter.fetch_raw_rssi()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def replay(rows, scale):
+    """The session played `scale` times back to back, one minute apart: a session `scale` times as long."""
+    if scale == 1:
+        return rows
+    parsed = [(datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S"),) + row[1:] for row in rows]
+    period = parsed[-1][0] - parsed[0][0] + timedelta(minutes=1)
+    period_ms = int(period.total_seconds() * 1000)
+    replayed = []
+    for i in range(scale):
+        shift = period * i
+        replayed += [((ts + shift).strftime("%Y-%m-%d %H:%M:%S"),) + tuple(rest) + (ts_ms + period_ms * i,)
+                     for ts, *rest, ts_ms in parsed]
+    return replayed
+
+
+def timed(function, rows):
+    start = time.perf_counter()
+    result = function(rows)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the per-timestamp scan and the sorted alignment of the hybrid filter.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100], help="Session lengths, in shipped sessions")
+    parser.add_argument("--scan-scales", type=int, nargs="+", default=[1, 2, 4],
+                        help="Lengths the O(n^2) scan is actually run at; longer ones are extrapolated from the longest")
+    args = parser.parse_args()
+
+    session = load_session()
+    print(f"Shipped session: {len(session)} readings")
+    print(f"{'scale':>6}{'readings':>10}{'fused':>9}{'scan s':>12}{'sorted s':>10}{'speed-up':>10}")
+
+    scan_timings = {}
+    for scale in sorted(set(args.scales) | set(args.scan_scales)):
+        rows = replay(session, scale)
+        aligned, sorted_seconds = timed(align_readings, rows)
+        if scale in args.scan_scales:
+            expected, scan_seconds = timed(align_readings_scan, rows)
+            # The scan predates ts_ms; compare everything else
+            if [row[:1] + row[2:] for row in aligned] != expected:
+                raise SystemExit(f"align_readings() differs from the scan at scale {scale}")
+            scan_timings[scale] = scan_seconds
+            scan = f"{scan_seconds:.3f}"
+        else:
+            # Per key, the scan does (timestamps x readings) work: quadratic in the session length
+            measured = max(s for s in scan_timings if s <= scale) if scan_timings else None
+            if measured is None:
+                print(f"{scale:>6}{len(rows):>10}{len(aligned):>9}{'-':>12}{sorted_seconds:>10.3f}{'-':>10}")
+                continue
+            scan_seconds = scan_timings[measured] * (scale / measured) ** 2
+            scan = f"~{scan_seconds:.0f}"
+        if scale in args.scales:
+            print(f"{scale:>6}{len(rows):>10}{len(aligned):>9}{scan:>12}{sorted_seconds:>10.3f}{scan_seconds / sorted_seconds:>9.0f}x")
+    print("~ scan time extrapolated from the longest session it ran on")
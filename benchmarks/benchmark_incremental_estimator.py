@@ -0,0 +1,115 @@
+# Periodic BLE position estimation over a growing session: a full run after
+# every --period seconds of readings (solve the whole filtered history into a
+# new estimated_positions, what the estimator always did) vs an --incremental
+# run (common/estimator_state.py: only the windows from each tag's trailing
+# one on, written with batched upserts). The filtered readings are synthetic,
+# in two temporary databases: --tags tags at random spots of the room, heard
+# by its 4 APs every 7 s on whole seconds, the APs staggered by 0, 1, 3 and
+# 4 s. Both must end with the same positions.
+#
+# python benchmark_incremental_estimator.py
+# python benchmark_incremental_estimator.py --tags 200 --minutes 60 --period 30
+
+import argparse
+import contextlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+sys.path.append(os.path.join(BASE_DIR, "..", "BLE_only"))
+import position_estimator
+import rssi_filter
+from epoch_time import ms_to_text
+
+APS = list(position_estimator.AP_COORDINATES)
+OFFSETS_MS = [0, 1000, 3000, 4000]
+PERIOD_MS = 7000
+
+
+def session_readings(tags, minutes, rng):
+    """filtered_rssi rows (timestamp, ap_id, mac, device_name, filtered_rssi, ts_ms), in event-time order."""
+    start = 1743888727000
+    cycles = int(minutes * 60 * 1000 // PERIOD_MS)
+    spots = rng.uniform(0, 1, (tags, 2)) * (4.96, 8.06)
+    rows = []
+    for tag in range(tags):
+        phase = int(rng.integers(0, PERIOD_MS // 1000)) * 1000
+        for ap, offset in zip(APS, OFFSETS_MS):
+            distance = max(np.linalg.norm(spots[tag] - position_estimator.AP_COORDINATES[ap]), 0.1)
+            expected = position_estimator.PATH_LOSS_A - 10 * position_estimator.PATH_LOSS_N * np.log10(distance)
+            ts = start + phase + offset + np.arange(cycles) * PERIOD_MS
+            rssi = expected + rng.normal(0, 2, cycles)
+            rows += [(ms_to_text(t), ap, f"02:00:00:00:{tag // 256:02x}:{tag % 256:02x}", f"tag{tag:04d}", float(r), int(t))
+                     for t, r in zip(ts, rssi)]
+    rows.sort(key=lambda row: (row[5], row[1], row[2]))
+    return rows
+
+
+def run_estimator(database, incremental):
+    """One estimator run on database, as its command line does it; returns the seconds it took."""
+    position_estimator.DATABASE = database
+    begin = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        positions, latest = position_estimator.estimate_positions(incremental=incremental)
+        position_estimator.store_positions(positions, latest, replace=not incremental)
+    return time.perf_counter() - begin
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare full and incremental estimator runs over a growing session.")
+    parser.add_argument("--tags", type=int, default=100)
+    parser.add_argument("--minutes", type=float, default=30.0, help="Session length")
+    parser.add_argument("--period", type=float, default=60.0, help="Seconds of readings between estimator runs")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    rows = session_readings(args.tags, args.minutes, rng)
+    print(f"Readings: {len(rows)}  tags: {args.tags}  runs: every {args.period:g} s of a {args.minutes:g} min session")
+
+    workdir = tempfile.mkdtemp(prefix="incremental_estimator_")
+    try:
+        databases = {"full": os.path.join(workdir, "full.db"), "incremental": os.path.join(workdir, "incremental.db")}
+        for database in databases.values():
+            rssi_filter.DATABASE = database
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                rssi_filter.create_tables()
+
+        seconds = {mode: [] for mode in databases}
+        first_ms = rows[0][5]
+        start = 0
+        while start < len(rows):
+            end = start
+            bound = first_ms + (len(seconds["full"]) + 1) * int(args.period * 1000)
+            while end < len(rows) and rows[end][5] < bound:
+                end += 1
+            for mode, database in databases.items():
+                conn = sqlite3.connect(database)
+                conn.executemany("INSERT INTO filtered_rssi (timestamp, ap_id, mac, device_name, filtered_rssi, ts_ms) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)", rows[start:end])
+                conn.commit()
+                conn.close()
+                seconds[mode].append(run_estimator(database, mode == "incremental"))
+            start = end
+
+        stored = {}
+        for mode, database in databases.items():
+            conn = sqlite3.connect(database)
+            stored[mode] = conn.execute("SELECT mac, timestamp, x, y FROM estimated_positions ORDER BY mac, timestamp").fetchall()
+            conn.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'mode':<13}{'first run s':>13}{'last run s':>12}{'total s':>10}")
+    for mode, runs in seconds.items():
+        print(f"{mode:<13}{runs[0]:>13.3f}{runs[-1]:>12.3f}{sum(runs):>10.2f}")
+    difference = max((abs(a[2] - b[2]) + abs(a[3] - b[3]) for a, b in zip(stored["full"], stored["incremental"])), default=0.0)
+    same_windows = [row[:2] for row in stored["full"]] == [row[:2] for row in stored["incremental"]]
+    print(f"last run speed-up: {seconds['full'][-1] / seconds['incremental'][-1]:.0f}x   positions: {len(stored['full'])} "
+          f"{'same windows' if same_windows else 'DIFFERENT windows'}, max difference {difference:.1e} m")
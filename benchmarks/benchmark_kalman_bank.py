@@ -0,0 +1,98 @@
+# Batch RSSI smoothing: one KalmanFilter.update() per row (the filters before
+# common/kalman_bank.py) vs KalmanBank on the same backfill. The recorded BLE
+# and WiFi readings are replayed over and over for many synthetic tags until
+# the backfill has --rows readings, in time order with the tags interleaved.
+#
+# python benchmark_kalman_bank.py
+# python benchmark_kalman_bank.py --rows 5000000 --tags 200
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+sys.path.append(os.path.join(BASE_DIR, "..", "BLE_only"))
+from kalman_bank import KalmanBank
+from rssi_filter import KalmanFilter
+
+SOURCES = [
+    (os.path.join(BASE_DIR, "../BLE_only/positioning.db"), "ble_rssi"),
+    (os.path.join(BASE_DIR, "../Wifi_only/positioning.db"), "wifi_rssi"),
+]
+
+
+def make_backfill(rows, tags):
+    """(keys, rssi) of a time-ordered backfill; keys are "<tag>/<mac>" strings like the filters' MAC keys."""
+    recorded = []
+    for db_path, table in SOURCES:
+        conn = sqlite3.connect(db_path)
+        recorded += conn.execute(f"SELECT mac, rssi FROM {table} WHERE rssi IS NOT NULL ORDER BY timestamp").fetchall()
+        conn.close()
+    macs = sorted({mac for mac, _ in recorded})
+    mac_index = {mac: i for i, mac in enumerate(macs)}
+    recorded_macs = np.array([mac_index[mac] for mac, _ in recorded])
+    recorded_rssi = np.array([rssi for _, rssi in recorded], dtype=float)
+
+    # Every step of the replay is one recorded reading seen by one synthetic tag
+    rng = np.random.default_rng(0)
+    step = np.arange(rows) % len(recorded)
+    tag = rng.integers(0, tags, rows)
+    key_ids = tag * len(macs) + recorded_macs[step]
+    names = [f"tag{t}/{mac}" for t in range(tags) for mac in macs]
+    keys = [names[k] for k in key_ids.tolist()]
+    rssi = recorded_rssi[step] + rng.normal(0, 1, rows).round()
+    return keys, rssi
+
+
+def per_row(keys, rssi):
+    filters = {}
+    out = []
+    for key, value in zip(keys, rssi.tolist()):
+        kalman = filters.get(key)
+        if kalman is None:
+            kalman = filters[key] = KalmanFilter()
+        out.append(kalman.update(value))
+    return np.array(out)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-row and vectorized Kalman filtering of a backfill.")
+    parser.add_argument("--rows", type=int, default=2_000_000, help="Readings in the backfill")
+    parser.add_argument("--tags", type=int, default=100, help="Synthetic tags replaying the recording")
+    args = parser.parse_args()
+
+    keys, rssi = make_backfill(args.rows, args.tags)
+    expected, row_seconds = timed(per_row, keys, rssi)
+
+    bank = KalmanBank()
+    filtered, bank_seconds = timed(bank.update, keys, rssi)
+
+    # Same backfill already grouped by key (e.g. read ORDER BY mac, timestamp), keys as slot ids
+    grouped_bank = KalmanBank()
+    slots = grouped_bank.slot_ids(keys)
+    order = np.argsort(slots, kind="stable")
+    grouped, grouped_seconds = timed(grouped_bank.update_slots, slots[order], rssi[order])
+
+    error = max(np.abs(filtered - expected).max(), np.abs(grouped - expected[order]).max())
+    if error > 1e-9:
+        raise SystemExit(f"KalmanBank differs from the per-row filter by {error} dBm")
+
+    print(f"Readings: {args.rows}  Keys: {len(bank)}  Max difference: {error:.1e} dBm")
+    print(f"{'filter':<28}{'seconds':>10}{'ns/reading':>12}{'speed-up':>10}")
+    for name, seconds in [
+        ("KalmanFilter per row", row_seconds),
+        ("KalmanBank, time order", bank_seconds),
+        ("KalmanBank, grouped by key", grouped_seconds),
+    ]:
+        print(f"{name:<28}{seconds:>10.3f}{seconds / args.rows * 1e9:>12.1f}{row_seconds / seconds:>10.1f}x")
@@ -0,0 +1,74 @@
+# Linear fallback trilateration for a store with dozens of APs: the
+# weighted_trilateration() the estimators used to run per window (A rebuilt
+# from the AP coordinates, np.linalg.inv of A^T W A with a dense np.diag W) vs
+# linear_positions() in common/trilateration.py, which caches the geometry of
+# every ordered AP subset and solves all windows of a subset at once. Windows
+# hear a random subset of --min-aps..--max-aps APs of a --grid layout, so
+# some subsets are collinear; both must agree on which ones.
+#
+# python benchmark_linear_trilateration.py
+# python benchmark_linear_trilateration.py --windows 200000 --grid 8 6 --min-aps 3 --max-aps 5
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from trilateration import linear_positions, subset_geometry
+
+
+def weighted_trilateration(ap_positions, distances):
+    """One window, the way the estimators solved it before linear_positions()."""
+    A, b, weights = [], [], []
+    for i in range(1, len(ap_positions)):
+        x0, y0 = ap_positions[0]
+        xi, yi = ap_positions[i]
+        di_sq = distances[i]**2 - distances[0]**2
+        A.append([2 * (xi - x0), 2 * (yi - y0)])
+        b.append(di_sq - (xi**2 + yi**2 - x0**2 - y0**2))
+        weights.append(1 / (distances[i] + 1e-6))
+    try:
+        A, b, W = np.array(A), np.array(b), np.diag(weights)
+        return np.linalg.inv(A.T @ W @ A) @ A.T @ W @ b
+    except np.linalg.LinAlgError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-window and cached batch linear trilateration.")
+    parser.add_argument("--windows", type=int, default=100000)
+    parser.add_argument("--grid", type=int, nargs=2, default=[6, 5], help="APs along x and y, 8 m apart")
+    parser.add_argument("--min-aps", type=int, default=3)
+    parser.add_argument("--max-aps", type=int, default=4)
+    parser.add_argument("--subsets", type=int, default=500, help="Distinct AP subsets the windows use")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    aps = [(8.0 * i, 8.0 * j) for i in range(args.grid[0]) for j in range(args.grid[1])]
+    subsets = [[aps[k] for k in rng.choice(len(aps), rng.integers(args.min_aps, args.max_aps + 1), replace=False)]
+               for _ in range(args.subsets)]
+    ap_points = [subsets[k] for k in rng.integers(0, len(subsets), args.windows)]
+    distances = [rng.uniform(1, 30, len(points)) for points in ap_points]
+    print(f"APs: {len(aps)}  Windows: {args.windows}  Subsets: {len(subsets)}")
+
+    begin = time.perf_counter()
+    reference = [weighted_trilateration(points, d) for points, d in zip(ap_points, distances)]
+    per_window_seconds = time.perf_counter() - begin
+
+    subset_geometry.cache_clear()
+    begin = time.perf_counter()
+    positions, solved = linear_positions(ap_points, distances)
+    batch_seconds = time.perf_counter() - begin
+
+    scale = np.array([1.0 if r is None else max(1.0, np.abs(r).max()) for r in reference])
+    both = np.array([r is not None for r in reference]) & solved
+    error = max((np.abs(reference[k] - positions[k]).max() / scale[k] for k in np.flatnonzero(both)), default=0.0)
+    print(f"per window: {per_window_seconds:.2f} s   cached batch: {batch_seconds:.3f} s   "
+          f"speed-up: {per_window_seconds / batch_seconds:.0f}x")
+    print(f"max relative difference: {error:.1e}   unsolved (collinear): {int(np.sum(~solved))}   "
+          f"singular per window: {sum(r is None for r in reference)}")
+    print(f"geometry cache: {subset_geometry.cache_info()}")
@@ -0,0 +1,105 @@
+# MAC attribution of the WiFi estimator's windows: the per-window lookup it
+# used to run (a new SQLite connection and a device/time range query on the
+# (device_name, ts_ms, mac) index per window) vs build_mac_index() and
+# find_macs() in Wifi_only/wifi_position_estimator.py, which index the
+# readings the estimator already fetched and binary-search them. The readings
+# are synthetic, in a temporary database: --devices devices, each reporting
+# through 4 APs every 7 s and changing MAC every --rotate readings. Both
+# lookups must attribute the same MACs.
+#
+# python benchmark_mac_lookup.py
+# python benchmark_mac_lookup.py --devices 200 --hours 2 --sql-windows 5000
+
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+sys.path.append(os.path.join(BASE_DIR, "..", "Wifi_only"))
+from wifi_position_estimator import FILTERED_ROWS_SQL, WINDOW_MS, build_mac_index, find_macs
+
+APS = ["RPi_AP_Alicia", "RPi_AP_EnThong", "RPi_AP_Pierre", "RPi_AP_XY"]
+OFFSETS_MS = [0, 1000, 3000, 4000]
+PERIOD_MS = 7000
+
+# The estimator's old lookup, on the index it had
+MAC_AT_TIME_SQL = """
+    SELECT mac, ts_ms FROM wifi_filtered_rssi
+    WHERE device_name = ?
+    AND ts_ms BETWEEN ? AND ?
+    ORDER BY ts_ms ASC, mac ASC
+"""
+
+
+def find_mac_for_device_at_time(database, device_name, ts_ms):
+    """One window, the way the estimator attributed it before find_macs()."""
+    conn = sqlite3.connect(database)
+    cursor = conn.cursor()
+    cursor.execute(MAC_AT_TIME_SQL, (device_name, ts_ms - WINDOW_MS, ts_ms + WINDOW_MS))
+    candidates = cursor.fetchall()
+    conn.close()
+    if not candidates:
+        return None
+    mac, _ = min(candidates, key=lambda row: abs(row[1] - ts_ms))
+    return mac
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-window SQL and in-memory MAC attribution.")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--hours", type=float, default=1.0)
+    parser.add_argument("--rotate", type=int, default=50, help="Readings per MAC before it changes")
+    parser.add_argument("--sql-windows", type=int, default=5000, help="Windows attributed by the SQL lookup")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    cycles = int(args.hours * 3600 * 1000 // PERIOD_MS)
+    start = 1743888727000
+    rows = []
+    for device in range(args.devices):
+        phase = int(rng.integers(0, PERIOD_MS // 1000)) * 1000
+        for ap, offset in zip(APS, OFFSETS_MS):
+            ts = start + phase + offset + np.arange(cycles) * PERIOD_MS
+            rows += [(f"M5Stick-{device:04d}", f"02:00:00:{device % 256:02x}:{(k // args.rotate) % 256:02x}:{ap[-2:].lower()}",
+                      ap, int(t), -70.0) for k, t in enumerate(ts)]
+
+    workdir = tempfile.mkdtemp(prefix="mac_lookup_")
+    try:
+        database = os.path.join(workdir, "positioning.db")
+        conn = sqlite3.connect(database)
+        conn.execute("CREATE TABLE wifi_filtered_rssi (device_name TEXT, mac TEXT, ap_id TEXT, ts_ms INTEGER, filtered_rssi REAL)")
+        conn.executemany("INSERT INTO wifi_filtered_rssi VALUES (?, ?, ?, ?, ?)", rows)
+        conn.execute("CREATE INDEX idx_wifi_filtered_rssi_device_ms ON wifi_filtered_rssi (device_name, ts_ms, mac)")
+        conn.commit()
+        raw_data = conn.execute(FILTERED_ROWS_SQL).fetchall()
+        conn.close()
+
+        # One window per device every WINDOW_MS, at the centre times of the estimator's grid
+        ticks = np.arange(start // WINDOW_MS, (start + cycles * PERIOD_MS) // WINDOW_MS + 1) * WINDOW_MS - WINDOW_MS // 2
+        device_names = np.repeat(np.array(sorted({row[0] for row in rows}), dtype=object), len(ticks))
+        window_ts = np.tile(ticks, args.devices)
+        order = rng.permutation(len(window_ts))  # The SQL lookup runs on a random sample
+        print(f"Readings: {len(rows)}  devices: {args.devices}  windows: {len(window_ts)}")
+
+        begin = time.perf_counter()
+        macs = find_macs(build_mac_index(raw_data), device_names, window_ts)
+        index_seconds = time.perf_counter() - begin
+
+        checked = order[:min(len(order), args.sql_windows)]
+        begin = time.perf_counter()
+        reference = [find_mac_for_device_at_time(database, device_names[k], int(window_ts[k])) for k in checked]
+        sql_seconds = (time.perf_counter() - begin) * len(window_ts) / len(checked)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    mismatches = sum(macs[k] != mac for k, mac in zip(checked, reference))
+    print(f"per-window SQL: {sql_seconds:.2f} s (extrapolated)   time index: {index_seconds:.2f} s   "
+          f"speed-up: {sql_seconds / index_seconds:.0f}x")
+    print(f"mismatches: {mismatches} of {len(checked)}   attributed: {sum(mac is not None for mac in macs)}")
@@ -0,0 +1,119 @@
+# Full BLE filter run on a large backfill: process_rssi() in one process vs
+# process_rssi_parallel() (common/parallel_filter.py) with 1, 2, 4 and 8
+# worker processes. The recorded BLE readings are copied to many synthetic
+# tags (each copy gets its own MAC) in a temporary raw table of --rows
+# readings; every parallel run must store the same filtered RSSI as the
+# single-process run.
+#
+# python benchmark_parallel_filter.py
+# python benchmark_parallel_filter.py --rows 5000000 --workers 1 2 4 8 --chunk-size 100000
+
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "ingestion"))
+sys.path.append(os.path.join(BASE_DIR, "..", "BLE_only"))
+import rssi_filter
+from ingest_service import RAW_TABLE_SCHEMA
+from parallel_filter import DEFAULT_CHUNK_SIZE
+
+RECORDING = os.path.join(BASE_DIR, "../BLE_only/positioning.db")
+RUN_ID = 1
+
+
+def make_raw_table(database, rows):
+    """ble_rssi with `rows` readings: the recording, each reading seen by every synthetic copy of its tag. Returns the tag count."""
+    conn = sqlite3.connect(RECORDING)
+    recorded = conn.execute(
+        "SELECT timestamp, ap_id, mac, device_name, rssi, latency FROM ble_rssi ORDER BY timestamp, id"
+    ).fetchall()
+    conn.close()
+    copies = -(-rows // len(recorded))
+
+    conn = sqlite3.connect(database)
+    conn.execute(RAW_TABLE_SCHEMA.format(table="ble_rssi"))
+    written = 0
+    for timestamp, ap_id, mac, device_name, rssi, latency in recorded:
+        batch = [
+            (timestamp, ap_id, f"{copy % 256:02x}:{copy // 256:02x}:{mac[6:]}", f"{device_name}_{copy}", rssi, latency, RUN_ID)
+            for copy in range(min(copies, rows - written))
+        ]
+        conn.executemany(
+            "INSERT INTO ble_rssi (timestamp, ap_id, mac, device_name, rssi, latency, run_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            batch,
+        )
+        written += len(batch)
+        if written == rows:
+            break
+    conn.commit()
+    tags = conn.execute("SELECT COUNT(DISTINCT mac) FROM ble_rssi").fetchone()[0]
+    conn.close()
+    return tags
+
+
+def keep_expected(database):
+    """Snapshot of the single-process result, indexed like filtered_rssi."""
+    conn = sqlite3.connect(database)
+    conn.execute("DROP TABLE IF EXISTS expected")
+    conn.execute("CREATE TABLE expected AS SELECT timestamp, ap_id, mac, filtered_rssi FROM filtered_rssi")
+    conn.execute("CREATE UNIQUE INDEX idx_expected ON expected (timestamp, ap_id, mac)")
+    conn.commit()
+    count = conn.execute("SELECT COUNT(*) FROM expected").fetchone()[0]
+    conn.close()
+    return count
+
+
+def matches_expected(database):
+    conn = sqlite3.connect(database)
+    total = conn.execute("SELECT COUNT(*) FROM filtered_rssi").fetchone()[0]
+    same = conn.execute("""
+        SELECT COUNT(*) FROM filtered_rssi f
+        JOIN expected e ON e.timestamp = f.timestamp AND e.ap_id = f.ap_id AND e.mac = f.mac
+        WHERE e.filtered_rssi = f.filtered_rssi
+    """).fetchone()[0]
+    expected = conn.execute("SELECT COUNT(*) FROM expected").fetchone()[0]
+    conn.close()
+    return total == same == expected
+
+
+def timed_run(function, *args):
+    rssi_filter.create_tables()  # Drops the filtered table of the previous run
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare single-process and parallel filtering of a large backfill.")
+    parser.add_argument("--rows", type=int, default=2_000_000, help="Raw readings in the backfill")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Raw rows each worker reads at a time")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="parallel_filter_")
+    try:
+        rssi_filter.DATABASE = os.path.join(workdir, "positioning.db")
+        tags = make_raw_table(rssi_filter.DATABASE, args.rows)
+        print(f"Readings: {args.rows}  Tags: {tags}  CPUs: {os.cpu_count()}")
+
+        results = [("single process", timed_run(rssi_filter.process_rssi, RUN_ID))]
+        stored = keep_expected(rssi_filter.DATABASE)
+        for workers in args.workers:
+            seconds = timed_run(rssi_filter.process_rssi_parallel, RUN_ID, workers, args.chunk_size)
+            if not matches_expected(rssi_filter.DATABASE):
+                raise SystemExit(f"{workers} workers stored different filtered RSSI than the single-process run")
+            results.append((f"{workers} workers", seconds))
+
+        base = results[0][1]
+        print(f"Filtered rows: {stored}")
+        print(f"{'mode':<16}{'seconds':>10}{'readings/s':>14}{'speed-up':>10}")
+        for name, seconds in results:
+            print(f"{name:<16}{seconds:>10.2f}{args.rows / seconds:>14.0f}{base / seconds:>10.2f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
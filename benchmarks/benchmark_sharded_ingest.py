@@ -0,0 +1,96 @@
+# Ingestion throughput: single-writer IngestService vs ShardedIngestService
+# with 1, 2, 4, ... shard writer processes. The recorded readings are fanned out
+# to many synthetic tags, packed as per-scan batches and pushed straight into
+# the service (no broker), then timed until everything is committed.
+#
+# python benchmark_sharded_ingest.py
+# python benchmark_sharded_ingest.py --tags 50 --shards 1 2 4 8
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "ingestion"))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from ingest_service import IngestService
+from replay import DEFAULT_SOURCES, build_messages, encode_message, load_recording
+from sharded_ingest import ShardedIngestService
+from shards import connect
+
+
+def make_payloads(tags, duration):
+    recording = load_recording(DEFAULT_SOURCES, duration)
+    messages = build_messages(recording, "batch", tags)
+    now = time.time()
+    payloads = []
+    readings = 0
+    for offset, topic, ap_id, scan in messages:
+        for payload in encode_message("batch", now + offset, ap_id, scan):
+            payloads.append((topic, payload))
+        readings += len(scan)
+    return payloads, readings
+
+
+async def ingest(service, payloads):
+    writer_task = asyncio.create_task(service.run())
+    # Time the steady state, not opening the database / spawning writers
+    while service.run_id is None:
+        await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    for topic, payload in payloads:
+        # Waits whenever the service applies backpressure
+        await service.submit(topic, payload)
+    await service.stop()
+    await writer_task
+    return time.perf_counter() - start
+
+
+def stored_readings(database):
+    conn = connect(database)
+    count = sum(conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("ble_rssi", "wifi_rssi"))
+    conn.close()
+    return count
+
+
+def run_case(name, make_service, payloads, readings, workdir):
+    database = os.path.join(workdir, f"{name.replace(' ', '_')}.db")
+    service = make_service(database)
+    elapsed = asyncio.run(ingest(service, payloads))
+    stored = stored_readings(database)
+    if stored != readings:
+        raise SystemExit(f"{name}: stored {stored} of {readings} readings")
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare single-writer and sharded ingestion throughput.")
+    parser.add_argument("--tags", type=int, default=20, help="Synthetic tags per recorded tag")
+    parser.add_argument("--duration", type=float, default=None, help="Only use the first N recorded seconds")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    payloads, readings = make_payloads(args.tags, args.duration)
+    print(f"Messages: {len(payloads)}  Readings: {readings}  CPUs: {os.cpu_count()}")
+
+    workdir = tempfile.mkdtemp(prefix="sharded_ingest_")
+    try:
+        cases = [("single writer", lambda db: IngestService(db, keep_runs=0))]
+        for shards in args.shards:
+            cases.append((f"{shards} shards", lambda db, shards=shards: ShardedIngestService(db, shards=shards, keep_runs=0)))
+
+        results = []
+        for name, make_service in cases:
+            elapsed = run_case(name, make_service, payloads, readings, workdir)
+            results.append((name, elapsed))
+
+        base = results[0][1]
+        print(f"{'mode':<16}{'seconds':>10}{'readings/s':>14}{'speed-up':>10}")
+        for name, elapsed in results:
+            print(f"{name:<16}{elapsed:>10.2f}{readings / elapsed:>14.0f}{base / elapsed:>10.2f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
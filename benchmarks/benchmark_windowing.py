@@ -0,0 +1,110 @@
+# Window grouping of a long replay, up to the solver inputs (K x 3 AP positions
+# and ranges): the per-device Python scan the BLE estimator used to run (open a
+# window at a reading, collect the readings up to 3 s after it, skip past
+# them) and its per-window loop over the APs, vs resample_windows() and
+# known_windows() in common/windowing.py, which put every (device, AP) stream
+# on a fixed 3 s grid and gather the inputs with array indexing. The readings
+# are synthetic, timed like the recordings: each of --tags tags heard by 4 APs
+# every 7 s on whole seconds, the APs staggered by 0, 1, 3 and 4 s, with some
+# readings dropped.
+#
+# python benchmark_windowing.py
+# python benchmark_windowing.py --tags 200 --hours 2
+
+import argparse
+import os
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from windowing import known_windows, resample_windows
+
+AP_COORDINATES = {"xypi": (4.96, 0), "pierre": (4.96, 8.06), "enthong": (0, 8.06), "aliciapi": (0, 0)}
+APS = ["aliciapi", "enthong", "pierre", "xypi"]
+OFFSETS_MS = [0, 1000, 3000, 4000]
+PERIOD_MS = 7000
+
+
+def rssi_to_distance(rssi, A=-55.525, n=0.73529100890785):
+    return 10 ** ((A - rssi) / (10 * n))
+
+
+def scan_windows(rows, window_ms):
+    """The old grouping: {device: [(mid ts_ms, {ap: rssi})]}, windows of exactly 3 APs."""
+    grouped = defaultdict(list)
+    for device, ap, ts_ms, rssi in rows:
+        grouped[device].append((ts_ms, ap, rssi))
+
+    windowed = {}
+    for device, readings in grouped.items():
+        readings.sort()
+        i = 0
+        while i < len(readings):
+            ts_i, ap_i, rssi_i = readings[i]
+            window = {ap_i: rssi_i}
+            timestamps = [ts_i]
+            j = i + 1
+            while j < len(readings):
+                ts_j, ap_j, rssi_j = readings[j]
+                if ts_j - ts_i <= window_ms:
+                    window[ap_j] = rssi_j
+                    timestamps.append(ts_j)
+                    j += 1
+                else:
+                    break
+            if len(window) == 3:
+                windowed.setdefault(device, []).append(((min(timestamps) + max(timestamps)) // 2, window))
+                i = j
+            else:
+                i += 1
+    return windowed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the per-device window scan and fixed-rate resampling.")
+    parser.add_argument("--tags", type=int, default=100)
+    parser.add_argument("--hours", type=float, default=1.0)
+    parser.add_argument("--window", type=int, default=3000, help="Window width (ms)")
+    parser.add_argument("--drop", type=float, default=0.05, help="Share of readings lost")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    cycles = int(args.hours * 3600 * 1000 // PERIOD_MS)
+    start = 1743888727000
+    rows = []
+    for tag in range(args.tags):
+        phase = int(rng.integers(0, PERIOD_MS // 1000)) * 1000
+        for ap, offset in zip(APS, OFFSETS_MS):
+            ts = start + phase + offset + np.arange(cycles) * PERIOD_MS
+            rssi = rng.normal(-75, 4, cycles)
+            kept = rng.random(cycles) >= args.drop
+            rows += [(f"tag{tag:04d}", ap, int(t), float(r)) for t, r in zip(ts[kept], rssi[kept])]
+    rows.sort(key=lambda row: row[2])  # Event-time order, as the estimators read them
+    print(f"Readings: {len(rows)}  tags: {args.tags}  window: {args.window} ms")
+
+    begin = time.perf_counter()
+    ap_points, distances = [], []
+    for windows in scan_windows(rows, args.window).values():
+        for _, ap_rssi in windows:
+            known = [(AP_COORDINATES[ap], rssi_to_distance(rssi)) for ap, rssi in ap_rssi.items() if ap in AP_COORDINATES]
+            if len(known) == 3:
+                ap_points.append([position for position, _ in known])
+                distances.append([distance for _, distance in known])
+    scan_seconds = time.perf_counter() - begin
+    scan_windows_count = len(distances)
+
+    begin = time.perf_counter()
+    devices, _, rssi, aps = resample_windows(rows, args.window)
+    known, columns = known_windows(rssi, aps, AP_COORDINATES)
+    coordinates = np.array([AP_COORDINATES[ap] for ap in aps])
+    ap_points, distances = coordinates[columns], rssi_to_distance(rssi[known[:, None], columns])
+    resample_seconds = time.perf_counter() - begin
+
+    print(f"{'grouping':<12}{'seconds':>10}{'windows':>10}")
+    print(f"{'scan':<12}{scan_seconds:>10.2f}{scan_windows_count:>10}")
+    print(f"{'resample':<12}{resample_seconds:>10.2f}{len(distances):>10}")
+    print(f"speed-up: {scan_seconds / resample_seconds:.1f}x")
@@ -0,0 +1,237 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+# === NTP-style clock offset estimation over MQTT ===
+# Latency is receive time (ingest host clock) minus the publisher's
+# timestamp_epoch (publisher clock), so any skew between the two clocks ends up
+# in it. The ingest host publishes a ping every PING_INTERVAL seconds; every
+# publisher answers with its own receive / send times:
+#
+#   t0  ping sent      (host clock)      t1  ping received  (publisher clock)
+#   t3  echo received  (host clock)      t2  echo sent      (publisher clock)
+#
+#   offset = ((t1 - t0) + (t2 - t3)) / 2    publisher clock minus host clock
+#   delay  = (t3 - t0) - (t2 - t1)          network round trip
+#
+# Like NTP, the low-delay samples are trusted most (their offset error is at
+# most delay / 2) and a line fitted through them gives the drift, so the
+# offset can be applied between pings. Ingest then stores
+# latency = raw latency + offset, the real transport delay.
+#
+# clock_sync.py is copied next to the publisher scripts on the Pi, like rssi_codec.py.
+
+PING_TOPIC = "clock/ping"
+ECHO_TOPIC = "clock/echo"
+
+# Seconds between pings
+PING_INTERVAL = 10.0
+# Samples kept per publisher (~5 minutes at the default interval)
+SAMPLE_WINDOW = 32
+# Drift is only fitted once the trusted samples span this many seconds
+MIN_DRIFT_SPAN = 60.0
+# Crystal oscillators stay well inside NTP's 500 ppm limit; anything larger is noise
+MAX_DRIFT = 500e-6
+# Pings waiting for an echo; older ones are forgotten
+MAX_OUTSTANDING = 64
+
+# Whose clock stamped a reading: the Pis stamp their BLE scans (ap_id), the
+# M5Sticks stamp their own WiFi scans (device_name, the ap_id is the SSID seen)
+STAMPED_BY = {
+    "ble/rssi": "ap_id",
+    "wifi/rssi": "device_name",
+}
+
+
+def reading_sender(topic, ap_id, device_name):
+    """Sender name of the clock that stamped a reading published on topic."""
+    return device_name if STAMPED_BY.get(topic, "ap_id") == "device_name" else ap_id
+
+
+# === Publisher side ===
+def echo_payload(ping, sender, receive_time, send_time=None):
+    """Answer to a ping payload, or None if it is not a ping."""
+    try:
+        request = json.loads(ping)
+        session, seq, t0 = request["session"], int(request["seq"]), float(request["t0"])
+    except (ValueError, KeyError, TypeError):
+        return None
+    return json.dumps({
+        "session": session,
+        "seq": seq,
+        "t0": t0,
+        "t1": receive_time,
+        "t2": time.time() if send_time is None else send_time,
+        "sender": sender,
+    })
+
+
+def answer_pings(client, sender):
+    """
+    Make a paho client echo clock pings as `sender` (the ap_id it publishes under).
+    Needs the client's network loop running (loop_start() or loop_forever()).
+    """
+    def on_ping(client, userdata, msg):
+        receive_time = time.time()
+        payload = echo_payload(msg.payload, sender, receive_time)
+        if payload is not None:
+            client.publish(ECHO_TOPIC, payload)
+
+    client.message_callback_add(PING_TOPIC, on_ping)
+    client.subscribe(PING_TOPIC)
+
+
+# === Ingest side ===
+class ClockOffsetEstimator:
+    """Offset and drift of one publisher's clock relative to the ingest host."""
+
+    def __init__(self, window=SAMPLE_WINDOW):
+        self.samples = deque(maxlen=window)  # (host time, offset, delay)
+        self.offset = None
+        self.drift = 0.0
+        self.delay = None
+        self.reference_time = None
+        self.updated_at = None
+        self.last_seq = 0
+        self._estimate = None
+
+    def add_sample(self, t0, t1, t2, t3):
+        delay = (t3 - t0) - (t2 - t1)
+        if delay < 0:
+            delay = 0.0  # Clock steps between t1 and t2; keep the sample, it is still bounded
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        self.samples.append(((t0 + t3) / 2, offset, delay))
+        self._update()
+        return offset, delay
+
+    def _update(self):
+        # Trust the lower-delay half of the window (at least 3 samples when there are that many)
+        ranked = sorted(self.samples, key=lambda sample: sample[2])
+        trusted = ranked[:max(3, len(ranked) // 2)]
+        best_time, best_offset, best_delay = ranked[0]
+
+        times = [sample[0] for sample in trusted]
+        drift = 0.0
+        if len(trusted) >= 3 and max(times) - min(times) >= MIN_DRIFT_SPAN:
+            mean_time = sum(times) / len(times)
+            mean_offset = sum(sample[1] for sample in trusted) / len(trusted)
+            spread = sum((t - mean_time) ** 2 for t in times)
+            drift = sum((t - mean_time) * (sample[1] - mean_offset) for t, sample in zip(times, trusted)) / spread
+            drift = max(-MAX_DRIFT, min(MAX_DRIFT, drift))
+            # Line through the trusted samples, anchored at their mean
+            best_time, best_offset = mean_time, mean_offset
+
+        # Swapped as one tuple so readers on other threads never see a mismatched pair
+        self._estimate = (best_offset, drift, best_time)
+        self.offset, self.drift, self.reference_time = self._estimate
+        self.delay = best_delay
+        self.updated_at = time.time()
+
+    def offset_at(self, host_time):
+        """Estimated offset (publisher minus host, seconds) at a host time, None before the first sample."""
+        estimate = self._estimate
+        if estimate is None:
+            return None
+        offset, drift, reference_time = estimate
+        return offset + drift * (host_time - reference_time)
+
+
+class ClockSync:
+    """
+    Clock offsets of every publisher that answers pings, keyed by the sender
+    name in its echo (the ap_id a Pi publishes under, or the device name of a
+    tag that publishes its own readings).
+
+    next_ping() / handle_echo() run wherever the MQTT client lives;
+    correct_latency() can be called from any thread.
+    """
+
+    def __init__(self, window=SAMPLE_WINDOW):
+        self.window = window
+        self.estimators = {}
+        self.session = f"{os.getpid()}-{random.getrandbits(32):08x}"  # Ignore echoes of other ingest hosts
+        self._seq = 0
+        self._outstanding = {}
+        self._lock = threading.Lock()
+        self.pings = 0
+        self.echoes = 0
+
+    def next_ping(self, now=None):
+        """Ping payload to publish on PING_TOPIC."""
+        t0 = time.time() if now is None else now
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._outstanding[seq] = t0
+            if len(self._outstanding) > MAX_OUTSTANDING:
+                del self._outstanding[min(self._outstanding)]
+            self.pings += 1
+        return json.dumps({"session": self.session, "seq": seq, "t0": t0})
+
+    def handle_echo(self, payload, receive_time):
+        """Add the sample of one echo (receive_time = t3); returns the sender, or None if it is not ours."""
+        try:
+            echo = json.loads(payload)
+            if echo.get("session") != self.session:
+                return None
+            seq, t1, t2, sender = int(echo["seq"]), float(echo["t1"]), float(echo["t2"]), str(echo["sender"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None
+        with self._lock:
+            # Our own t0, so an echo cannot move it; every publisher answers the same ping
+            t0 = self._outstanding.get(seq)
+            if t0 is None:
+                return None
+            estimator = self.estimators.get(sender)
+            if estimator is None:
+                estimator = self.estimators[sender] = ClockOffsetEstimator(self.window)
+            if seq <= estimator.last_seq:
+                return None  # Duplicate or out-of-order echo
+            estimator.last_seq = seq
+            estimator.add_sample(t0, t1, t2, receive_time)
+            self.echoes += 1
+        return sender
+
+    def offset(self, sender, host_time):
+        estimator = self.estimators.get(sender)
+        return estimator.offset_at(host_time) if estimator is not None else None
+
+    def correct_latency(self, latency, receive_time, sender):
+        """
+        Raw latency (receive_time - timestamp_epoch) -> transport delay, with
+        sender the publisher that stamped the reading (see reading_sender()).
+        Readings from a publisher that never answered a ping keep their raw latency.
+        """
+        offset = self.offset(sender, receive_time)
+        return latency if offset is None else latency + offset
+
+    def stats(self):
+        return {
+            sender: {
+                "offset_ms": estimator.offset * 1000,
+                "drift_ppm": estimator.drift * 1e6,
+                "delay_ms": estimator.delay * 1000,
+                "samples": len(estimator.samples),
+            }
+            for sender, estimator in list(self.estimators.items())
+            if estimator.offset is not None
+        }
+
+
+def start_pinger(clock, publish, interval=PING_INTERVAL):
+    """Daemon thread calling publish(PING_TOPIC, payload) every interval seconds."""
+
+    def ping_forever():
+        while True:
+            try:
+                publish(PING_TOPIC, clock.next_ping())
+            except Exception as e:
+                print(f"Clock ping failed: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=ping_forever, name="clock-ping", daemon=True)
+    thread.start()
+    return thread
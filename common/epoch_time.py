@@ -0,0 +1,85 @@
+# Integer epoch-millisecond event times.
+#
+# Every raw, filtered and position table carries a ts_ms INTEGER column next to
+# its TEXT timestamp: milliseconds since the Unix epoch, taken from the
+# publisher's timestamp_epoch when it sent one. Windows and "closest reading"
+# lookups compare ts_ms as plain integers (in NumPy or SQL) instead of parsing
+# "%Y-%m-%d %H:%M:%S" strings, and keep the sub-second part that the text
+# drops. The TEXT column stays for display and for the evaluation scripts.
+#
+# Text timestamps are local time (rssi_codec.format_timestamp()), so the
+# backfill of older rows reads them as local time too.
+
+import time
+from datetime import datetime
+
+from schema_version import ensure_schema_migrations, is_applied, mark_applied
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Local-time text -> epoch ms, in SQL; NULL for text SQLite cannot parse.
+# julianday() keeps fractional seconds ("...12:00:01.250" -> ...1250).
+TEXT_TO_MS_SQL = "CAST(ROUND((julianday({column}, 'utc') - 2440587.5) * 86400000) AS INTEGER)"
+
+
+def epoch_ms(epoch_seconds):
+    """Epoch seconds (float) -> integer epoch ms."""
+    return int(round(epoch_seconds * 1000))
+
+
+def text_to_ms(timestamp):
+    """Local-time "%Y-%m-%d %H:%M:%S" (or ISO format, fractions allowed) -> epoch ms; None if unparseable."""
+    try:
+        return epoch_ms(datetime.fromisoformat(timestamp).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+
+def ms_to_text(ms):
+    """Epoch ms -> "%Y-%m-%d %H:%M:%S" local time (the sub-second part is dropped)."""
+    return time.strftime(TIMESTAMP_FORMAT, time.localtime(ms // 1000))
+
+
+def ms_to_isoformat(ms):
+    """Epoch ms -> local-time ISO format, with microseconds when ms is not a whole second."""
+    return datetime.fromtimestamp(ms / 1000).isoformat()
+
+
+def reading_ms(timestamp, send_time, receive_time):
+    """
+    ts_ms of one received reading whose TEXT timestamp is `timestamp`: the
+    publisher's timestamp_epoch whenever it sent one (with or without the
+    text), else the text itself, else the time it was received.
+    """
+    if send_time is not None:
+        return epoch_ms(send_time)
+    ms = text_to_ms(timestamp)
+    return epoch_ms(receive_time) if ms is None else ms
+
+
+def _table_exists(conn, table):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)
+    ).fetchone() is not None
+
+
+def ensure_epoch_columns(conn, tables):
+    """
+    Give every existing table of `tables` a ts_ms column and fill it in from the
+    TEXT timestamp for rows written without it (older databases). Adding the
+    column is O(1); the backfill is one UPDATE per table, run once per table
+    (schema_version.py), since every writer now stores ts_ms itself.
+    """
+    ensure_schema_migrations(conn)
+    for table in tables:
+        if not _table_exists(conn, table) or is_applied(conn, f"ts_ms:{table}"):
+            continue
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if "timestamp" not in columns:
+            continue
+        if "ts_ms" not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN ts_ms INTEGER")
+        conn.execute(f"UPDATE {table} SET ts_ms = {TEXT_TO_MS_SQL.format(column='timestamp')} "
+                     f"WHERE ts_ms IS NULL AND timestamp IS NOT NULL")
+        mark_applied(conn, f"ts_ms:{table}")
+        conn.commit()
@@ -0,0 +1,156 @@
+# Persisted state of the incremental position estimators.
+#
+# A full estimator run solves every window of the filtered history into a new
+# positions table, which replaces the stored one (and the estimator's
+# watermarks) only once every position is written: a run that fails leaves the
+# previous positions in place. In incremental mode the estimators instead keep, per device
+# (or MAC), the newest filtered ts_ms they have read (estimator_watermarks), and
+# the next run only reads the readings from shortly before the watermarks on:
+# - windows ending before a device's watermark already had all their readings
+#   and are not solved again
+# - the trailing window, which was still open at the watermark, is re-opened
+#   and solved again with its new readings, and the windows after it are new
+# Positions are upserted, so a re-opened window replaces its earlier fix, and
+# positions and watermarks are committed in one transaction. They are keyed by
+# the window's centre time in ISO format, milliseconds included, so windows
+# narrower than a second get keys of their own.
+#
+# Readings are expected in event-time order give or take ALLOWED_LATENESS: a
+# device's windows are never re-opened further back than that behind the
+# newest watermark, so readings arriving later than that are not estimated
+# until the next full run. A full filter run rebuilds the filtered table,
+# which needs a full estimator run after it.
+
+import numpy as np
+
+from epoch_time import ensure_epoch_columns, ms_to_isoformat
+from schema_version import is_applied, mark_applied
+
+# Seconds a device's readings may lag the newest watermark and still be estimated
+ALLOWED_LATENESS = 30
+
+ESTIMATOR_STATE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS estimator_watermarks (
+        estimator TEXT NOT NULL,
+        key TEXT NOT NULL,
+        ts_ms INTEGER NOT NULL,
+        window_ms INTEGER NOT NULL,
+        PRIMARY KEY (estimator, key)
+    )
+"""
+
+
+def ensure_estimator_state(conn):
+    conn.execute(ESTIMATOR_STATE_SCHEMA)
+    conn.commit()
+
+
+def load_estimator_watermarks(conn, name, window_ms):
+    """
+    {key (TEXT): newest ts_ms read} of one estimator. Raises when they were
+    taken with windows of another width, whose grid the stored fixes are on.
+    """
+    ensure_estimator_state(conn)
+    watermarks = {}
+    for key, ts_ms, stored_window_ms in conn.execute(
+            "SELECT key, ts_ms, window_ms FROM estimator_watermarks WHERE estimator = ?", (name,)):
+        if stored_window_ms != window_ms:
+            raise RuntimeError(f"{name} was estimated with {stored_window_ms} ms windows; "
+                               f"run once without --incremental to switch to {window_ms} ms")
+        watermarks[key] = ts_ms
+    return watermarks
+
+
+def save_estimator_watermarks(conn, name, latest, window_ms):
+    """
+    latest: {key: newest ts_ms of the readings just estimated}. A watermark
+    never moves back. The caller commits, together with the positions.
+    """
+    conn.executemany(
+        """INSERT INTO estimator_watermarks (estimator, key, ts_ms, window_ms) VALUES (?, ?, ?, ?)
+           ON CONFLICT (estimator, key) DO UPDATE SET ts_ms = MAX(ts_ms, excluded.ts_ms),
+                                                      window_ms = excluded.window_ms""",
+        [(name, str(key), int(ts_ms), window_ms) for key, ts_ms in latest.items()],
+    )
+
+
+def read_since(watermarks, window_ms, lateness=ALLOWED_LATENESS):
+    """Epoch ms from which an incremental run reads the filtered readings (None: all, on the first run)."""
+    if not watermarks:
+        return None
+    # Two windows before the oldest one re-opened: its readings, and those around its centre
+    return max(watermarks.values()) - int(lateness * 1000) - 2 * window_ms
+
+
+def reopened_windows(keys, window_ts, window_ms, watermarks, lateness=ALLOWED_LATENESS):
+    """
+    Bool mask of the windows (keys K, centre ts_ms K) an incremental run
+    solves: those ending at or after their key's watermark, but never more
+    than lateness seconds behind the newest watermark.
+    """
+    if not watermarks:
+        return np.ones(len(window_ts), dtype=bool)
+    floor = max(watermarks.values()) - int(lateness * 1000)
+    ends = np.asarray(window_ts, dtype=np.int64) + window_ms // 2
+    reopen = np.array([max(watermarks.get(str(key), floor), floor) for key in keys], dtype=np.int64)
+    return ends >= reopen
+
+
+def _add_missing_columns(conn, table, schema):
+    """Add the columns of `schema` that a stored positions table of an older layout lacks."""
+    conn.execute(schema.format(table=f"temp.{table}_layout"))
+    wanted = [(row[1], row[2]) for row in conn.execute(f"PRAGMA temp.table_info({table}_layout)")]
+    conn.execute(f"DROP TABLE temp.{table}_layout")
+    stored = {row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")}
+    for column, column_type in wanted:
+        if column not in stored:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    conn.commit()
+
+
+def _isoformat_timestamps(conn, table):
+    """
+    Rewrite the whole-second timestamps the WiFi and hybrid estimators used to
+    key their windows by as ms_to_isoformat(ts_ms), once per table, so that an
+    incremental run re-opening such a window updates its fix instead of adding
+    a second one.
+    """
+    if is_applied(conn, f"isoformat:{table}"):
+        return
+    rows = conn.execute(f"SELECT id, ts_ms FROM {table} WHERE ts_ms IS NOT NULL").fetchall()
+    conn.executemany(f"UPDATE {table} SET timestamp = ? WHERE id = ?",
+                     [(ms_to_isoformat(ts_ms), row_id) for row_id, ts_ms in rows])
+    mark_applied(conn, f"isoformat:{table}")
+    conn.commit()
+
+
+def store_estimates(conn, name, table, schema, upsert_sql, rows, latest, window_ms, replace=False):
+    """
+    Upsert one run's position rows and save its watermarks in one transaction
+    (schema and upsert_sql take the table name as {table}). replace=True (a
+    full run) writes them to a new table that is swapped in for `table`, the
+    estimator's old watermarks dropped with it, so a failing run leaves the
+    stored positions untouched.
+    """
+    ensure_estimator_state(conn)
+    if not replace:
+        conn.execute(schema.format(table=table))
+        _add_missing_columns(conn, table, schema)
+        ensure_epoch_columns(conn, [table])
+        _isoformat_timestamps(conn, table)
+    target = f"{table}_new" if replace else table
+    conn.execute("BEGIN")
+    try:
+        if replace:
+            conn.execute(f"DROP TABLE IF EXISTS {target}")
+            conn.execute(schema.format(table=target))
+        conn.executemany(upsert_sql.format(table=target), rows)
+        if replace:
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.execute(f"ALTER TABLE {target} RENAME TO {table}")
+            conn.execute("DELETE FROM estimator_watermarks WHERE estimator = ?", (name,))
+        save_estimator_watermarks(conn, name, latest, window_ms)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
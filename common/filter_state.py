@@ -0,0 +1,135 @@
+# Persisted state of the incremental RSSI filters.
+#
+# A full filter run drops its filtered table and refilters the whole history
+# from x = -70. In incremental mode the filters instead keep, per filtered
+# table:
+# - kalman_state: x and P of every Kalman filter, plus the last raw row it consumed
+# - filter_watermarks: the highest raw id already filtered, per raw source
+#   ("main" for the catalog table, or the file name of each shard of sharded ingestion)
+# and only read raw rows above the watermark, so an invocation costs the new
+# rows, not the table size. Filtered rows, state and watermarks are committed
+# in one transaction, so a crash never applies a reading twice.
+
+import shards
+
+FILTER_STATE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS kalman_state (
+        filter TEXT NOT NULL,
+        key TEXT NOT NULL,
+        x REAL NOT NULL,
+        P REAL NOT NULL,
+        last_id INTEGER,
+        last_timestamp TEXT,
+        PRIMARY KEY (filter, key)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS filter_watermarks (
+        filter TEXT NOT NULL,
+        source TEXT NOT NULL,
+        last_id INTEGER NOT NULL,
+        PRIMARY KEY (filter, source)
+    )
+    """,
+]
+
+
+def ensure_filter_state(conn):
+    for statement in FILTER_STATE_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+
+def reset_filter_state(conn, name):
+    """Forget the state of one filter, e.g. when its filtered table is rebuilt from scratch."""
+    ensure_filter_state(conn)
+    conn.execute("DELETE FROM kalman_state WHERE filter = ?", (name,))
+    conn.execute("DELETE FROM filter_watermarks WHERE filter = ?", (name,))
+    conn.commit()
+
+
+# Keys per "key IN (...)" lookup, well below SQLite's bound-parameter limit
+LOOKUP_BATCH = 500
+
+
+def state_key(key):
+    """TEXT form of a filter key: a MAC as is, (device_key, ap_key, signal) as "device_key/ap_key/signal"."""
+    return "/".join(map(str, key)) if isinstance(key, tuple) else key
+
+
+def load_kalman_states(conn, name, keys=None):
+    """{key: (x, P)} of one filter; only the given keys (those that have state) if keys is set."""
+    if keys is None:
+        return {key: (x, P) for key, x, P in conn.execute(
+            "SELECT key, x, P FROM kalman_state WHERE filter = ?", (name,))}
+    by_text = {state_key(key): key for key in keys}
+    texts = list(by_text)
+    states = {}
+    for start in range(0, len(texts), LOOKUP_BATCH):
+        batch = texts[start:start + LOOKUP_BATCH]
+        placeholders = ", ".join("?" * len(batch))
+        for key, x, P in conn.execute(
+                f"SELECT key, x, P FROM kalman_state WHERE filter = ? AND key IN ({placeholders})", [name] + batch):
+            states[by_text[key]] = (x, P)
+    return states
+
+
+def checkpoint_kalman_states(conn, name, states):
+    """
+    Store {key: (x, P)} without touching last_id / last_timestamp (filters
+    evicted from memory, see kalman_store.py). The caller commits.
+    """
+    conn.executemany(
+        """INSERT INTO kalman_state (filter, key, x, P) VALUES (?, ?, ?, ?)
+           ON CONFLICT (filter, key) DO UPDATE SET x = excluded.x, P = excluded.P""",
+        [(name, state_key(key), x, P) for key, (x, P) in states.items()],
+    )
+
+
+def load_watermarks(conn, name):
+    """{source: last raw id filtered}"""
+    return dict(conn.execute("SELECT source, last_id FROM filter_watermarks WHERE filter = ?", (name,)))
+
+
+def fetch_new_rows(conn, table, columns, watermarks):
+    """
+    Raw rows above the watermark of every source, oldest first.
+
+    conn comes from shards.connect(), so the shard files are attached. Each
+    source is read through its own INTEGER PRIMARY KEY range (id > last_id),
+    never through the cross-shard view. Returns (rows, new_watermarks), each
+    row being (id, *columns); columns must include ts_ms.
+    """
+    rows = []
+    new_watermarks = {}
+    select = ", ".join(["id"] + list(columns))
+    for source, qualified_table in shards.raw_sources(conn, table):
+        last_id = watermarks.get(source, 0)
+        source_rows = conn.execute(
+            f"SELECT {select} FROM {qualified_table} WHERE id > ? ORDER BY id", (last_id,)
+        ).fetchall()
+        if source_rows:
+            new_watermarks[source] = source_rows[-1][0]
+            rows.extend(source_rows)
+    # Chronological across sources by event time (a row without one first); ids break ties
+    ts_ms = 1 + list(columns).index("ts_ms")
+    rows.sort(key=lambda row: (row[ts_ms] if row[ts_ms] is not None else 0, row[0]))
+    return rows, new_watermarks
+
+
+def save_filter_state(conn, name, states, watermarks):
+    """
+    states: {key: (x, P, last_id, last_timestamp)} of the filters that consumed rows.
+    watermarks: {source: last_id} of the sources that had new rows.
+    The caller commits, together with the filtered rows.
+    """
+    conn.executemany(
+        "INSERT OR REPLACE INTO kalman_state (filter, key, x, P, last_id, last_timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+        [(name, state_key(key), x, P, last_id, last_timestamp)
+         for key, (x, P, last_id, last_timestamp) in states.items()],
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO filter_watermarks (filter, source, last_id) VALUES (?, ?, ?)",
+        [(name, source, last_id) for source, last_id in watermarks.items()],
+    )
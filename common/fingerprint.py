@@ -0,0 +1,119 @@
+# RSSI fingerprinting: positions looked up in a radio map instead of computed
+# from the log-distance model, whose constants were tuned for one room.
+#
+# Offline, build_radio_map() turns labelled windows (the filtered RSSI per AP
+# of a tag standing at a surveyed point, e.g. the ground_truth_positions tags)
+# into a radio map: for every set of APs heard, the mean RSSI vector at each
+# surveyed point. It is stored in the radio_map table of the database.
+# Online, RadioMap keeps one scipy.spatial.cKDTree per AP set, and locate()
+# answers a whole batch of windows with one tree query per AP set: the k
+# nearest fingerprints (Euclidean distance in dBm), averaged with
+# inverse-distance weights. Each lookup is O(log n) in the radio map size.
+#
+# Survey and evaluate on different sessions: a radio map built from the
+# recording it is evaluated on matches its own windows.
+
+import json
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+RADIO_MAP_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS radio_map (
+        ap_set TEXT NOT NULL,
+        x REAL NOT NULL,
+        y REAL NOT NULL,
+        rssi TEXT NOT NULL,
+        samples INTEGER NOT NULL,
+        PRIMARY KEY (ap_set, x, y)
+    )
+"""
+
+# Fingerprints averaged per fix
+DEFAULT_K = 3
+
+
+def ap_set_key(aps):
+    """TEXT key of a set of APs: their names, sorted, comma-separated."""
+    return ",".join(sorted(map(str, aps)))
+
+
+def reference_points(conn):
+    """{device_name: (x, y)} of the surveyed tags in ground_truth_positions ({} without the table)."""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='ground_truth_positions'").fetchone() is None:
+        return {}
+    return {name: (x, y) for name, x, y in conn.execute("SELECT device_name, x, y FROM ground_truth_positions")}
+
+
+def build_radio_map(conn, samples):
+    """
+    Replace the radio map of conn with the mean fingerprints of samples:
+    [(ap_rssi {ap name: rssi}, x, y)]. Returns the number of fingerprints.
+    """
+    sums = {}
+    for ap_rssi, x, y in samples:
+        aps = sorted(ap_rssi, key=str)
+        entry = sums.setdefault((ap_set_key(aps), x, y), [np.zeros(len(aps)), 0])
+        entry[0] += [ap_rssi[ap] for ap in aps]
+        entry[1] += 1
+
+    conn.execute(RADIO_MAP_SCHEMA)
+    conn.execute("DELETE FROM radio_map")
+    conn.executemany(
+        "INSERT INTO radio_map (ap_set, x, y, rssi, samples) VALUES (?, ?, ?, ?, ?)",
+        [(ap_set, x, y, json.dumps((total / count).tolist()), count) for (ap_set, x, y), (total, count) in sums.items()],
+    )
+    conn.commit()
+    return len(sums)
+
+
+class RadioMap:
+    """Fingerprints of one database, one k-d tree per AP set."""
+
+    def __init__(self, fingerprints):
+        """fingerprints: {ap_set: [(rssi vector, (x, y))]}"""
+        self.trees = {}
+        for ap_set, entries in fingerprints.items():
+            rssi = np.array([vector for vector, _ in entries], dtype=float)
+            positions = np.array([position for _, position in entries], dtype=float)
+            self.trees[ap_set] = (cKDTree(rssi), positions)
+
+    @classmethod
+    def load(cls, conn):
+        """The radio_map table of conn (empty if it was never built)."""
+        conn.execute(RADIO_MAP_SCHEMA)
+        fingerprints = {}
+        for ap_set, x, y, rssi in conn.execute("SELECT ap_set, x, y, rssi FROM radio_map ORDER BY ap_set, x, y"):
+            fingerprints.setdefault(ap_set, []).append((json.loads(rssi), (x, y)))
+        return cls(fingerprints)
+
+    def __len__(self):
+        return sum(len(positions) for _, positions in self.trees.values())
+
+    def locate(self, windows, k=DEFAULT_K):
+        """
+        Positions of a batch of windows [{ap name: rssi}]: (positions K x 2,
+        located K bool). Windows whose AP set is not in the map are not located.
+        """
+        positions = np.full((len(windows), 2), np.nan)
+        located = np.zeros(len(windows), dtype=bool)
+
+        by_ap_set = {}
+        for index, ap_rssi in enumerate(windows):
+            by_ap_set.setdefault(ap_set_key(ap_rssi), []).append(index)
+
+        for ap_set, indices in by_ap_set.items():
+            if ap_set not in self.trees:
+                continue
+            tree, reference = self.trees[ap_set]
+            aps = ap_set.split(",")
+            names = {str(ap): ap for ap in windows[indices[0]]}
+            queries = np.array([[windows[index][names[ap]] for ap in aps] for index in indices], dtype=float)
+            neighbours = min(k, tree.n)
+            distances, nearest = tree.query(queries, k=neighbours)
+            if neighbours == 1:
+                distances, nearest = distances[:, None], nearest[:, None]
+            weights = 1.0 / (distances + 1e-6)
+            positions[indices] = np.einsum("kn,kni->ki", weights, reference[nearest]) / weights.sum(axis=1)[:, None]
+            located[indices] = True
+        return positions, located
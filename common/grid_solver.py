@@ -0,0 +1,114 @@
+# Grid-likelihood positioning: a fixed amount of work per fix.
+#
+# solve_positions() iterates until each window converges, so the cost of a fix
+# depends on the window, and the ones that do not converge fall back to the
+# linear solution. GridSolver instead discretizes the floor (a bounding box,
+# optionally with a floorplan of walkable cells) into cells and precomputes,
+# once, the cell-to-AP distances and the RSSI the log-distance model expects
+# in every cell. The log-likelihood of a window with Gaussian RSSI noise is
+#
+#   L_g = -sum_j m_j (r_j - E_gj)^2 / (2 sigma^2)
+#       = sum_j (m_j r_j E_gj - m_j E_gj^2 / 2) / sigma^2 + const
+#
+# (m_j = 1 for the APs the window heard), so a batch of K windows is scored
+# against all G cells by one K x 2M by 2M x G matrix product. The fix is the
+# most likely (MAP) cell, refined to sub-cell accuracy by a parabola through
+# its neighbours along each axis.
+
+import math
+
+import numpy as np
+
+# Cell edge (m), and the K x G scores of one matrix product held in memory at
+# most (32 MB of floats): finer grids score fewer windows at a time
+GRID_CELL = 0.1
+GRID_SCORES = 1 << 22
+# RSSI noise (dBm) of the likelihood; it scales the scores, not the MAP cell
+RSSI_SIGMA = 4.0
+# Shortest cell-to-AP distance (m) the model is evaluated at
+MIN_DISTANCE = 0.1
+
+
+class GridSolver:
+    """Likelihood of every floor cell for a fixed set of APs and a log-distance model."""
+
+    def __init__(self, ap_positions, A, n, bounds=None, cell=GRID_CELL, walkable=None, sigma=RSSI_SIGMA):
+        """
+        ap_positions: M x 2 AP coordinates, in the column order of the windows.
+        A, n: RSSI at 1 m and path-loss exponent. bounds: ((x_min, y_min),
+        (x_max, y_max)) of the floor, the APs' bounding box by default.
+        walkable: optional function (x, y arrays) -> bool array of the cells on
+        the floorplan; the others are never chosen.
+        """
+        self.aps = np.asarray(ap_positions, dtype=float).reshape(-1, 2)
+        if bounds is None:
+            bounds = (self.aps.min(axis=0), self.aps.max(axis=0))
+        self.lower, self.upper = np.asarray(bounds[0], dtype=float), np.asarray(bounds[1], dtype=float)
+        extent = self.upper - self.lower
+        self.shape = tuple(max(1, math.ceil(size / cell - 1e-9)) for size in extent)
+        self.step = extent / np.maximum(self.shape, 1)
+
+        # Cell centres, x-major: cell g = ix * ny + iy
+        xs = self.lower[0] + (np.arange(self.shape[0]) + 0.5) * self.step[0]
+        ys = self.lower[1] + (np.arange(self.shape[1]) + 0.5) * self.step[1]
+        self.cells = np.stack(np.meshgrid(xs, ys, indexing="ij"), axis=-1).reshape(-1, 2)
+
+        self.distances = np.linalg.norm(self.cells[:, None, :] - self.aps[None, :, :], axis=2)
+        self.expected = A - 10 * n * np.log10(np.maximum(self.distances, MIN_DISTANCE))
+        self.table = np.vstack([self.expected.T, -0.5 * (self.expected ** 2).T]) / sigma ** 2  # 2M x G
+        self.bias = np.zeros(len(self.cells))
+        self.batch = max(1, GRID_SCORES // len(self.cells))
+        if walkable is not None:
+            self.bias[~np.asarray(walkable(self.cells[:, 0], self.cells[:, 1]), dtype=bool)] = -np.inf
+
+    def __len__(self):
+        return len(self.cells)
+
+    def scores(self, rssi):
+        """
+        Log-likelihood (up to a per-window constant) of every cell: K x G for
+        K x M RSSI, NaN where an AP was not heard.
+        """
+        rssi = np.asarray(rssi, dtype=float).reshape(-1, len(self.aps))
+        heard = np.isfinite(rssi)
+        features = np.hstack([np.where(heard, rssi, 0.0), heard.astype(float)])
+        return features @ self.table + self.bias
+
+    def locate(self, rssi):
+        """
+        Positions of K windows (K x M RSSI, NaN for unheard APs): (positions
+        K x 2, located K bool). Windows without any heard AP are not located.
+        """
+        rssi = np.asarray(rssi, dtype=float).reshape(-1, len(self.aps))
+        positions = np.full((len(rssi), 2), np.nan)
+        located = np.any(np.isfinite(rssi), axis=1)
+        rows = np.flatnonzero(located)
+        for start in range(0, len(rows), self.batch):
+            batch = rows[start:start + self.batch]
+            positions[batch] = self._refine(self.scores(rssi[batch]))
+        return positions, located
+
+    def _refine(self, scores):
+        """
+        MAP cell of every row, moved to the vertex of a parabola through three
+        neighbouring cells on each axis (the two innermost ones at an edge).
+        """
+        best = np.argmax(scores, axis=1)
+        index = np.stack(np.unravel_index(best, self.shape), axis=1)
+        rows = np.arange(len(scores))
+        strides = (self.shape[1], 1)
+
+        offsets = np.zeros((len(scores), 2))
+        for axis in range(2):
+            if self.shape[axis] < 3:
+                continue
+            shift = np.clip(index[:, axis], 1, self.shape[axis] - 2) - index[:, axis]
+            middle = best + shift * strides[axis]
+            s_below, s_centre, s_above = (scores[rows, middle - strides[axis]], scores[rows, middle],
+                                          scores[rows, middle + strides[axis]])
+            curvature = s_below - 2 * s_centre + s_above
+            usable = np.isfinite(s_below) & np.isfinite(s_centre) & np.isfinite(s_above) & (curvature < 0)
+            vertex = shift + 0.5 * (s_below - s_above) / np.where(usable, curvature, -1.0)
+            offsets[:, axis] = np.where(usable, np.clip(vertex, -0.5, 0.5), 0.0)
+
+        return np.clip(self.cells[best] + offsets * self.step, self.lower, self.upper)
@@ -0,0 +1,182 @@
+# Device and AP identity dimension tables.
+#
+# Tags and APs show up under several spellings ("xypi", "RPi_Hybrid_XinYi",
+# "MSStick_BLE_SeeShen", ...). Every spelling is stored once as an alias of a
+# canonical device / access point with a small integer key, so the pipeline can
+# group and join on integers and the alias rules run once per new spelling
+# instead of once per row.
+
+import sqlite3
+
+from schema_version import ensure_schema_migrations, is_applied, mark_applied
+
+IDENTITY_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS devices (
+        device_key INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS device_aliases (
+        alias TEXT PRIMARY KEY,
+        device_key INTEGER NOT NULL REFERENCES devices(device_key)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS access_points (
+        ap_key INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS ap_aliases (
+        alias TEXT PRIMARY KEY,
+        ap_key INTEGER NOT NULL REFERENCES access_points(ap_key)
+    )
+    """,
+]
+
+# Lower-cased AP id -> canonical AP name (the names AP_COORDINATES uses)
+AP_ALIASES = {
+    "xypi": "RPi_AP_XY",
+    "aliciapi": "RPi_AP_Alicia",
+    "enthong": "RPi_AP_EnThong",
+    "pierre": "RPi_AP_Pierre",
+    "rpi_ap_xy": "RPi_AP_XY",
+    "rpi_ap_alicia": "RPi_AP_Alicia",
+    "rpi_ap_enthong": "RPi_AP_EnThong",
+    "rpi_ap_pierre": "RPi_AP_Pierre",
+    "rpi_hybrid_pierre": "RPi_AP_Pierre",
+    "rpi_hybrid_alicia": "RPi_AP_Alicia",
+    "rpi_hybrid_xinyi": "RPi_AP_XY",
+    "rpi_hybrid_xy": "RPi_AP_XY",
+    "rpi_hybrid_enthong": "RPi_AP_EnThong",
+}
+
+
+def canonical_device_name(name):
+    """Canonical tag name: "M5Stick_BLE_Alicia" and "M5StickCPlus-Alicia" both become "M5_Alicia"."""
+    name = name.strip()
+    if "MSStick" in name:
+        name = name.replace("MSStick", "M5Stick")
+    if "_BLE_" in name:
+        base_name = name.split("_BLE_")[-1]
+        if "SeeShen" in base_name:
+            base_name = "KeeShen"
+        return f"M5_{base_name}"
+    if "CPlus-" in name:
+        return f"M5_{name.split('CPlus-')[-1]}"
+    return name
+
+
+def canonical_ap_name(ap_id):
+    """Canonical AP name: "xypi", "RPi_Hybrid_XinYi", ... all become "RPi_AP_XY"."""
+    ap_id = ap_id.strip().lower()
+    return AP_ALIASES.get(ap_id, ap_id)
+
+
+def ensure_identity_tables(conn):
+    for statement in IDENTITY_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+
+class IdentityResolver:
+    """
+    Maps raw device names / AP ids to integer keys.
+
+    All known aliases are loaded once; a new spelling costs one canonicalisation
+    and a couple of INSERTs, every later row is a dict lookup. Use one resolver
+    per connection/thread.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        ensure_identity_tables(conn)
+        self._device_keys = dict(conn.execute("SELECT alias, device_key FROM device_aliases"))
+        self._ap_keys = dict(conn.execute("SELECT alias, ap_key FROM ap_aliases"))
+
+    def device_key(self, device_name):
+        key = self._device_keys.get(device_name)
+        if key is None:
+            key = self._register("devices", "device_key", "device_aliases",
+                                 canonical_device_name(device_name), device_name)
+            self._device_keys[device_name] = key
+        return key
+
+    def ap_key(self, ap_id):
+        key = self._ap_keys.get(ap_id)
+        if key is None:
+            key = self._register("access_points", "ap_key", "ap_aliases",
+                                 canonical_ap_name(ap_id), ap_id)
+            self._ap_keys[ap_id] = key
+        return key
+
+    def _register(self, table, key_column, alias_table, canonical, alias):
+        """
+        Store a new spelling. Raises sqlite3.Error (e.g. database locked) with
+        the transaction rolled back and nothing cached, so a retry starts clean.
+        """
+        try:
+            self.conn.execute(f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", (canonical,))
+            key = self.conn.execute(f"SELECT {key_column} FROM {table} WHERE name = ?", (canonical,)).fetchone()[0]
+            self.conn.execute(f"INSERT OR IGNORE INTO {alias_table} (alias, {key_column}) VALUES (?, ?)", (alias, key))
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        return key
+
+
+def _table_exists(conn, table):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)
+    ).fetchone() is not None
+
+
+def ensure_identity_columns(conn, raw_tables):
+    """
+    Give every raw table integer device_key / ap_key columns and fill them in for
+    rows written without them (older databases). Each distinct spelling is
+    resolved once, then one UPDATE per table; the backfill runs once per table
+    (schema_version.py), since every writer now stores the keys itself.
+    """
+    resolver = IdentityResolver(conn)
+    ensure_schema_migrations(conn)
+    for table in raw_tables:
+        if not _table_exists(conn, table) or is_applied(conn, f"identity:{table}"):
+            continue
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        for column in ("device_key", "ap_key"):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER")
+
+        for (device_name,) in conn.execute(
+            f"SELECT DISTINCT device_name FROM {table} WHERE device_key IS NULL AND device_name IS NOT NULL"
+        ).fetchall():
+            resolver.device_key(device_name)
+        for (ap_id,) in conn.execute(
+            f"SELECT DISTINCT ap_id FROM {table} WHERE ap_key IS NULL AND ap_id IS NOT NULL"
+        ).fetchall():
+            resolver.ap_key(ap_id)
+
+        conn.execute(f"""
+            UPDATE {table} SET
+                device_key = (SELECT device_key FROM device_aliases WHERE alias = {table}.device_name),
+                ap_key = (SELECT ap_key FROM ap_aliases WHERE alias = {table}.ap_id)
+            WHERE device_key IS NULL OR ap_key IS NULL
+        """)
+        mark_applied(conn, f"identity:{table}")
+        conn.commit()
+    return resolver
+
+
+def device_names(conn):
+    """{device_key: canonical name}"""
+    return dict(conn.execute("SELECT device_key, name FROM devices"))
+
+
+def ap_names(conn):
+    """{ap_key: canonical name}"""
+    return dict(conn.execute("SELECT ap_key, name FROM access_points"))
@@ -0,0 +1,185 @@
+# Vectorized bank of scalar Kalman filters for batch RSSI smoothing.
+#
+# Same model as the KalmanFilter class of the filter scripts (random walk,
+# process variance Q, measurement variance R), one filter per key (MAC, or
+# (device, AP, signal) in hybrid mode), but the state of every key lives in
+# NumPy arrays and a whole batch of readings is filtered at once:
+#
+#   P <- P + Q;  K = P / (P + R);  x <- x + K (z - x);  P <- P (1 - K)
+#
+# P and K never depend on the measurements, so from x = -70, P = 1 the gain
+# sequence is the same for every key and P reaches its fixed point after
+# ~770 readings (bit-exact in float64). Until then the keys are stepped
+# together, one array operation per reading index; once a key's P stops
+# changing its gain is constant and the rest of its readings are a first-order
+# IIR filter, which scipy.signal.lfilter runs in C. The transient is
+# bit-identical to the per-row filter; the constant-gain tail agrees to
+# floating-point rounding (~1e-12 dBm).
+
+import numpy as np
+from scipy.signal import lfilter
+
+# Stop stepping a key whose P has not reached its fixed point after this many
+# readings (a float64 P that alternates between two neighbouring values);
+# the gain it then keeps differs from the exact one by ~1 ulp
+MAX_TRANSIENT = 10000
+
+
+class KalmanBank:
+    """
+    Kalman filters for any number of keys. Feed readings with update(keys, rssi);
+    the state of a key carries over between calls, like one KalmanFilter per key.
+    """
+
+    def __init__(self, process_variance=1e-3, measurement_variance=2.0, x=-70.0, P=1.0):
+        self.Q = process_variance
+        self.R = measurement_variance
+        self.x0 = x
+        self.P0 = P
+        self.slots = {}  # key -> index into x / P
+        self.keys = []
+        self.x = np.empty(0)
+        self.P = np.empty(0)
+        self._gains = {}  # starting P -> _gain_sequence()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def _grow(self, new_keys, x, P):
+        for key in new_keys:
+            self.slots[key] = len(self.keys)
+            self.keys.append(key)
+        self.x = np.concatenate([self.x, x])
+        self.P = np.concatenate([self.P, P])
+
+    def _gain_sequence(self, P):
+        """
+        Gains of the readings before P reaches its fixed point, P after each of
+        them, and the gain from then on. Same float operations as the per-row
+        filter, so the gains are bit-identical.
+        """
+        cached = self._gains.get(P)
+        if cached is not None:
+            return cached
+        start = P
+        gains, posteriors = [], []
+        Q, R = self.Q, self.R
+        while True:
+            P_prior = P + Q
+            K = P_prior / (P_prior + R)
+            P_post = P_prior * (1 - K)
+            if P_post == P or len(gains) == MAX_TRANSIENT:
+                break
+            gains.append(K)
+            posteriors.append(P_post)
+            P = P_post
+        cached = self._gains[start] = (np.array(gains), np.array(posteriors), K)
+        return cached
+
+    def load(self, states):
+        """Continue filters from stored state: {key: (x, P)} (e.g. filter_state.load_kalman_states())."""
+        new_keys = [key for key in states if key not in self.slots]
+        self._grow(new_keys, np.full(len(new_keys), self.x0, dtype=float), np.full(len(new_keys), self.P0, dtype=float))
+        for key, (x, P) in states.items():
+            self.x[self.slots[key]] = x
+            self.P[self.slots[key]] = P
+
+    def state(self, key):
+        """(x, P) of one key."""
+        slot = self.slots[key]
+        return float(self.x[slot]), float(self.P[slot])
+
+    def states(self, keys=None):
+        """{key: (x, P)} of the given keys (default: all)."""
+        return {key: self.state(key) for key in (self.keys if keys is None else keys)}
+
+    def slot_ids(self, keys):
+        """Slot index of every key of a batch, creating filters for keys not seen before."""
+        slots = self.slots
+        try:
+            return np.fromiter(map(slots.__getitem__, keys), dtype=np.intp, count=len(keys))
+        except KeyError:
+            pass
+        new_keys = [key for key in dict.fromkeys(keys) if key not in slots]
+        self._grow(new_keys, np.full(len(new_keys), self.x0, dtype=float), np.full(len(new_keys), self.P0, dtype=float))
+        return np.fromiter(map(slots.__getitem__, keys), dtype=np.intp, count=len(keys))
+
+    def update(self, keys, measurements):
+        """
+        Filter a batch: keys[i] is the key of measurements[i]. Readings of the
+        same key are applied in batch order (other keys may be interleaved).
+        Returns the filtered values in batch order.
+        """
+        return self.update_slots(self.slot_ids(keys), measurements)
+
+    def update_slots(self, slots, measurements):
+        """update() with the keys already turned into slot_ids()."""
+        slots = np.asarray(slots, dtype=np.intp)
+        z = np.asarray(measurements, dtype=float)
+        n = len(z)
+        if n == 0:
+            return np.empty(0)
+
+        # Group the batch by key; a stable sort keeps each key's readings in order.
+        # Batches already sorted by key skip it, and small slot numbers sort as
+        # uint8 / uint16, which NumPy radix-sorts.
+        if np.all(slots[1:] >= slots[:-1]):
+            order = None
+        else:
+            sort_keys = slots.astype(np.min_scalar_type(len(self.keys)), copy=False)
+            order = np.argsort(sort_keys, kind="stable")
+            z = z[order]
+        per_slot = np.bincount(slots, minlength=len(self.keys))
+        group_slots = np.flatnonzero(per_slot)
+        counts = per_slot[group_slots]
+        starts = np.cumsum(counts) - counts
+
+        x = self.x[group_slots]
+        P = self.P[group_slots]
+        out = np.empty(n)
+
+        # Keys starting from the same P share one gain sequence (usually P0 for
+        # new keys and the fixed point for everything else)
+        for P_start in np.unique(P):
+            groups = np.flatnonzero(P == P_start)
+            gains, posteriors, steady_gain = self._gain_sequence(P_start)
+
+            # Transient: stepped for all these keys at once, one reading index per step
+            transient = np.minimum(counts[groups], len(gains))
+            steps = int(transient.max())
+            if steps:
+                index = starts[groups][None, :] + np.arange(steps)[:, None]
+                valid = np.arange(steps)[:, None] < transient[None, :]
+                index = np.where(valid, index, starts[groups][None, :])
+                Z = z[index]
+                X = np.empty_like(Z)
+                xs = x[groups]
+                for step in range(steps):
+                    xs = xs + gains[step] * (Z[step] - xs)
+                    X[step] = xs
+                out[index[valid]] = X[valid]
+                stepped = transient > 0
+                last = transient[stepped] - 1
+                x[groups[stepped]] = X[last, np.flatnonzero(stepped)]
+                P[groups[stepped]] = posteriors[last]
+
+            # Steady state, constant gain: x_n = K z_n + (1 - K) x_{n-1}
+            K = steady_gain
+            for group, done in zip(groups, transient):
+                begin, end = starts[group] + done, starts[group] + counts[group]
+                if begin == end:
+                    continue
+                tail, _ = lfilter([K], [1.0, -(1.0 - K)], z[begin:end], zi=[(1.0 - K) * x[group]])
+                out[begin:end] = tail
+                x[group] = tail[-1]
+
+        self.x[group_slots] = x
+        self.P[group_slots] = P
+        if order is None:
+            return out
+        result = np.empty(n)
+        result[order] = out
+        return result
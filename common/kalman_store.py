@@ -0,0 +1,106 @@
+# Bounded Kalman state for long-running processes.
+#
+# A KalmanBank keeps every key it has ever seen. That is what a batch run
+# wants, but a process that runs for days (the hybrid subscriber's streaming
+# fusion) sees thousands of transient tags and would keep all of them.
+# KalmanStateStore is a KalmanBank that only keeps the filters in use:
+# - filters idle for longer than `ttl` seconds are evicted
+# - beyond `max_keys` filters, the least recently used are evicted (LRU)
+# Evicted x and P are checkpointed to kalman_state (filter_state.py), and a key
+# that is not in memory is restored from there, so a returning tag continues
+# from its last state instead of from -70 dBm.
+#
+# Eviction compacts the state arrays, so it runs in sweeps rather than per key:
+# TTL sweeps at most every SWEEP_INTERVAL seconds, and a full store is cut back
+# to LRU_TARGET of max_keys at once.
+
+import time
+
+import numpy as np
+
+from filter_state import checkpoint_kalman_states, ensure_filter_state, load_kalman_states
+from kalman_bank import KalmanBank
+
+# Seconds between two TTL sweeps
+SWEEP_INTERVAL = 10
+# Share of max_keys left after an LRU eviction
+LRU_TARGET = 0.9
+
+
+class KalmanStateStore(KalmanBank):
+    """
+    KalmanBank whose filters are restored from and evicted to the kalman_state
+    rows of filter `name`. max_keys and ttl (seconds) bound the filters kept in
+    memory; None disables that bound (then only restoring happens). Drop-in for
+    KalmanBank: update(keys, rssi) returns the same values as a bank that had
+    kept every key.
+    """
+
+    def __init__(self, conn, name, max_keys=None, ttl=None, **kalman_params):
+        super().__init__(**kalman_params)
+        self.conn = conn
+        self.name = name
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.last_used = np.empty(0)  # Per slot, time of the last update()
+        self.last_sweep = time.time()
+        self.restored = 0
+        self.evicted = 0
+        ensure_filter_state(conn)
+
+    def _grow(self, new_keys, x, P):
+        super()._grow(new_keys, x, P)
+        self.last_used = np.concatenate([self.last_used, np.full(len(new_keys), time.time())])
+
+    def slot_ids(self, keys):
+        """Slot index of every key of a batch, restoring or creating the filters not in memory."""
+        slots = self.slots
+        missing = [key for key in dict.fromkeys(keys) if key not in slots]
+        if missing:
+            states = load_kalman_states(self.conn, self.name, missing)
+            self.load(states)
+            self.restored += len(states)
+        return super().slot_ids(keys)
+
+    def update(self, keys, measurements, now=None):
+        """KalmanBank.update(); afterwards, evicts whatever is over the bounds."""
+        now = time.time() if now is None else now
+        slots = self.slot_ids(keys)
+        filtered = self.update_slots(slots, measurements)
+        self.last_used[slots] = now
+        self.evict(now)
+        return filtered
+
+    def evict(self, now=None):
+        """Checkpoint and drop the filters idle past the TTL or, least recently used first, over max_keys."""
+        now = time.time() if now is None else now
+        evicted = np.zeros(len(self.keys), dtype=bool)
+        if self.ttl is not None and now - self.last_sweep >= SWEEP_INTERVAL:
+            self.last_sweep = now
+            evicted |= self.last_used < now - self.ttl
+        if self.max_keys is not None and len(self.keys) - evicted.sum() > self.max_keys:
+            kept = np.flatnonzero(~evicted)
+            oldest_first = kept[np.argsort(self.last_used[kept], kind="stable")]
+            evicted[oldest_first[:len(kept) - int(self.max_keys * LRU_TARGET)]] = True
+        if not evicted.any():
+            return 0
+
+        slots = np.flatnonzero(evicted)
+        checkpoint_kalman_states(self.conn, self.name, self.states([self.keys[slot] for slot in slots]))
+        self.conn.commit()
+        kept = ~evicted
+        self.keys = [key for key, keep in zip(self.keys, kept.tolist()) if keep]
+        self.slots = {key: slot for slot, key in enumerate(self.keys)}
+        self.x = self.x[kept]
+        self.P = self.P[kept]
+        self.last_used = self.last_used[kept]
+        self.evicted += len(slots)
+        return len(slots)
+
+    def checkpoint(self):
+        """Store the state of every filter in memory (e.g. at shutdown), keeping them loaded."""
+        checkpoint_kalman_states(self.conn, self.name, self.states())
+        self.conn.commit()
+
+    def stats(self):
+        return {"filters": len(self.keys), "restored": self.restored, "evicted": self.evicted}
@@ -0,0 +1,266 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Minimal Prometheus-style metrics for the ingestion processes: counters, gauges
+# and fixed-bucket histograms, rendered in the Prometheus text format and served
+# on a small local HTTP port (curl http://localhost:9100/metrics, or scrape it).
+# Histograms also expose p50/p95/p99 estimated from their buckets, and counters
+# a per-second rate since the previous scrape, so the endpoint is readable
+# without a Prometheus server.
+
+# Publisher -> subscriber latency, seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# SQLite insert + commit time, seconds
+COMMIT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        self._last_values = {}
+        self._last_time = time.monotonic()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        if not self.label_names and not values:
+            values[()] = 0  # Unlabelled counters read 0 before their first increment
+        now = time.monotonic()
+        elapsed = max(now - self._last_time, 1e-9)
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, label_values)} {value}")
+        rate_name = self.name[:-len("_total")] if self.name.endswith("_total") else self.name
+        lines.append(f"# HELP {rate_name}_per_second {self.help_text} per second since the previous scrape")
+        lines.append(f"# TYPE {rate_name}_per_second gauge")
+        for label_values, value in sorted(values.items()):
+            rate = (value - self._last_values.get(label_values, 0)) / elapsed
+            lines.append(f"{rate_name}_per_second{_labels(self.label_names, label_values)} {rate:.3f}")
+        self._last_values = values
+        self._last_time = now
+        return lines
+
+
+class Gauge:
+    """
+    A gauge that is set explicitly, or read from `function` at scrape time.
+    With labels, `function` returns {label values tuple: value}.
+    """
+
+    def __init__(self, name, help_text, function=None, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+        self.label_names = tuple(labels)
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def render(self):
+        value = self.function() if self.function is not None else self._value
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        if not self.label_names:
+            return lines + [f"{self.name} {value}"]
+        for label_values, series_value in sorted(value.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, label_values)} {series_value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(labels)
+        self._series = {}  # label values -> [bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def _get_series(self, label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        return series
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._get_series(label_values)
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def observe_many(self, values, *label_values):
+        buckets = self.buckets
+        indexes = [bisect.bisect_left(buckets, value) for value in values]
+        with self._lock:
+            series = self._get_series(label_values)
+            counts = series[0]
+            for index in indexes:
+                counts[index] += 1
+            series[1] += sum(values)
+            series[2] += len(indexes)
+
+    def quantile(self, q, *label_values):
+        """Estimate of the q-quantile, interpolating linearly inside the bucket it falls in."""
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None or series[2] == 0:
+                return None
+            counts = list(series[0])
+            total = series[2]
+        rank = q * total
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]  # Beyond the last finite bucket
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def render(self):
+        with self._lock:
+            series = {labels: (list(s[0]), s[1], s[2]) for labels, s in self._series.items()}
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total_sum, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, label_values, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, label_values)} {total_sum}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, label_values)} {count}")
+
+        lines.append(f"# HELP {self.name}_quantile {self.help_text} (p50/p95/p99 estimated from the buckets)")
+        lines.append(f"# TYPE {self.name}_quantile gauge")
+        for label_values in sorted(series):
+            for q in QUANTILES:
+                value = self.quantile(q, *label_values)
+                if value is not None:
+                    lines.append(f"{self.name}_quantile{_labels(self.label_names, label_values, ('quantile', q))} {value:.6f}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, function=None, labels=()):
+        return self._add(Gauge(name, help_text, function, labels))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, labels=()):
+        return self._add(Histogram(name, help_text, buckets, labels))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def start_http_server(registry, port, host="127.0.0.1"):
+    """Serve registry.render() at http://host:port/metrics from a daemon thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Keep scrapes out of the subscriber's console output
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return server
+
+
+class IngestMetrics:
+    """The metric set every ingestion process reports."""
+
+    def __init__(self, registry=None, queue_depth=None):
+        self.registry = registry or MetricsRegistry()
+        self.messages = self.registry.counter(
+            "ingest_messages_total", "MQTT messages received", labels=("topic",))
+        self.readings = self.registry.counter(
+            "ingest_readings_total", "Readings decoded", labels=("topic", "ap_id"))
+        self.decode_errors = self.registry.counter(
+            "ingest_decode_errors_total", "Messages that could not be decoded", labels=("topic",))
+        self.dropped = self.registry.counter(
+            "ingest_dropped_readings_total", "Readings dropped because the write queue was full")
+        self.key_errors = self.registry.counter(
+            "ingest_key_errors_total", "Messages dropped because a device/AP key could not be stored",
+            labels=("topic",))
+        self.rows_written = self.registry.counter(
+            "ingest_rows_written_total", "Rows committed to SQLite", labels=("table",))
+        self.commit_seconds = self.registry.histogram(
+            "ingest_commit_seconds", "SQLite insert + commit time per batch", buckets=COMMIT_BUCKETS)
+        self.latency_seconds = self.registry.histogram(
+            "ingest_publish_latency_seconds", "Publisher to subscriber latency", buckets=LATENCY_BUCKETS)
+        if queue_depth is not None:
+            self.track_queue_depth(queue_depth)
+
+    def track_queue_depth(self, function):
+        self.registry.gauge("ingest_queue_depth", "Items waiting to be written", function)
+
+    def track_clock(self, clock):
+        """Per-publisher clock offset, drift and round trip of a clock_sync.ClockSync."""
+        def series(field, scale):
+            return lambda: {(sender,): getattr(estimator, field) * scale
+                            for sender, estimator in list(clock.estimators.items())
+                            if estimator.offset is not None}
+
+        self.registry.gauge("ingest_clock_offset_seconds", "Publisher clock minus ingest host clock",
+                            series("offset", 1), labels=("sender",))
+        self.registry.gauge("ingest_clock_drift_ppm", "Publisher clock drift relative to the ingest host",
+                            series("drift", 1e6), labels=("sender",))
+        self.registry.gauge("ingest_clock_delay_seconds", "Round trip of the best clock ping",
+                            series("delay", 1), labels=("sender",))
+
+    def serve(self, port, host="127.0.0.1"):
+        return start_http_server(self.registry, port, host)
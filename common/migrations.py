@@ -0,0 +1,115 @@
+# Index migrations for the filter and estimator query paths.
+#
+# The filtered tables are dropped and rebuilt by every full filter run, so the
+# migration is idempotent and the filters apply it right after creating their
+# tables. Raw tables get their (run_id, timestamp) index from run_storage.py;
+# their key-range indexes are created by the parallel backfills that read by MAC
+# or (device, AP) range (or by --db), not by every filter run.
+# Tables of older databases first get their integer ts_ms column (epoch_time.py),
+# which the estimators' windows and most of these indexes are on.
+#
+# Apply to a database:          python migrations.py --db ../BLE_only/positioning.db
+#
+# tests/test_query_plans.py runs the filters' and estimators' own SQL through
+# EXPLAIN QUERY PLAN on copies of the shipped databases and asserts the index
+# each query reads, so a query change cannot silently lose its index.
+
+import argparse
+import sqlite3
+
+from epoch_time import ensure_epoch_columns
+
+# table -> [(index name, columns)]. An index is skipped when an existing one
+# (e.g. the UNIQUE autoindex) already starts with the same columns.
+INDEXES = {
+    "filtered_rssi": [
+        ("idx_filtered_rssi_mac_ts", ("mac", "timestamp")),
+        ("idx_filtered_rssi_device_ts", ("device_name", "timestamp")),
+        # Probe side of the raw -> filtered anti-join; the UNIQUE constraint usually provides it
+        ("idx_filtered_rssi_ts_ap_mac", ("timestamp", "ap_id", "mac")),
+        # The estimator reads in event-time order
+        ("idx_filtered_rssi_ms_ap_mac", ("ts_ms", "ap_id", "mac")),
+    ],
+    "wifi_filtered_rssi": [
+        ("idx_wifi_filtered_rssi_mac_ts", ("mac", "timestamp")),
+        # Covering for the anti-join, which also matches device_name
+        ("idx_wifi_filtered_rssi_ts_ap_mac", ("timestamp", "ap_id", "mac", "device_name")),
+        # The estimator reads in event-time order
+        ("idx_wifi_filtered_rssi_ms_ap_mac", ("ts_ms", "ap_id", "mac", "device_name")),
+    ],
+    # One MAC / (device, AP) range of a run per parallel backfill task, each key's rows in time order
+    "ble_rssi": [
+        ("idx_ble_rssi_run_mac", ("run_id", "mac", "timestamp")),
+        ("idx_ble_rssi_run_keys", ("run_id", "device_key", "ap_key", "timestamp")),
+    ],
+    "wifi_rssi": [
+        ("idx_wifi_rssi_run_mac", ("run_id", "mac", "timestamp")),
+        ("idx_wifi_rssi_run_keys", ("run_id", "device_key", "ap_key", "timestamp")),
+    ],
+    "hybrid_filtered_rssi": [
+        # Covering for the estimator's per-device read
+        ("idx_hybrid_filtered_rssi_device_ms", ("device_key", "ts_ms", "ap_key", "filtered_rssi")),
+    ],
+}
+
+# Tables that carry an integer ts_ms next to their TEXT timestamp
+EPOCH_TABLES = [
+    "ble_rssi", "wifi_rssi",
+    "filtered_rssi", "wifi_filtered_rssi", "hybrid_filtered_rssi",
+    "estimated_positions", "wifi_estimated_positions", "hybrid_estimated_positions",
+]
+
+
+def _table_exists(conn, table):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)
+    ).fetchone() is not None
+
+
+def _index_columns(conn, table):
+    """{index name: (columns...)} of a table, autoindexes included."""
+    indexes = {}
+    for row in conn.execute(f"PRAGMA index_list({table})").fetchall():
+        name = row[1]
+        indexes[name] = tuple(info[2] for info in conn.execute(f"PRAGMA index_info({name})"))
+    return indexes
+
+
+def migrate(conn, tables=None, indexes=None):
+    """
+    Add and backfill ts_ms, then create the missing indexes (only those named
+    in `indexes`, if given), on whichever of `tables` exist (default: all of
+    them); returns the names of the indexes created.
+    """
+    tables = tables or EPOCH_TABLES
+    ensure_epoch_columns(conn, [table for table in tables if table in EPOCH_TABLES])
+    created = []
+    for table in tables:
+        if table not in INDEXES or not _table_exists(conn, table):
+            continue
+        existing = _index_columns(conn, table)
+        table_columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, columns in INDEXES[table]:
+            if indexes is not None and name not in indexes:
+                continue
+            if name in existing or not table_columns.issuperset(columns):
+                continue  # Present, or an older table layout the query does not run on
+            if any(cols[:len(columns)] == columns for cols in existing.values()):
+                continue  # Already served by another index
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+            existing[name] = columns
+            created.append(name)
+    conn.commit()
+    return created
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add ts_ms and create the filter/estimator indexes.")
+    parser.add_argument("--db", action="append", required=True, help="Database to migrate (repeatable)")
+    args = parser.parse_args()
+
+    for database in args.db:
+        conn = sqlite3.connect(database)
+        created = migrate(conn)
+        conn.close()
+        print(f"{database}: {', '.join(created) if created else 'up to date'}")
@@ -0,0 +1,77 @@
+# Parallel backfill of the RSSI filters.
+#
+# Kalman filtering is independent per key (MAC, or (device, AP) in hybrid
+# mode), so a full filter run can be split into contiguous key ranges and each
+# range filtered in its own process. Workers only read: each opens its own
+# connection, reads its range in chunks and returns the filtered rows. Every
+# insert goes through one connection in the parent process (SQLite allows a
+# single writer anyway), committed range by range as workers finish. The
+# database is switched to WAL so those commits and the workers' reads do not
+# lock each other out.
+#
+# The filters expose this as --workers / --chunk-size; see
+# benchmarks/benchmark_parallel_filter.py for how it scales.
+
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Raw rows a worker fetches from SQLite at a time
+DEFAULT_CHUNK_SIZE = 50000
+# Key ranges per worker: smaller tasks even out busy and quiet tags, and the
+# writer can start on the first results while the rest are still filtering
+RANGES_PER_WORKER = 4
+
+
+def key_ranges(key_counts, partitions):
+    """
+    Split [(key, rows)], sorted by key, into at most `partitions` contiguous
+    (first key, last key) ranges with roughly the same number of rows each.
+    """
+    total = sum(count for _, count in key_counts)
+    if not total:
+        return []
+    target = total / max(1, partitions)
+    ranges = []
+    first = None
+    seen = 0
+    for key, count in key_counts:
+        if first is None:
+            first = key
+        seen += count
+        if seen >= target * (len(ranges) + 1):
+            ranges.append((first, key))
+            first = None
+    if first is not None:
+        ranges.append((first, key_counts[-1][0]))
+    return ranges
+
+
+def fetch_chunks(cursor, chunk_size=DEFAULT_CHUNK_SIZE):
+    """The rows of an executed cursor, chunk_size at a time."""
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def open_writer(database):
+    """The connection that does every insert; call it before starting the workers."""
+    conn = sqlite3.connect(database, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def run_partitioned(task, args, ranges, workers, write):
+    """
+    Call task(*args, first, last) for every key range on a pool of `workers`
+    processes. write(rows) runs in this process with each range's result as
+    soon as it is ready, so one connection does all the writing. Returns the
+    sum of what write() returned.
+    """
+    written = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(task, *args, first, last) for first, last in ranges]
+        for future in as_completed(futures):
+            written += write(future.result())
+    return written
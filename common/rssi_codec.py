@@ -0,0 +1,238 @@
+import json
+import struct
+import time
+
+# === Compact binary RSSI payload ===
+# JSON payloads always start with '{' (0x7B), so a first byte >= 0x80 marks a
+# binary payload and its value doubles as the format version.
+BINARY_READING_V1 = 0xA1
+BINARY_BATCH_V1 = 0xA2
+
+# Dictionary codes for device names and AP ids: the code is the list index
+# (0 is reserved). These lists are APPEND-ONLY. Never reorder or remove an
+# entry, or senders flashed with the old table will decode to the wrong name.
+DEVICE_NAMES = [
+    None,
+    "M5Stick_BLE_Alicia",
+    "M5Stick_BLE_KeeShen",
+    "M5Stick_BLE_EnThong",
+    "M5Stick_BLE_XinYi",
+    "M5Stick_BLE_Pierre",
+    "M5StickCPlus-Alicia",
+    "M5StickCPlus-KeeShen",
+    "M5StickCPlus-Enthong",
+    "M5StickCPlus-EnThong",
+    "M5StickCPlus-XinYi",
+    "M5StickCPlus-Pierre",
+]
+
+AP_NAMES = [
+    None,
+    "aliciapi",
+    "xypi",
+    "enthong",
+    "pierre",
+    "RPi_AP_Alicia",
+    "RPi_AP_XY",
+    "RPi_AP_EnThong",
+    "RPi_AP_Pierre",
+    "RPi_Hybrid_Alicia",
+    "RPi_Hybrid_XY",
+    "RPi_Hybrid_XinYi",
+    "RPi_Hybrid_EnThong",
+    "RPi_Hybrid_Pierre",
+]
+
+DEVICE_CODES = {name: code for code, name in enumerate(DEVICE_NAMES) if name}
+AP_CODES = {name: code for code, name in enumerate(AP_NAMES) if name}
+
+# Flag bits
+FLAG_MAC_UPPER = 0x01  # WiFi BSSIDs are reported upper-case, BLE MACs lower-case
+
+# header, flags, ap code, device code, mac (6 raw bytes), rssi, timestamp_epoch
+# 20 bytes per reading versus ~170 for the JSON object.
+READING_V1 = struct.Struct("<BBBH6sbd")
+
+# Per-scan batch: one header for the AP and scan time, then `count` readings.
+# 13 + 9 bytes per reading.
+# header, flags, ap code, scan timestamp_epoch, count
+BATCH_HEADER_V1 = struct.Struct("<BBBdH")
+# device code, mac (6 raw bytes), rssi
+BATCH_READING_V1 = struct.Struct("<H6sb")
+
+# (second, formatted) of the last timestamp, swapped as one tuple so that
+# concurrent callers never see a mismatched pair
+_last_formatted = (None, None)
+
+
+def format_timestamp(timestamp_epoch):
+    """Epoch seconds -> "%Y-%m-%d %H:%M:%S" local time, cached per second."""
+    global _last_formatted
+    second = int(timestamp_epoch)
+    cached_second, cached = _last_formatted
+    if second != cached_second:
+        cached = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        _last_formatted = (second, cached)
+    return cached
+
+
+def encode_reading(timestamp_epoch, ap_id, mac, device_name, rssi):
+    """
+    Pack one reading into the v1 binary format.
+
+    Returns None when the reading cannot be dictionary-coded (unknown device or
+    AP, malformed MAC); callers should then publish JSON instead.
+    """
+    ap_code = AP_CODES.get(ap_id)
+    device_code = DEVICE_CODES.get(device_name)
+    if ap_code is None or device_code is None:
+        return None
+    try:
+        mac_raw = bytes.fromhex(mac.replace(":", ""))
+    except ValueError:
+        return None
+    if len(mac_raw) != 6:
+        return None
+    flags = FLAG_MAC_UPPER if mac.isupper() else 0
+    return READING_V1.pack(BINARY_READING_V1, flags, ap_code, device_code, mac_raw,
+                           max(-128, min(127, int(rssi))), float(timestamp_epoch))
+
+
+def encode_batch(timestamp_epoch, ap_id, readings):
+    """
+    Pack every reading from one scan into a single v1 batch payload.
+
+    readings: [(mac, device_name, rssi), ...], all seen by ap_id at timestamp_epoch.
+
+    Returns (payload, rejected) where rejected lists the readings that could not
+    be dictionary-coded and should be published as JSON. payload is None if
+    nothing could be packed.
+    """
+    ap_code = AP_CODES.get(ap_id)
+    if ap_code is None or not readings:
+        return None, list(readings)
+
+    mac_upper = readings[0][0].isupper()
+    body = []
+    rejected = []
+    for mac, device_name, rssi in readings:
+        device_code = DEVICE_CODES.get(device_name)
+        try:
+            mac_raw = bytes.fromhex(mac.replace(":", ""))
+        except ValueError:
+            mac_raw = b""
+        if device_code is None or len(mac_raw) != 6 or mac.isupper() != mac_upper:
+            rejected.append((mac, device_name, rssi))
+            continue
+        body.append(BATCH_READING_V1.pack(device_code, mac_raw, max(-128, min(127, int(rssi)))))
+
+    if not body:
+        return None, rejected
+    flags = FLAG_MAC_UPPER if mac_upper else 0
+    header = BATCH_HEADER_V1.pack(BINARY_BATCH_V1, flags, ap_code, float(timestamp_epoch), len(body))
+    return header + b"".join(body), rejected
+
+
+def encode_json_reading(timestamp_epoch, ap_id, mac, device_name, rssi):
+    """The original JSON payload, still accepted by every subscriber."""
+    return json.dumps({
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp_epoch)),
+        "timestamp_epoch": timestamp_epoch,
+        "ap_id": ap_id,
+        "mac_address": mac,
+        "device_name": device_name,
+        "rssi": rssi
+    })
+
+
+def is_binary(payload):
+    return len(payload) > 0 and payload[0] >= 0x80
+
+
+def decode_reading(payload):
+    """
+    Decode one MQTT payload, binary or JSON.
+
+    Returns (timestamp, timestamp_epoch, ap_id, mac, device_name, rssi), or None
+    if a JSON payload is missing required fields. timestamp/timestamp_epoch may
+    be None for JSON senders that omit them. Raises ValueError for payloads that
+    cannot be decoded at all.
+    """
+    if is_binary(payload):
+        if payload[0] == BINARY_READING_V1:
+            return _decode_reading_v1(payload, 0)
+        raise ValueError(f"Unknown binary payload version 0x{payload[0]:02x}")
+    return _decode_json_reading(payload)
+
+
+def decode_readings(payload):
+    """
+    Decode one MQTT payload that may carry several readings (a per-scan batch).
+
+    Returns a list of (timestamp, timestamp_epoch, ap_id, mac, device_name, rssi)
+    tuples; empty if a JSON payload is missing required fields. Raises
+    ValueError for payloads that cannot be decoded at all.
+    """
+    if is_binary(payload) and payload[0] == BINARY_BATCH_V1:
+        return _decode_batch_v1(payload)
+    reading = decode_reading(payload)
+    return [reading] if reading is not None else []
+
+
+def _decode_batch_v1(payload):
+    view = memoryview(payload)
+    try:
+        _, flags, ap_code, timestamp_epoch, count = BATCH_HEADER_V1.unpack_from(view, 0)
+        ap_id = AP_NAMES[ap_code]
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"Malformed binary batch: {e}")
+    if ap_id is None:
+        raise ValueError("Binary batch uses reserved AP code 0")
+    if len(view) != BATCH_HEADER_V1.size + count * BATCH_READING_V1.size:
+        raise ValueError(f"Binary batch length {len(view)} does not match {count} readings")
+
+    timestamp = format_timestamp(timestamp_epoch)
+    mac_upper = flags & FLAG_MAC_UPPER
+    readings = []
+    for device_code, mac_raw, rssi in BATCH_READING_V1.iter_unpack(view[BATCH_HEADER_V1.size:]):
+        if device_code >= len(DEVICE_NAMES) or device_code == 0:
+            raise ValueError(f"Binary batch uses unknown device code {device_code}")
+        mac = mac_raw.hex(":")
+        if mac_upper:
+            mac = mac.upper()
+        readings.append((timestamp, timestamp_epoch, ap_id, mac, DEVICE_NAMES[device_code], rssi))
+    return readings
+
+
+def _decode_reading_v1(payload, offset):
+    try:
+        _, flags, ap_code, device_code, mac_raw, rssi, timestamp_epoch = READING_V1.unpack_from(payload, offset)
+        ap_id = AP_NAMES[ap_code]
+        device_name = DEVICE_NAMES[device_code]
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"Malformed binary reading: {e}")
+    if ap_id is None or device_name is None:
+        raise ValueError("Binary reading uses reserved code 0")
+    mac = mac_raw.hex(":")
+    if flags & FLAG_MAC_UPPER:
+        mac = mac.upper()
+    return (format_timestamp(timestamp_epoch), timestamp_epoch, ap_id, mac, device_name, rssi)
+
+
+def _decode_json_reading(payload):
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        payload = bytes(payload).decode()
+    data = json.loads(payload)
+    if not isinstance(data, dict):
+        return None
+    if "mac_address" not in data or "device_name" not in data or "rssi" not in data:
+        return None
+    try:
+        timestamp_epoch = data.get("timestamp_epoch")
+        if timestamp_epoch is not None:
+            timestamp_epoch = float(timestamp_epoch)
+        rssi = int(data["rssi"])
+    except (TypeError, ValueError):
+        return None
+    return (data.get("timestamp"), timestamp_epoch, data.get("ap_id", "Unknown"),
+            data["mac_address"], data["device_name"], rssi)
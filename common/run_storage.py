@@ -0,0 +1,117 @@
+import sqlite3
+import threading
+import time
+
+# Every raw reading is stamped with the run (one subscriber session) it was
+# recorded in. Starting a subscriber just opens a new run instead of wiping
+# the raw tables, old runs stay queryable, and expire_runs() drops the oldest
+# ones in the background once there are more than the retention limit.
+
+RUNS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    started_at TEXT,
+    source TEXT
+)
+"""
+
+# Rows recorded before run partitioning existed belong to run 0
+LEGACY_RUN_ID = 0
+
+DEFAULT_KEEP_RUNS = 10
+
+
+def _table_exists(conn, table):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)
+    ).fetchone() is not None
+
+
+def ensure_run_partitioning(conn, raw_tables):
+    """
+    Make sure the runs table exists and every existing raw table has an
+    indexed run_id column. Adding the column is O(1) in SQLite (constant
+    default, no table rewrite); older rows become the legacy run 0.
+    """
+    conn.execute(RUNS_SCHEMA)
+    has_legacy_rows = False
+    for table in raw_tables:
+        if not _table_exists(conn, table):
+            continue
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if "run_id" not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN run_id INTEGER NOT NULL DEFAULT {LEGACY_RUN_ID}")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_run ON {table}(run_id, timestamp)")
+        if conn.execute(f"SELECT 1 FROM {table} WHERE run_id = ? LIMIT 1", (LEGACY_RUN_ID,)).fetchone():
+            has_legacy_rows = True
+
+    if has_legacy_rows:
+        conn.execute(
+            "INSERT OR IGNORE INTO runs (run_id, started_at, source) VALUES (?, NULL, 'legacy')",
+            (LEGACY_RUN_ID,)
+        )
+    conn.commit()
+
+
+def start_run(conn, source):
+    """Open a new run and return its id. O(1): nothing is deleted."""
+    cursor = conn.execute(
+        "INSERT INTO runs (started_at, source) VALUES (?, ?)",
+        (time.strftime("%Y-%m-%d %H:%M:%S"), source)
+    )
+    conn.commit()
+    return cursor.lastrowid
+
+
+def current_run_id(conn):
+    """Latest run in the database (the legacy run 0 if runs were never started)."""
+    if not _table_exists(conn, "runs"):
+        return LEGACY_RUN_ID
+    row = conn.execute("SELECT MAX(run_id) FROM runs").fetchone()
+    return row[0] if row and row[0] is not None else LEGACY_RUN_ID
+
+
+def expire_runs(database, raw_tables, keep_runs=DEFAULT_KEEP_RUNS, chunk_size=5000):
+    """
+    Delete every run except the newest keep_runs. Rows are removed in small
+    chunks through the run_id index so a live subscriber is never locked out
+    for long. Returns the expired run ids.
+    """
+    conn = sqlite3.connect(database, timeout=30)
+    try:
+        expired = [row[0] for row in conn.execute(
+            "SELECT run_id FROM runs ORDER BY run_id DESC LIMIT -1 OFFSET ?", (keep_runs,)
+        )]
+        for run_id in expired:
+            for table in raw_tables:
+                if not _table_exists(conn, table):
+                    continue
+                while True:
+                    cursor = conn.execute(
+                        f"DELETE FROM {table} WHERE rowid IN "
+                        f"(SELECT rowid FROM {table} WHERE run_id = ? LIMIT ?)",
+                        (run_id, chunk_size)
+                    )
+                    conn.commit()
+                    if cursor.rowcount < chunk_size:
+                        break
+            conn.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+            conn.commit()
+        return expired
+    finally:
+        conn.close()
+
+
+def expire_runs_in_background(database, raw_tables, keep_runs=DEFAULT_KEEP_RUNS):
+    """Run expire_runs() on a daemon thread so start-up never waits on it."""
+    def _run():
+        try:
+            expired = expire_runs(database, raw_tables, keep_runs)
+            if expired:
+                print(f"Retention: removed runs {expired}")
+        except sqlite3.Error as e:
+            print(f"Retention failed: {e}")
+
+    thread = threading.Thread(target=_run, name="run-retention", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,30 @@
+# One-off data migrations of a database, recorded so they run once.
+#
+# Backfills such as ts_ms (epoch_time.py) or device_key / ap_key (identity.py)
+# are full-table UPDATEs. Running them on every subscriber or ingest start made
+# each restart cost the table size again, although every current writer stores
+# those columns itself. Each backfill is now recorded in schema_migrations under
+# a name like "ts_ms:ble_rssi", in the same transaction as its UPDATE, and is
+# skipped once recorded: a crash before the commit leaves it to run again, and
+# a start after it costs one primary-key lookup per table.
+
+SCHEMA_MIGRATIONS_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        name TEXT PRIMARY KEY,
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+def ensure_schema_migrations(conn):
+    conn.execute(SCHEMA_MIGRATIONS_SQL)
+    conn.commit()
+
+
+def is_applied(conn, name):
+    return conn.execute("SELECT 1 FROM schema_migrations WHERE name = ?", (name,)).fetchone() is not None
+
+
+def mark_applied(conn, name):
+    """Record a migration; the caller commits, together with its changes."""
+    conn.execute("INSERT OR IGNORE INTO schema_migrations (name) VALUES (?)", (name,))
@@ -0,0 +1,91 @@
+import glob
+import os
+import sqlite3
+
+# Read side of sharded ingestion (ingestion/sharded_ingest.py).
+#
+# positioning.db stays the catalog (runs, devices, access points, filtered and
+# estimated tables); raw readings live in positioning.shard0.db,
+# positioning.shard1.db, ... connect() attaches the shards and puts a TEMP view
+# in front of each raw table, so the filter queries read every shard (plus any
+# rows still in the catalog itself) without knowing the data is split.
+
+RAW_TABLES = ["ble_rssi", "wifi_rssi"]
+
+# SQLite's default SQLITE_MAX_ATTACHED
+MAX_SHARDS = 10
+
+
+def shard_path(database, shard):
+    stem, ext = os.path.splitext(database)
+    return f"{stem}.shard{shard}{ext or '.db'}"
+
+
+def shard_paths(database):
+    """Existing shard files of a catalog database, in shard order."""
+    stem, ext = os.path.splitext(database)
+    paths = glob.glob(f"{glob.escape(stem)}.shard*{ext or '.db'}")
+    suffix = ext or ".db"
+
+    def shard_number(path):
+        number = path[len(stem) + len(".shard"):-len(suffix)]
+        return int(number) if number.isdigit() else -1
+
+    return sorted((p for p in paths if shard_number(p) >= 0), key=shard_number)
+
+
+def _tables(conn, schema):
+    return {row[0] for row in conn.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type='table'")}
+
+
+def raw_sources(conn, table):
+    """
+    Physical copies of a raw table behind a connect() connection, each with its
+    own id sequence: [(source, "main.<table>"), (source, "shardN.<table>"), ...].
+    source is "main" or the shard's file name, which stays the same however
+    the shards happen to be attached.
+    """
+    sources = []
+    for _, schema, path in conn.execute("PRAGMA database_list").fetchall():
+        if schema == "temp" or table not in _tables(conn, schema):
+            continue
+        source = "main" if schema == "main" else os.path.basename(path)
+        sources.append((source, f"{schema}.{table}"))
+    return sources
+
+
+def connect(database, raw_tables=RAW_TABLES):
+    """
+    Connection to the catalog where each raw table reads across all shards.
+    Without shard files this is a plain sqlite3.connect(). Use it for reading
+    raw tables; create tables and indexes through a plain connection.
+    """
+    conn = sqlite3.connect(database)
+    paths = shard_paths(database)[:MAX_SHARDS]
+    if not paths:
+        return conn
+
+    schemas = []
+    for i, path in enumerate(paths):
+        conn.execute(f"ATTACH DATABASE ? AS shard{i}", (path,))
+        schemas.append(f"shard{i}")
+
+    main_tables = _tables(conn, "main")
+    for table in raw_tables:
+        sources = [f"main.{table}"] if table in main_tables else []
+        sources += [f"{schema}.{table}" for schema in schemas if table in _tables(conn, schema)]
+        if not sources:
+            continue
+        source_columns = {
+            source: [row[1] for row in conn.execute(f"PRAGMA {source.split('.')[0]}.table_info({table})")]
+            for source in sources
+        }
+        columns = source_columns[sources[-1]]
+        # Older catalog tables may lack newer columns (e.g. device_key); those read as NULL.
+        # SQLite pushes WHERE run_id = ? into every branch, so each shard uses its own index.
+        branches = []
+        for source in sources:
+            select = ", ".join(c if c in source_columns[source] else f"NULL AS {c}" for c in columns)
+            branches.append(f"SELECT {select} FROM {source}")
+        conn.execute(f"CREATE TEMP VIEW {table} AS " + " UNION ALL ".join(branches))
+    return conn
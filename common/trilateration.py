@@ -0,0 +1,305 @@
+# Batch trilateration: every window of every device solved at once.
+#
+# The estimators used to call scipy.optimize.least_squares once per window,
+# through a Python closure, which dominates a long replay. solve_positions()
+# minimizes the same weighted range residuals
+#
+#   r_i = w_i (|p - ap_i| - d_i),  w_i = 1 / (d_i + 0.1)
+#
+# for K windows in NumPy arrays: a damped (Levenberg-Marquardt) step inside a
+# trust radius on all unfinished windows at once, with the 2x2 system solved in
+# closed form. loss="soft_l1" is the robust loss of least_squares (f_scale 1).
+# Like least_squares, a window starts with Gauss-Newton steps, so it heads for
+# the same one of the (often two, mirrored) minima of a three-AP window; once
+# those stop making progress it switches to the exact Hessian, which converges
+# quadratically even in the flat valleys that high-residual windows have, where
+# Gauss-Newton (and least_squares' tolerances) stops early. With bounds,
+# coordinates at a bound whose descent direction points outside are held fixed
+# and a step stops at the first bound it crosses. A window converges when its
+# (projected) gradient is gone; the few that do not within max_iterations are
+# solved again with least_squares, and only those it cannot solve either are
+# flagged so the caller can use the linear solution for them.
+#
+# linear_positions() is that linear solution for a batch. Its design matrix
+# depends only on which APs a window heard, in which order, so the geometry of
+# each AP subset is computed once and kept in an LRU cache; a fix then only
+# weights precomputed 2x2 terms. Collinear subsets have no linear solution and
+# are reported as unsolved instead of raising.
+
+from functools import lru_cache
+
+import numpy as np
+from scipy.optimize import least_squares
+
+# Iterations (accepted or rejected steps) before a window counts as not converged
+MAX_ITERATIONS = 200
+# Stop when a step moves less than XTOL * (XTOL + |p|), or the cost drops by less than FTOL * cost
+XTOL = 1e-10
+FTOL = 1e-12
+# Largest gradient component at a minimum; a window that stops on a tiny step or
+# gain only counts as converged with its gradient below STALL_GTOL * (1 + cost)
+GTOL = 1e-10
+STALL_GTOL = 1e-6
+# A Gauss-Newton step that lowers the cost by less than this share (or is
+# rejected) switches the window to exact Newton steps
+NEWTON_SWITCH = 1e-3
+# LM damping: start value, factors on rejected / accepted steps, and the value
+# at which no step improves the cost any more
+DAMPING = 1e-3
+DAMPING_UP = 4.0
+DAMPING_DOWN = 3.0
+MAX_DAMPING = 1e12
+# Distance (m) below which a point counts as sitting on an AP
+APEX = 1e-9
+# AP subsets whose linear geometry is kept (a store with dozens of APs has many)
+GEOMETRY_CACHE_SIZE = 4096
+# det(A^T A) below this share of trace^2 / 4 makes a subset collinear
+COLLINEAR = 1e-12
+
+
+def range_weights(distances):
+    """Per-AP residual weights of the estimators: closer APs count more."""
+    return 1.0 / (np.asarray(distances, dtype=float) + 0.1)
+
+
+def _residuals(x, points, distances, weights):
+    offsets = x[:, None, :] - points
+    ranges = np.hypot(offsets[..., 0], offsets[..., 1])
+    return offsets, ranges, weights * (ranges - distances)
+
+
+def _cost(residuals, loss):
+    z = residuals * residuals
+    if loss == "soft_l1":
+        return np.sum(np.sqrt(1.0 + z) - 1.0, axis=1)  # 0.5 * rho(z), rho(z) = 2 (sqrt(1 + z) - 1)
+    return 0.5 * np.sum(z, axis=1)
+
+
+def solve_positions(ap_points, distances, x0, weights=None, loss="soft_l1", bounds=None,
+                    max_iterations=MAX_ITERATIONS):
+    """
+    Weighted nonlinear least-squares fixes of K windows.
+
+    ap_points: K x m x 2 AP coordinates, distances: K x m ranges, x0: K x 2
+    starting points, weights: K x m (default range_weights(distances)).
+    loss is "linear" or "soft_l1"; bounds is ((x_min, y_min), (x_max, y_max))
+    or None. Windows that have not converged after max_iterations are solved
+    with least_squares instead. Returns (positions K x 2, converged K bool).
+    """
+    points = np.asarray(ap_points, dtype=float)
+    distances = np.asarray(distances, dtype=float)
+    weights = range_weights(distances) if weights is None else np.asarray(weights, dtype=float)
+    if loss not in ("linear", "soft_l1"):
+        raise ValueError(f"Unknown loss: {loss}")
+    x = np.array(x0, dtype=float).reshape(-1, 2)
+    if bounds is not None:
+        lower, upper = np.asarray(bounds[0], dtype=float), np.asarray(bounds[1], dtype=float)
+        x = np.clip(x, lower, upper)
+
+    count = len(x)
+    converged = np.zeros(count, dtype=bool)
+    if count == 0:
+        return x, converged
+    finite = (np.all(np.isfinite(points), axis=(1, 2)) & np.all(np.isfinite(distances), axis=1)
+              & np.all(np.isfinite(weights), axis=1) & np.all(np.isfinite(x), axis=1))
+    done = ~finite
+    damping = np.full(count, DAMPING)
+    cost = np.full(count, np.inf)
+    cost[finite] = _cost(_residuals(x[finite], points[finite], distances[finite], weights[finite])[2], loss)
+
+    start = x.copy()
+    # Trust radius |x0| (1 m at the origin) and Gauss-Newton steps first, as in least_squares
+    radius = np.linalg.norm(x, axis=1)
+    radius[radius == 0] = 1.0
+    newton = np.zeros(count, dtype=bool)
+    for _ in range(max_iterations):
+        rows = np.flatnonzero(~done)
+        if not len(rows):
+            break
+        p, d, w, xr = points[rows], distances[rows], weights[rows], x[rows]
+        offsets, ranges, r = _residuals(xr, p, d, w)
+
+        # Gradient and Hessian of the cost: sum of phi(r_i), phi(r) = r^2 / 2 or sqrt(1 + r^2) - 1
+        # At an AP (the hybrid estimator starts at the median AP) the range has a
+        # cone tip; like least_squares' finite differences, take its one-sided
+        # slope, +1 per coordinate, or -1 for a coordinate at its upper bound
+        apex = ranges < APEX
+        safe_ranges = np.where(apex, 1.0, ranges)
+        unit = offsets / safe_ranges[..., None]
+        if apex.any():
+            inward = np.ones_like(xr) if bounds is None else np.where(xr >= upper, -1.0, 1.0)
+            unit = np.where(apex[..., None], inward[:, None, :], unit)
+        if loss == "soft_l1":
+            scale = 1.0 / np.sqrt(1.0 + r * r)
+            slope, curvature = r * scale, scale ** 3
+        else:
+            slope, curvature = r, np.ones_like(r)
+        g = np.einsum("km,kmi->ki", slope * w, unit)
+        outer = np.einsum("kmi,kmj->kmij", unit, unit)
+        gauss_newton = np.einsum("km,kmij->kij", curvature * w * w, outer)
+        H = gauss_newton + np.einsum("km,kmij->kij", np.where(apex, 0.0, slope * w / safe_ranges), np.eye(2) - outer)
+        # Away from a minimum the exact Hessian can be indefinite; the Gauss-Newton
+        # part alone still gives a descent step that stays in the starting basin
+        indefinite = (H[:, 0, 0] <= 0) | (H[:, 0, 0] * H[:, 1, 1] - H[:, 0, 1] * H[:, 1, 0] <= 0)
+        gauss_newton_rows = indefinite | ~newton[rows]
+        H[gauss_newton_rows] = gauss_newton[gauss_newton_rows]
+
+        free = np.ones_like(xr, dtype=bool)
+        if bounds is not None:
+            free = ~(((xr <= lower) & (g > 0)) | ((xr >= upper) & (g < 0)))
+            H = H * (free[:, :, None] & free[:, None, :])
+            g = np.where(free, g, 0.0)
+
+        # A minimum (on the box, with the held coordinates left out) has no gradient left
+        stationary = np.max(np.abs(g), axis=1) <= GTOL
+        converged[rows[stationary]] = True
+        done[rows[stationary]] = True
+        keep = ~stationary
+        rows, p, d, w, xr, g, H = rows[keep], p[keep], d[keep], w[keep], xr[keep], g[keep], H[keep]
+        free = free[keep]
+        if not len(rows):
+            break
+
+        # (H + mu I) step = -g, 2x2 in closed form; fixed coordinates get a zero step.
+        # mu grows on rejected steps, which also makes an indefinite H positive definite.
+        mu = damping[rows] * np.maximum(np.abs(H[:, 0, 0]) + np.abs(H[:, 1, 1]), 1e-12)
+        a = np.where(free[:, 0], H[:, 0, 0] + mu, 1.0)
+        c = np.where(free[:, 1], H[:, 1, 1] + mu, 1.0)
+        b = H[:, 0, 1]
+        det = a * c - b * b
+        definite = (a > 0) & (det > 0)
+        det = np.where(definite, det, 1.0)
+        step = -np.stack([c * g[:, 0] - b * g[:, 1], a * g[:, 1] - b * g[:, 0]], axis=1) / det[:, None]
+        step[~definite] = 0.0
+
+        # Steps stay inside the trust radius, and stop at the first bound they
+        # cross instead of being clipped along it: a clipped step slides into a
+        # corner of the box that is usually not the minimum of the window
+        length = np.linalg.norm(step, axis=1)
+        step *= np.minimum(1.0, radius[rows] / np.maximum(length, 1e-300))[:, None]
+        if bounds is not None:
+            step[((xr <= lower) & (step < 0)) | ((xr >= upper) & (step > 0))] = 0.0
+            room = np.where(step > 0, upper - xr, np.where(step < 0, lower - xr, np.inf))
+            reach = np.where(step != 0, room / np.where(step != 0, step, 1.0), np.inf)
+            step *= np.clip(np.min(reach, axis=1), 0.0, 1.0)[:, None]
+        candidate = xr + step
+        if bounds is not None:
+            # A step that stops at a bound lands on it exactly, not a rounding error inside
+            snap = XTOL * (1.0 + np.abs(upper - lower))
+            candidate = np.clip(candidate, lower, upper)
+            candidate = np.where(candidate - lower <= snap, lower,
+                                 np.where(upper - candidate <= snap, upper, candidate))
+        new_cost = _cost(_residuals(candidate, p, d, w)[2], loss)
+
+        # Trust radius from how well the quadratic model predicted the change
+        moved = np.linalg.norm(candidate - xr, axis=1)
+        predicted = -(np.einsum("ki,ki->k", g, step) + 0.5 * np.einsum("ki,kij,kj->k", step, H, step))
+        ratio = np.where(predicted > 0, (cost[rows] - new_cost) / np.where(predicted > 0, predicted, 1.0), -1.0)
+        radius[rows] = np.where(~definite | (moved == 0), radius[rows],
+                                np.where(ratio < 0.25, 0.25 * moved,
+                                         np.where(ratio > 0.75, np.maximum(radius[rows], 2.0 * moved), radius[rows])))
+
+        accepted = definite & (new_cost < cost[rows])
+        small_step = moved <= XTOL * (XTOL + np.linalg.norm(xr, axis=1))
+        small_gain = (cost[rows] - new_cost <= FTOL * cost[rows]) & small_step
+
+        newton[rows[~accepted | (cost[rows] - new_cost < NEWTON_SWITCH * cost[rows])]] = True
+        accepted_rows = rows[accepted]
+        x[accepted_rows] = candidate[accepted]
+        cost[accepted_rows] = new_cost[accepted]
+        damping[accepted_rows] /= DAMPING_DOWN
+        rejected_rows = rows[~accepted]
+        damping[rejected_rows] *= DAMPING_UP
+
+        # Stopping on a tiny step or gain, or because no step improves the cost any
+        # more, only counts as converged if the gradient there is nearly gone too
+        nearly_stationary = np.max(np.abs(g), axis=1) <= STALL_GTOL * (1.0 + cost[rows])
+        finished = (accepted & (small_step | small_gain)) | (~accepted & (damping[rows] > MAX_DAMPING))
+        converged[rows[finished & nearly_stationary]] = True
+        done[rows[finished]] = True
+
+    # Windows that ran out of iterations or stopped short of a minimum get the
+    # per-window least_squares solve the batch replaces, from the same start
+    for k in np.flatnonzero(finite & ~converged):
+        x[k], converged[k] = _least_squares_fix(points[k], distances[k], weights[k], start[k], loss, bounds)
+    return x, converged
+
+
+def _least_squares_fix(points, distances, weights, x0, loss, bounds):
+    """One window with scipy.optimize.least_squares: (position, converged)."""
+    def residuals(point):
+        return weights * (np.linalg.norm(points - point, axis=1) - distances)
+
+    if bounds is None:
+        result = least_squares(residuals, x0=x0, loss=loss)
+    else:
+        result = least_squares(residuals, x0=x0, bounds=bounds, loss=loss)
+    return result.x, result.success
+
+
+@lru_cache(maxsize=GEOMETRY_CACHE_SIZE)
+def subset_geometry(ap_positions):
+    """
+    Distance-independent terms of the linear solution for one ordered AP
+    subset ((x, y) tuples, the first AP is the reference): the rows A_i and
+    their outer products A_i^T A_i, the |ap_i|^2 - |ap_0|^2 offsets, and
+    whether the subset is collinear (then there is no solution).
+    """
+    points = np.array(ap_positions, dtype=float)
+    rows = 2 * (points[1:] - points[0])
+    offsets = np.sum(points[1:] ** 2, axis=1) - np.sum(points[0] ** 2)
+    outer = rows[:, :, None] * rows[:, None, :]
+    normal = outer.sum(axis=0)
+    trace = normal[0, 0] + normal[1, 1]
+    det = normal[0, 0] * normal[1, 1] - normal[0, 1] * normal[1, 0]
+    collinear = len(points) < 3 or not det > COLLINEAR * trace * trace / 4
+    return rows, offsets, outer, collinear
+
+
+def _group_by_subset(ap_points):
+    """(ordered AP subset as a tuple of (x, y), indices of its windows) for every subset in the batch."""
+    if isinstance(ap_points, np.ndarray):
+        count = len(ap_points)
+        subsets, inverse = np.unique(ap_points.reshape(count, -1), axis=0, return_inverse=True)
+        order = np.argsort(inverse.ravel(), kind="stable")
+        bounds = np.cumsum(np.bincount(inverse.ravel(), minlength=len(subsets)))[:-1]
+        return [(tuple(map(tuple, subset.reshape(-1, 2).tolist())), windows)
+                for subset, windows in zip(subsets, np.split(order, bounds))]
+    groups = {}
+    for k, ap_positions in enumerate(ap_points):
+        groups.setdefault(tuple(map(tuple, ap_positions)), []).append(k)
+    return [(subset, np.array(windows)) for subset, windows in groups.items()]
+
+
+def linear_positions(ap_points, distances):
+    """
+    Weighted linear trilateration of K windows (the estimators' fallback):
+    x = (A^T W A)^-1 A^T W b with b_i = d_i^2 - d_0^2 - (|ap_i|^2 - |ap_0|^2)
+    and w_i = 1 / (d_i + 1e-6). ap_points is K x m x 2 (or a list of
+    per-window AP lists of any length), distances K x m. Returns
+    (positions K x 2, solved K bool); collinear subsets are not solved.
+    """
+    count = len(distances)
+    positions = np.full((count, 2), np.nan)
+    solved = np.zeros(count, dtype=bool)
+
+    for ap_positions, windows in _group_by_subset(ap_points):
+        rows, offsets, outer, collinear = subset_geometry(ap_positions)
+        if collinear:
+            continue
+        if isinstance(distances, np.ndarray):
+            d = distances[windows].astype(float)
+        else:
+            d = np.array([distances[k] for k in windows], dtype=float)
+        weights = 1.0 / (d[:, 1:] + 1e-6)
+        b = d[:, 1:] ** 2 - d[:, :1] ** 2 - offsets
+        normal = np.einsum("ki,ijl->kjl", weights, outer)
+        rhs = np.einsum("ki,ij->kj", weights * b, rows)
+        det = normal[:, 0, 0] * normal[:, 1, 1] - normal[:, 0, 1] * normal[:, 1, 0]
+        x = (normal[:, 1, 1] * rhs[:, 0] - normal[:, 0, 1] * rhs[:, 1]) / det
+        y = (normal[:, 0, 0] * rhs[:, 1] - normal[:, 1, 0] * rhs[:, 0]) / det
+        ok = np.isfinite(x) & np.isfinite(y)
+        positions[windows[ok], 0] = x[ok]
+        positions[windows[ok], 1] = y[ok]
+        solved[windows[ok]] = True
+    return positions, solved
@@ -0,0 +1,91 @@
+# Fixed-rate window grouping shared by the estimators.
+#
+# The estimators used to walk each device's readings in Python, opening a
+# window at a reading and scanning forward for the readings within 2 s (WiFi,
+# hybrid) or 3 s (BLE) of it. resample_windows() instead resamples every
+# filtered (device, AP) stream onto one time grid: ticks every step_ms of
+# epoch time, the same for every device, where a stream holds its last
+# filtered RSSI of the window_ms before the tick (both ends included, like
+# the old windows). Each reading lands in the few ticks whose window covers
+# it, so window membership is integer arithmetic and the windows come out as
+# a dense K x APs matrix (NaN for the APs a window did not hear) that the
+# batch solvers take as is.
+
+import numpy as np
+import pandas as pd
+
+# Window width and grid step (ms); the APs of the recordings report every 7 s,
+# staggered by 1-3 s, so 3 s is the narrowest window that hears three of them
+WINDOW_MS = 3000
+# APs a window must hear to be kept
+MIN_APS = 3
+
+
+def resample_windows(rows, window_ms=WINDOW_MS, step_ms=None, aps=None, min_aps=MIN_APS):
+    """
+    rows: (device, ap, ts_ms, rssi) readings in any order. step_ms defaults
+    to window_ms (windows do not overlap).
+
+    Returns (devices K, ts_ms K, rssi K x M, aps M): one row per device and
+    tick that heard at least min_aps APs, ordered by device (first seen) then
+    time, with the centre time of the tick's window. aps is the column order:
+    the given APs (readings of others are ignored) or every AP in rows, sorted.
+    """
+    step_ms = step_ms or window_ms
+    table = np.array(rows, dtype=object).reshape(-1, 4)
+
+    # Small integer codes for devices and APs (hashed, no per-reading Python work)
+    device_codes, device_names = pd.factorize(table[:, 0])
+    ap_codes, ap_ids = pd.factorize(table[:, 1])
+    aps = sorted(ap_ids, key=str) if aps is None else list(aps)
+    column_of = {ap: column for column, ap in enumerate(aps)}
+    columns = np.array([column_of.get(ap, -1) for ap in ap_ids], dtype=np.int64)[ap_codes]
+    heard = columns >= 0  # Readings of other APs are ignored
+    if not heard.any():
+        return np.empty(0, dtype=object), np.empty(0, dtype=np.int64), np.empty((0, len(aps))), aps
+    device_codes, columns, table = device_codes[heard], columns[heard], table[heard]
+    ts_ms = table[:, 2].astype(np.int64)
+    rssi = table[:, 3].astype(float)
+
+    # Ticks t (in steps) with t - window_ms <= ts <= t: one record per reading and tick
+    first = -(-ts_ms // step_ms)
+    covered = (ts_ms + window_ms) // step_ms - first + 1
+    reading = np.repeat(np.arange(len(ts_ms)), covered)
+    ticks = first[reading] + np.arange(len(reading)) - np.repeat(np.cumsum(covered) - covered, covered)
+    device_codes, columns, ts_ms, rssi = device_codes[reading], columns[reading], ts_ms[reading], rssi[reading]
+
+    # Last reading of every (device, tick, AP): sort by them, then by time
+    order = np.lexsort((ts_ms, columns, ticks, device_codes))
+    device_codes, ticks, columns, rssi = device_codes[order], ticks[order], columns[order], rssi[order]
+    new_window = np.ones(len(order), dtype=bool)
+    new_window[1:] = (device_codes[1:] != device_codes[:-1]) | (ticks[1:] != ticks[:-1])
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = new_window[1:] | (columns[1:] != columns[:-1])
+
+    window = np.cumsum(new_window) - 1
+    matrix = np.full((int(window[-1]) + 1, len(aps)), np.nan)
+    matrix[window[last], columns[last]] = rssi[last]
+
+    starts = np.flatnonzero(new_window)
+    keep = np.sum(np.isfinite(matrix), axis=1) >= min_aps
+    centres = ticks[starts] * step_ms - window_ms // 2
+    devices = np.asarray(device_names, dtype=object)[device_codes[starts]]
+    return devices[keep], centres[keep], matrix[keep], aps
+
+
+def known_windows(rssi, aps, known, count=3):
+    """
+    Windows that heard at least count of the APs in known (a set or dict of AP
+    ids), and the columns of the count strongest of those in each (the nearest
+    APs): (rows K', columns K' x count, in column order).
+    """
+    heard = np.isfinite(rssi) & np.array([ap in known for ap in aps], dtype=bool)
+    rows = np.flatnonzero(np.sum(heard, axis=1) >= count)
+    strength = np.where(heard[rows], rssi[rows], -np.inf)
+    strongest = np.argsort(-strength, axis=1, kind="stable")[:, :count]
+    return rows, np.sort(strongest, axis=1)
+
+
+def window_dicts(rssi, aps):
+    """{ap: rssi} of every window row, with the APs it heard (what RadioMap takes)."""
+    return [{aps[column]: value for column, value in enumerate(row) if value == value} for row in rssi.tolist()]
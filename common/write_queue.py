@@ -0,0 +1,175 @@
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+# Sentinel pushed by close() to tell the writer thread to drain and exit
+_STOP = object()
+
+_INSERT_TABLE = re.compile(r"INSERT\s+(?:OR\s+\w+\s+)?INTO\s+(\w+)", re.IGNORECASE)
+
+
+class WriteBehindQueue:
+    """
+    Bounded in-memory queue with a dedicated SQLite writer thread.
+
+    MQTT callbacks call put()/put_many() and return immediately; the writer
+    thread groups pending rows per INSERT statement and flushes them with
+    executemany() + a single commit once max_batch rows are waiting or
+    max_delay seconds have passed since the first row of the batch arrived.
+    """
+
+    def __init__(self, database, max_batch=500, max_delay=0.5, max_queue=10000, metrics=None):
+        self.database = database
+        self.metrics = metrics  # optional metrics.IngestMetrics
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._lock = threading.Lock()
+
+        # Counters (read through stats())
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.commits = 0
+        self.errors = 0
+        self.last_commit_ms = 0.0
+        self.max_commit_ms = 0.0
+        self._total_commit_ms = 0.0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def put(self, sql, params, timeout=None):
+        """Queue one row. Returns False (and counts a drop) if the queue stays full."""
+        return self.put_many(sql, [params], timeout)
+
+    def put_many(self, sql, rows, timeout=None):
+        """
+        Queue several rows for the same statement as one queue slot, e.g. all
+        readings of a per-scan batch message. They are written by one executemany.
+        """
+        if not rows:
+            return True
+        try:
+            if timeout is None:
+                self._queue.put_nowait((sql, rows))
+            else:
+                self._queue.put((sql, rows), timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.dropped += len(rows)
+            if self.metrics is not None:
+                self.metrics.dropped.inc(amount=len(rows))
+            return False
+        with self._lock:
+            self.enqueued += len(rows)
+        return True
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def close(self, timeout=10.0):
+        """Flush everything still queued, then stop the writer thread."""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            avg_commit_ms = self._total_commit_ms / self.commits if self.commits else 0.0
+            return {
+                "queue_depth": self._queue.qsize(),
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+                "written": self.written,
+                "commits": self.commits,
+                "errors": self.errors,
+                "last_commit_ms": self.last_commit_ms,
+                "avg_commit_ms": avg_commit_ms,
+                "max_commit_ms": self.max_commit_ms,
+            }
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database)
+        # WAL lets the filter/estimator scripts read while we write, and
+        # synchronous=NORMAL drops the per-commit fsync of the main DB file.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _run(self):
+        conn = self._connect()
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            pending_rows = len(item[1])
+            deadline = time.monotonic() + self.max_delay
+            while pending_rows < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                pending_rows += len(item[1])
+
+            self._flush(conn, batch)
+
+        # Drain anything that was queued behind the stop sentinel
+        leftover = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                leftover.append(item)
+        if leftover:
+            self._flush(conn, leftover)
+        conn.close()
+
+    def _flush(self, conn, batch):
+        grouped = {}
+        row_count = 0
+        for sql, rows in batch:
+            grouped.setdefault(sql, []).extend(rows)
+            row_count += len(rows)
+
+        start = time.perf_counter()
+        try:
+            for sql, rows in grouped.items():
+                conn.executemany(sql, rows)
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            print(f"Write queue flush failed ({row_count} rows): {e}")
+            with self._lock:
+                self.errors += 1
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if self.metrics is not None:
+            self.metrics.commit_seconds.observe(elapsed_ms / 1000)
+            for sql, rows in grouped.items():
+                match = _INSERT_TABLE.match(sql.strip())
+                self.metrics.rows_written.inc(match.group(1) if match else "unknown", amount=len(rows))
+
+        with self._lock:
+            self.written += row_count
+            self.commits += 1
+            self.last_commit_ms = elapsed_ms
+            self.max_commit_ms = max(self.max_commit_ms, elapsed_ms)
+            self._total_commit_ms += elapsed_ms
@@ -8,6 +8,13 @@ import sqlite3
 import math
 import os
 
+def hybrid_rssi_table(db_path):
+    """The named view of the keyed hybrid_filtered_rssi; older databases have the names in the table itself."""
+    conn = sqlite3.connect(db_path)
+    view = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = 'hybrid_filtered_rssi_named'").fetchone()
+    conn.close()
+    return "hybrid_filtered_rssi_named" if view else "hybrid_filtered_rssi"
+
 def calculate_accuracy(table_name, db_path, rssi_table):
     if not os.path.exists(db_path):
         print(f"Database not found at: {db_path}")
@@ -80,5 +87,5 @@ if __name__ == "__main__":
     elif args.mode == "hybrid":
         db_path = "../BLE+Wifi/positioning.db"
         table_name = "hybrid_estimated_positions"
-        rssi_table = "hybrid_filtered_rssi"
+        rssi_table = hybrid_rssi_table(db_path) if os.path.exists(db_path) else "hybrid_filtered_rssi_named"
     calculate_accuracy(table_name, db_path, rssi_table)
\ No newline at end of file
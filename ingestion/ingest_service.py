@@ -0,0 +1,556 @@
+# Unified asyncio ingestion service: one process subscribes to every RSSI topic
+# (ble/rssi, wifi/rssi, ...) and routes each reading to its raw table.
+#
+# Running the service
+# python ingest_service.py --db ../BLE+Wifi/positioning.db
+# python ingest_service.py --db positioning.db --route ble/rssi=ble_rssi --route lora/rssi=lora_rssi
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from local_broker import topic_matches
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import rssi_codec
+from run_storage import DEFAULT_KEEP_RUNS, ensure_run_partitioning, expire_runs_in_background, start_run
+from identity import ensure_identity_columns
+from metrics import IngestMetrics
+from clock_sync import ECHO_TOPIC, PING_INTERVAL, PING_TOPIC, ClockSync, reading_sender
+from epoch_time import ensure_epoch_columns, reading_ms
+
+# === MQTT Broker Configuration ===
+MQTT_BROKER = "keshleepi.local"  # Use hostname
+MQTT_PORT = 8883  # TLS port
+MQTT_USERNAME = "team19"
+MQTT_PASSWORD = "test123"
+
+# === TLS Certificate Paths ===
+CA_CERT = "certs/ca.crt"
+CLIENT_CERT = "certs/client.crt"
+CLIENT_KEY = "certs/client.key"
+
+# === Prometheus-style metrics endpoint (0 disables) ===
+METRICS_PORT = 9100
+
+# === Topic -> raw table routing ===
+DEFAULT_ROUTES = {
+    "ble/rssi": "ble_rssi",
+    "wifi/rssi": "wifi_rssi",
+}
+
+RAW_TABLE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT,
+    ap_id TEXT,
+    mac TEXT,
+    device_name TEXT,
+    rssi INTEGER,
+    latency REAL,
+    run_id INTEGER NOT NULL DEFAULT 0,
+    device_key INTEGER,
+    ap_key INTEGER,
+    ts_ms INTEGER
+)
+"""
+
+# run_id is fixed for the whole process, so it is bound into the statement once
+INSERT_SQL = ("INSERT INTO {table} (timestamp, ap_id, mac, device_name, rssi, latency, ts_ms, device_key, ap_key, run_id) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, {run_id})")
+
+_STOP = object()
+
+
+def decode_rows(payload, receive_time, clock=None, topic=None):
+    """
+    Decode one published message (binary reading, per-scan batch or JSON) into raw-table rows.
+
+    Payload contract (same as the publishers and M5Stick firmware):
+    mac_address, device_name, rssi, and optionally ap_id, timestamp, timestamp_epoch.
+
+    With a ClockSync, latency is corrected by the offset of the clock that
+    stamped the reading, which depends on the topic it was published on.
+    Returns [(timestamp, ap_id, mac, device_name, rssi, latency, ts_ms), ...], or None if malformed.
+    """
+    try:
+        readings = rssi_codec.decode_readings(payload)
+    except ValueError:
+        return None
+    if not readings:
+        return None
+
+    rows = []
+    for timestamp, send_time, ap_id, mac, device_name, rssi in readings:
+        if send_time is None:
+            latency = 0.0
+        else:
+            latency = receive_time - send_time
+            if clock is not None:
+                latency = clock.correct_latency(latency, receive_time, reading_sender(topic, ap_id, device_name))
+        ts_ms = reading_ms(timestamp, send_time, receive_time)
+        if timestamp is None:
+            timestamp = rssi_codec.format_timestamp(receive_time)
+        rows.append((timestamp, ap_id, mac, device_name, rssi, latency, ts_ms))
+    return rows
+
+
+def record_readings(metrics, topic, rows):
+    """Per-AP reading counts and publish -> receive latencies of one decoded message."""
+    per_ap = {}
+    for row in rows:
+        per_ap[row[1]] = per_ap.get(row[1], 0) + 1
+    for ap_id, count in per_ap.items():
+        metrics.readings.inc(topic, ap_id, amount=count)
+    metrics.latency_seconds.observe_many([row[5] for row in rows])
+
+
+class IngestService:
+    """
+    Routes readings from any number of topics into their raw tables.
+
+    Network sources call accept() (from callbacks) or await submit(). Readings
+    sit in an asyncio queue; once it holds queue_size items the service pauses
+    its sources until it has drained to half that, so a slow disk pushes back
+    on the broker instead of growing memory. Decoding and SQLite writes run on
+    a single worker thread so the event loop never blocks on I/O.
+
+    Stored latencies are corrected with the publishers' clock offsets, which
+    MqttSource keeps up to date in self.clock.
+    """
+
+    def __init__(self, database, routes=None, queue_size=10000, max_batch=500, max_delay=0.5,
+                 keep_runs=DEFAULT_KEEP_RUNS, metrics=None, clock=None):
+        self.database = database
+        self.keep_runs = keep_runs
+        self.run_id = None
+        self.routes = dict(routes or DEFAULT_ROUTES)
+        self.queue_size = queue_size
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self._conn = None
+        self._insert_sql = {}
+        self._identity = None
+        self._flow_control = []
+        self._commit_listeners = []
+        self.paused = False
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.metrics = metrics or IngestMetrics()
+        self.metrics.track_queue_depth(self._queue.qsize)
+        self.clock = clock or ClockSync()
+        self.metrics.track_clock(self.clock)
+
+        # Counters (read through stats())
+        self.received = 0
+        self.decode_errors = 0
+        self.key_errors = 0
+        self.unrouted = 0
+        self.written = {table: 0 for table in self.routes.values()}
+        self.commits = 0
+        self.pauses = 0
+        self.last_commit_ms = 0.0
+        self.max_commit_ms = 0.0
+        self._total_commit_ms = 0.0
+
+    # === Producer side ===
+    def add_flow_control(self, on_pause, on_resume):
+        """Register callbacks used to stop/start reading from a network source."""
+        self._flow_control.append((on_pause, on_resume))
+
+    def add_commit_listener(self, on_commit):
+        """
+        Register a callback that gets the publish -> commit latency (s) of every
+        row of each committed batch. It runs on the writer thread.
+        """
+        self._commit_listeners.append(on_commit)
+
+    def accept(self, topic, payload):
+        """Queue one message without waiting (safe to call from sync callbacks)."""
+        self.received += 1
+        self.metrics.messages.inc(topic)
+        self._queue.put_nowait((topic, payload, time.time()))
+        if not self.paused and self._queue.qsize() >= self.queue_size:
+            self._pause()
+
+    async def submit(self, topic, payload):
+        """Queue one message, waiting while the service is applying backpressure."""
+        await self.writable.wait()
+        self.accept(topic, payload)
+
+    def route(self, topic):
+        """Raw table for a topic; routes may use MQTT wildcards ('+', '#')."""
+        table = self.routes.get(topic)
+        if table is None:
+            for pattern, candidate in self.routes.items():
+                if topic_matches(pattern, topic):
+                    table = candidate
+                    break
+        return table
+
+    def _pause(self):
+        self.paused = True
+        self.pauses += 1
+        self.writable.clear()
+        for on_pause, _ in self._flow_control:
+            on_pause()
+
+    def _maybe_resume(self):
+        if self.paused and self._queue.qsize() <= self.queue_size // 2:
+            self.paused = False
+            self.writable.set()
+            for _, on_resume in self._flow_control:
+                on_resume()
+
+    # === Consumer side ===
+    async def run(self):
+        """Drain the queue in batches until stop() is called."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._open)
+        try:
+            stopping = False
+            while not stopping:
+                item = await self._queue.get()
+                if item is _STOP:
+                    break
+
+                batch = [item]
+                deadline = loop.time() + self.max_delay
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self._queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        remaining = deadline - loop.time()
+                        if remaining <= 0:
+                            break
+                        try:
+                            item = await asyncio.wait_for(self._queue.get(), remaining)
+                        except asyncio.TimeoutError:
+                            break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+
+                self._maybe_resume()
+                await loop.run_in_executor(self._executor, self._flush, batch)
+                self._maybe_resume()
+        finally:
+            await loop.run_in_executor(self._executor, self._close)
+
+    async def stop(self):
+        """Ask run() to flush everything queued so far and exit."""
+        self._queue.put_nowait(_STOP)
+
+    def stats(self):
+        avg_commit_ms = self._total_commit_ms / self.commits if self.commits else 0.0
+        return {
+            "queue_depth": self._queue.qsize(),
+            "received": self.received,
+            "decode_errors": self.decode_errors,
+            "key_errors": self.key_errors,
+            "unrouted": self.unrouted,
+            "written": dict(self.written),
+            "commits": self.commits,
+            "pauses": self.pauses,
+            "last_commit_ms": self.last_commit_ms,
+            "avg_commit_ms": avg_commit_ms,
+            "max_commit_ms": self.max_commit_ms,
+            "clock": self.clock.stats(),
+        }
+
+    # === Writer thread ===
+    def _open(self):
+        self._conn = sqlite3.connect(self.database)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for table in set(self.routes.values()):
+            self._conn.execute(RAW_TABLE_SCHEMA.format(table=table))
+        self._conn.commit()
+
+        # A new run per service start; nothing is wiped
+        ensure_run_partitioning(self._conn, sorted(set(self.routes.values())))
+        ensure_epoch_columns(self._conn, sorted(set(self.routes.values())))
+        self.run_id = start_run(self._conn, "ingest_service")
+        self._insert_sql = {
+            table: INSERT_SQL.format(table=table, run_id=int(self.run_id))
+            for table in set(self.routes.values())
+        }
+        # Device/AP names -> integer keys, resolved once per spelling
+        self._identity = ensure_identity_columns(self._conn, sorted(set(self.routes.values())))
+        print(f"Started run {self.run_id}")
+        if self.keep_runs:
+            expire_runs_in_background(self.database, sorted(set(self.routes.values())), self.keep_runs)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _flush(self, batch):
+        rows_by_table = {}
+        decode_errors = 0
+        key_errors = 0
+        unrouted = 0
+        received = []  # (receive_time, latencies) of the kept messages, for the commit listeners
+        for topic, payload, receive_time in batch:
+            table = self.route(topic)
+            if table is None:
+                unrouted += 1
+                continue
+            rows = decode_rows(payload, receive_time, self.clock, topic)
+            if rows is None:
+                decode_errors += 1
+                self.metrics.decode_errors.inc(topic)
+                continue
+            record_readings(self.metrics, topic, rows)
+            identity = self._identity
+            try:
+                keyed = [row + (identity.device_key(row[3]), identity.ap_key(row[1])) for row in rows]
+            except sqlite3.Error as e:
+                # Registering a new spelling failed: drop this message, keep the batch
+                key_errors += 1
+                self.metrics.key_errors.inc(topic)
+                print(f"Could not store device/AP keys, message dropped: {e}")
+                continue
+            rows_by_table.setdefault(table, []).extend(keyed)
+            if self._commit_listeners:
+                received.append((receive_time, [row[5] for row in rows]))
+
+        start = time.perf_counter()
+        try:
+            for table, rows in rows_by_table.items():
+                self._conn.executemany(self._insert_sql[table], rows)
+            self._conn.commit()
+        except sqlite3.Error as e:
+            self._conn.rollback()
+            print(f"Insert failed ({len(batch)} messages): {e}")
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if self._commit_listeners:
+            # Latency to the receive time, plus the wait in the queue and the commit
+            commit_time = time.time()
+            latencies = [latency + commit_time - receive_time
+                         for receive_time, message_latencies in received for latency in message_latencies]
+            for on_commit in self._commit_listeners:
+                on_commit(latencies)
+        self.metrics.commit_seconds.observe(elapsed_ms / 1000)
+        for table, rows in rows_by_table.items():
+            self.metrics.rows_written.inc(table, amount=len(rows))
+
+        # Plain int/float updates; the event loop only reads these.
+        self.decode_errors += decode_errors
+        self.key_errors += key_errors
+        self.unrouted += unrouted
+        for table, rows in rows_by_table.items():
+            self.written[table] = self.written.get(table, 0) + len(rows)
+        self.commits += 1
+        self.last_commit_ms = elapsed_ms
+        self.max_commit_ms = max(self.max_commit_ms, elapsed_ms)
+        self._total_commit_ms += elapsed_ms
+
+
+class MqttSource:
+    """
+    Feeds an IngestService from a real MQTT broker.
+
+    paho's socket is driven by the asyncio event loop (add_reader/add_writer)
+    instead of a blocking loop_forever(), so pausing the service simply stops
+    reading the socket and TCP flow control pushes back on the broker.
+
+    It also pings the publishers every ping_interval seconds (0 disables) and
+    feeds their echoes straight into service.clock, bypassing the queue so the
+    echo receive time is not delayed by backpressure.
+    """
+
+    def __init__(self, service, broker=MQTT_BROKER, port=MQTT_PORT,
+                 username=MQTT_USERNAME, password=MQTT_PASSWORD, use_tls=True, ping_interval=PING_INTERVAL):
+        self.service = service
+        self.broker = broker
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.ping_interval = ping_interval
+        self._loop = None
+        self._client = None
+        self._sock = None
+        self._reading = False
+        self._misc_task = None
+        self._ping_task = None
+        self._disconnected = None
+        self._stopping = False
+
+    async def run(self):
+        import paho.mqtt.client as mqtt
+
+        self._loop = asyncio.get_running_loop()
+        client = mqtt.Client()
+        if self.use_tls:
+            client.tls_set(ca_certs=CA_CERT, certfile=CLIENT_CERT, keyfile=CLIENT_KEY)
+        client.username_pw_set(self.username, self.password)
+        client.on_connect = self._on_connect
+        client.on_message = self._on_message
+        client.on_disconnect = self._on_disconnect
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        self._client = client
+        self.service.add_flow_control(self._pause_reading, self._resume_reading)
+
+        while not self._stopping:
+            self._disconnected = self._loop.create_future()
+            try:
+                client.connect(self.broker, self.port, 60)
+            except OSError as e:
+                print(f"Connection to {self.broker}:{self.port} failed: {e}")
+                await asyncio.sleep(5)
+                continue
+            rc = await self._disconnected
+            if self._stopping:
+                break
+            print(f"Disconnected from broker (rc={rc}), reconnecting in 5s...")
+            await asyncio.sleep(5)
+
+    def stop(self):
+        self._stopping = True
+        if self._client is not None:
+            self._client.disconnect()
+
+    # === paho callbacks ===
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            print("Connected to MQTT Broker")
+            client.subscribe([(topic, 0) for topic in self.service.routes] + [(ECHO_TOPIC, 0)])
+            if self.ping_interval and self._ping_task is None:
+                self._ping_task = self._loop.create_task(self._ping_loop())
+        else:
+            print(f"Connection failed with code {rc}")
+
+    def _on_message(self, client, userdata, msg):
+        if msg.topic == ECHO_TOPIC:
+            self.service.clock.handle_echo(msg.payload, time.time())
+            return
+        if msg.topic == PING_TOPIC:
+            return  # Our own ping, seen through a wildcard route
+        self.service.accept(msg.topic, msg.payload)
+
+    def _on_disconnect(self, client, userdata, rc):
+        if self._disconnected is not None and not self._disconnected.done():
+            self._disconnected.set_result(rc)
+
+    # === asyncio socket integration ===
+    def _on_socket_open(self, client, userdata, sock):
+        self._sock = sock
+        if not self.service.paused:
+            self._resume_reading()
+        self._misc_task = self._loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._pause_reading()
+        self._sock = None
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+        if self._ping_task is not None:
+            self._ping_task.cancel()
+            self._ping_task = None
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
+    def _pause_reading(self):
+        if self._sock is not None and self._reading:
+            self._loop.remove_reader(self._sock)
+            self._reading = False
+
+    def _resume_reading(self):
+        if self._sock is not None and not self._reading:
+            self._loop.add_reader(self._sock, self._client.loop_read)
+            self._reading = True
+
+    async def _ping_loop(self):
+        while True:
+            self._client.publish(PING_TOPIC, self.service.clock.next_ping())
+            await asyncio.sleep(self.ping_interval)
+
+    async def _misc_loop(self):
+        import paho.mqtt.client as mqtt
+
+        while self._client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+def parse_routes(route_args):
+    routes = dict(DEFAULT_ROUTES)
+    for route in route_args or []:
+        topic, _, table = route.partition("=")
+        if not topic or not table.isidentifier():
+            raise SystemExit(f"Invalid --route '{route}', expected topic=table")
+        routes[topic] = table
+    return routes
+
+
+async def main(args):
+    service = IngestService(
+        args.db,
+        routes=parse_routes(args.route),
+        queue_size=args.queue_size,
+        max_batch=args.batch_size,
+        max_delay=args.batch_delay,
+        keep_runs=args.keep_runs,
+    )
+
+    if args.metrics_port:
+        service.metrics.serve(args.metrics_port)
+
+    source = MqttSource(service, broker=args.broker, port=args.port, use_tls=not args.no_tls,
+                        ping_interval=args.ping_interval)
+    writer_task = asyncio.create_task(service.run())
+    source_task = asyncio.create_task(source.run())
+    try:
+        await asyncio.wait([writer_task, source_task], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        source.stop()
+        source_task.cancel()
+        await service.stop()
+        await writer_task
+        print("Ingestion stats:", service.stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest BLE/WiFi RSSI readings from MQTT into SQLite.")
+    parser.add_argument("--db", default="positioning.db", help="SQLite database to write to")
+    parser.add_argument("--route", action="append", help="Extra topic=table routing (repeatable)")
+    parser.add_argument("--broker", default=MQTT_BROKER)
+    parser.add_argument("--port", type=int, default=MQTT_PORT)
+    parser.add_argument("--no-tls", action="store_true", help="Connect without TLS (e.g. port 1883)")
+    parser.add_argument("--queue-size", type=int, default=10000, help="Readings buffered before pausing the broker")
+    parser.add_argument("--batch-size", type=int, default=500, help="Max messages per commit")
+    parser.add_argument("--batch-delay", type=float, default=0.5, help="Max seconds a message waits before commit")
+    parser.add_argument("--keep-runs", type=int, default=DEFAULT_KEEP_RUNS,
+                        help="Runs kept in the raw tables; older ones are expired (0 keeps everything)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Serve Prometheus metrics on this local port (0 disables)")
+    parser.add_argument("--ping-interval", type=float, default=PING_INTERVAL,
+                        help="Seconds between clock-offset pings to the publishers (0 disables)")
+    args = parser.parse_args()
+
+    # paho needs add_reader/add_writer, which the default Windows loop lacks
+    if sys.platform == "win32":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print("Stopping ingestion service...")
@@ -0,0 +1,47 @@
+import asyncio
+
+
+def topic_matches(pattern, topic):
+    """MQTT topic filter match supporting the '+' and '#' wildcards."""
+    pattern_parts = pattern.split("/")
+    topic_parts = topic.split("/")
+    for i, part in enumerate(pattern_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[i]:
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+
+class LocalBroker:
+    """
+    In-process stand-in for the Mosquitto broker.
+
+    Lets the ingestion service (and the load tools) be exercised without TLS
+    certificates, a Raspberry Pi or any network. Subscribers are plain
+    callables `handler(topic, payload)`; if a handler returns an awaitable the
+    publisher waits on it, so backpressure from the subscriber propagates back
+    to whoever is publishing.
+    """
+
+    def __init__(self):
+        self._subscriptions = []
+        self.published = 0
+
+    def subscribe(self, pattern, handler):
+        self._subscriptions.append((pattern, handler))
+
+    def unsubscribe(self, handler):
+        self._subscriptions = [(p, h) for p, h in self._subscriptions if h is not handler]
+
+    async def publish(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.published += 1
+        for pattern, handler in list(self._subscriptions):
+            if topic_matches(pattern, topic):
+                result = handler(topic, payload)
+                if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+                    await result
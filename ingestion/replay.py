@@ -0,0 +1,321 @@
+# Record-and-replay load generator for the ingestion path.
+#
+# Reads the raw readings recorded in the shipped positioning.db files and
+# republishes them as MQTT traffic, either into an in-process LocalBroker +
+# IngestService (default, no broker or certificates needed) or to a real broker
+# with whichever subscriber is under test listening. Each recording is shifted
+# to start at t=0 so the sessions play side by side.
+#
+# Every message is stamped with the time it is actually sent, so the latency
+# column the subscriber stores is the publish -> receive latency. That stops
+# where the message is accepted into the subscriber's write queue; with the
+# local service the report also gives the end-to-end publish -> commit latency,
+# from the commit time of the batch each reading was written in.
+#
+# python replay.py                                  # 1x, all recordings, local broker
+# python replay.py --speed 100 --tags 20            # 100x, every tag fanned out to 20 synthetic tags
+# python replay.py --speed 0 --format json          # as fast as possible, JSON payloads
+# python replay.py --broker localhost --port 1883 --no-tls --db ../BLE+Wifi/positioning.db
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+from ingest_service import CA_CERT, CLIENT_CERT, CLIENT_KEY, MQTT_PASSWORD, MQTT_USERNAME, IngestService
+from local_broker import LocalBroker
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from rssi_codec import encode_batch, encode_json_reading, encode_reading
+from run_storage import current_run_id
+
+DEFAULT_SOURCES = [
+    os.path.join(BASE_DIR, "../BLE_only/positioning.db"),
+    os.path.join(BASE_DIR, "../Wifi_only/positioning.db"),
+    os.path.join(BASE_DIR, "../BLE+Wifi/positioning.db"),
+    os.path.join(BASE_DIR, "../Wifi_only/Wifidata_30min_1904hrs.db"),
+]
+
+# Raw table -> topic it was originally published on
+TABLE_TOPICS = {
+    "ble_rssi": "ble/rssi",
+    "wifi_rssi": "wifi/rssi",
+}
+
+
+def load_recording(db_paths, duration=None):
+    """
+    Every recorded raw reading as (offset, topic, ap_id, mac, device_name, rssi),
+    sorted by offset. offset is seconds since the start of that recording.
+    """
+    recording = []
+    for db_path in db_paths:
+        conn = sqlite3.connect(db_path)
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        rows = []
+        for table, topic in TABLE_TOPICS.items():
+            if table not in tables:
+                continue
+            for timestamp, ap_id, mac, device_name, rssi in conn.execute(
+                f"SELECT timestamp, ap_id, mac, device_name, rssi FROM {table} ORDER BY timestamp"
+            ):
+                epoch = time.mktime(time.strptime(timestamp, "%Y-%m-%d %H:%M:%S"))
+                rows.append((epoch, topic, ap_id, mac, device_name, int(rssi)))
+        conn.close()
+        if not rows:
+            print(f"No recorded readings in {db_path}")
+            continue
+
+        start = min(row[0] for row in rows)
+        for epoch, topic, ap_id, mac, device_name, rssi in rows:
+            offset = epoch - start
+            if duration is None or offset < duration:
+                recording.append((offset, topic, ap_id, mac, device_name, rssi))
+        print(f"Loaded {len(rows)} readings from {os.path.basename(os.path.dirname(db_path))}/{os.path.basename(db_path)}")
+
+    recording.sort(key=lambda r: r[0])
+    return recording
+
+
+def fan_out_mac(mac, tag):
+    """MAC of synthetic tag number `tag` derived from a recorded tag (tag 0 is the original)."""
+    if tag == 0:
+        return mac
+    parts = mac.split(":")
+    if len(parts) != 6:
+        return f"{mac}-{tag}"
+    low = (int(parts[4], 16) << 8 | int(parts[5], 16)) ^ tag
+    fanned = parts[:4] + [f"{(low >> 8) & 0xFF:02x}", f"{low & 0xFF:02x}"]
+    mac_out = ":".join(fanned)
+    return mac_out.upper() if mac.isupper() else mac_out
+
+
+def build_messages(recording, payload_format, tags):
+    """
+    Group the recording into messages: [(offset, topic, ap_id, [(mac, device_name, rssi), ...])].
+    Synthetic tags keep the recorded device name (so payloads stay dictionary-codable)
+    and get their own MAC.
+    """
+    messages = []
+    if payload_format == "batch":
+        # One message per AP scan, like the BLE publisher
+        scans = {}
+        for offset, topic, ap_id, mac, device_name, rssi in recording:
+            key = (offset, topic, ap_id)
+            if key not in scans:
+                scans[key] = []
+                messages.append((offset, topic, ap_id, scans[key]))
+            for tag in range(tags):
+                scans[key].append((fan_out_mac(mac, tag), device_name, rssi))
+    else:
+        for offset, topic, ap_id, mac, device_name, rssi in recording:
+            for tag in range(tags):
+                messages.append((offset, topic, ap_id, [(fan_out_mac(mac, tag), device_name, rssi)]))
+    return messages
+
+
+def encode_message(payload_format, timestamp_epoch, ap_id, readings):
+    """Payloads for one message, falling back to JSON for readings the binary formats cannot code."""
+    if payload_format == "batch":
+        payload, rejected = encode_batch(timestamp_epoch, ap_id, readings)
+        payloads = [payload] if payload is not None else []
+        payloads.extend(encode_json_reading(timestamp_epoch, ap_id, *r).encode() for r in rejected)
+        return payloads
+
+    payloads = []
+    for mac, device_name, rssi in readings:
+        payload = None
+        if payload_format == "binary":
+            payload = encode_reading(timestamp_epoch, ap_id, mac, device_name, rssi)
+        if payload is None:
+            payload = encode_json_reading(timestamp_epoch, ap_id, mac, device_name, rssi).encode()
+        payloads.append(payload)
+    return payloads
+
+
+class Replayer:
+    """Publishes the messages on the recorded schedule, compressed by `speed` (0 = no pauses)."""
+
+    def __init__(self, messages, publish, payload_format="batch", speed=1.0):
+        self.messages = messages
+        self.publish = publish
+        self.payload_format = payload_format
+        self.speed = speed
+
+        self.published = 0
+        self.readings = 0
+        self.publish_failures = 0
+        self.max_lag = 0.0
+        self.elapsed = 0.0
+
+    async def run(self):
+        start = time.monotonic()
+        for offset, topic, ap_id, readings in self.messages:
+            if self.speed > 0:
+                due = start + offset / self.speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    self.max_lag = max(self.max_lag, -delay)
+
+            for payload in encode_message(self.payload_format, time.time(), ap_id, readings):
+                if await self.publish(topic, payload):
+                    self.published += 1
+                else:
+                    self.publish_failures += 1
+            self.readings += len(readings)
+        self.elapsed = time.monotonic() - start
+
+
+class MqttPublisher:
+    """Publishes to a real broker (QoS 0) for testing an external subscriber."""
+
+    def __init__(self, broker, port, use_tls=True):
+        import paho.mqtt.client as mqtt
+
+        self._mqtt = mqtt
+        self.client = mqtt.Client()
+        if use_tls:
+            self.client.tls_set(ca_certs=CA_CERT, certfile=CLIENT_CERT, keyfile=CLIENT_KEY)
+        self.client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+        self.client.connect(broker, port, 60)
+        self.client.loop_start()
+
+    async def publish(self, topic, payload):
+        info = self.client.publish(topic, payload)
+        return info.rc == self._mqtt.MQTT_ERR_SUCCESS
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def run_report(database, run_id, tables):
+    """Stored readings and publish -> accept latencies for one run of the subscriber under test."""
+    conn = sqlite3.connect(database)
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    stored = 0
+    latencies = []
+    for table in tables:
+        if table not in existing:
+            continue
+        rows = conn.execute(f"SELECT latency FROM {table} WHERE run_id = ?", (run_id,)).fetchall()
+        stored += len(rows)
+        latencies.extend(row[0] for row in rows if row[0] is not None)
+    conn.close()
+    return stored, np.array(latencies, dtype=float)
+
+
+def print_latencies(label, latencies):
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        print(f"{label:<21}p50 {p50:.1f}  p95 {p95:.1f}  p99 {p99:.1f}  max {latencies.max() * 1000:.1f}")
+
+
+def print_report(replayer, stored, latencies, drain_seconds, extra=None, commit_latencies=None):
+    total = replayer.elapsed + drain_seconds
+    print(f"Messages published: {replayer.published} ({replayer.publish_failures} failed)")
+    print(f"Readings published: {replayer.readings}")
+    print(f"Readings stored:    {stored}")
+    print(f"Dropped:            {replayer.readings - stored}")
+    print(f"Publish time:       {replayer.elapsed:.2f}s (max schedule lag {replayer.max_lag * 1000:.1f} ms)")
+    print(f"Sustained:          {replayer.published / replayer.elapsed if replayer.elapsed else 0:.0f} msg/s, "
+          f"{stored / total if total else 0:.0f} readings/s stored (incl. {drain_seconds:.2f}s drain)")
+    # Publish -> accepted into the write queue (the stored latency column)
+    print_latencies("Accept latency (ms):", latencies)
+    if commit_latencies is not None:
+        print_latencies("Commit latency (ms):", commit_latencies)
+    if extra:
+        print("Subscriber stats:", extra)
+
+
+async def replay_local(args, messages):
+    """Replay into an in-process LocalBroker feeding an IngestService."""
+    broker = LocalBroker()
+    service = IngestService(args.db, queue_size=args.queue_size, max_batch=args.batch_size, keep_runs=0)
+    for pattern in service.routes:
+        broker.subscribe(pattern, service.submit)
+    commit_latencies = []
+    service.add_commit_listener(commit_latencies.extend)
+
+    writer_task = asyncio.create_task(service.run())
+    replayer = Replayer(messages, _local_publish(broker), args.format, args.speed)
+    await replayer.run()
+
+    drain_start = time.monotonic()
+    await service.stop()
+    await writer_task
+    drain_seconds = time.monotonic() - drain_start
+
+    stored, latencies = run_report(args.db, service.run_id, service.routes.values())
+    print_report(replayer, stored, latencies, drain_seconds, service.stats(), np.array(commit_latencies, dtype=float))
+
+
+def _local_publish(broker):
+    async def publish(topic, payload):
+        await broker.publish(topic, payload)
+        return True
+    return publish
+
+
+async def replay_mqtt(args, messages):
+    """Replay to a real broker; the subscriber under test writes into args.db."""
+    publisher = MqttPublisher(args.broker, args.port, use_tls=not args.no_tls)
+    replayer = Replayer(messages, publisher.publish, args.format, args.speed)
+    try:
+        await replayer.run()
+
+        # Wait for the subscriber to commit the tail: until everything is stored
+        # or the stored count has not moved for `settle` seconds
+        drain_start = time.monotonic()
+        last_stored, last_change = -1, drain_start
+        while True:
+            conn = sqlite3.connect(args.db)
+            run_id = current_run_id(conn)
+            conn.close()
+            stored, _ = run_report(args.db, run_id, TABLE_TOPICS.keys())
+            now = time.monotonic()
+            if stored != last_stored:
+                last_stored, last_change = stored, now
+            if stored >= replayer.readings or now - last_change >= args.settle:
+                break
+            await asyncio.sleep(0.2)
+        drain_seconds = last_change - drain_start
+    finally:
+        publisher.close()
+
+    stored, latencies = run_report(args.db, run_id, TABLE_TOPICS.keys())
+    print(f"Subscriber run: {run_id}")
+    print_report(replayer, stored, latencies, drain_seconds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded RSSI readings as MQTT load.")
+    parser.add_argument("--source", action="append", help="Recorded database to replay (repeatable, default: all shipped ones)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed multiplier (0 = as fast as possible)")
+    parser.add_argument("--tags", type=int, default=1, help="Synthetic tags per recorded tag")
+    parser.add_argument("--format", choices=["batch", "binary", "json"], default="batch", help="Payload format")
+    parser.add_argument("--duration", type=float, default=None, help="Only replay the first N recorded seconds")
+    parser.add_argument("--db", default="replay.db", help="Database the subscriber under test writes to")
+    parser.add_argument("--broker", default=None, help="Publish to this MQTT broker instead of the local stand-in")
+    parser.add_argument("--port", type=int, default=8883)
+    parser.add_argument("--no-tls", action="store_true", help="Connect without TLS (e.g. port 1883)")
+    parser.add_argument("--settle", type=float, default=5.0, help="Give up on an external subscriber after this many seconds without progress")
+    parser.add_argument("--queue-size", type=int, default=10000, help="Local ingest service queue size")
+    parser.add_argument("--batch-size", type=int, default=500, help="Local ingest service max messages per commit")
+    args = parser.parse_args()
+
+    recording = load_recording(args.source or DEFAULT_SOURCES, args.duration)
+    messages = build_messages(recording, args.format, args.tags)
+    print(f"Replaying {len(messages)} messages at {'max' if args.speed <= 0 else f'{args.speed:g}x'} speed")
+
+    if args.broker:
+        asyncio.run(replay_mqtt(args, messages))
+    else:
+        asyncio.run(replay_local(args, messages))
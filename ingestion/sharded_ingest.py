@@ -0,0 +1,320 @@
+# Sharded ingestion: one front process takes every message off MQTT, decodes it
+# and routes each reading by tag to one of N writer processes; every writer owns
+# its own SQLite shard (positioning.shard0.db, positioning.shard1.db, ...).
+# All readings of a (tag, MAC) stream land in the same shard, and
+# common/shards.py lets the filters read across every shard as if it were one table.
+#
+# python sharded_ingest.py --db ../BLE+Wifi/positioning.db --shards 4
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+from ingest_service import (INSERT_SQL, METRICS_PORT, MQTT_BROKER, MQTT_PORT, PING_INTERVAL, RAW_TABLE_SCHEMA,
+                            IngestService, MqttSource, decode_rows, parse_routes, record_readings)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from identity import ensure_identity_tables, IdentityResolver
+from run_storage import DEFAULT_KEEP_RUNS, ensure_run_partitioning, expire_runs_in_background, start_run
+from epoch_time import ensure_epoch_columns
+from shards import MAX_SHARDS, shard_path
+
+# Row chunks a writer may fall behind by before the front process blocks
+SHARD_QUEUE_CHUNKS = 64
+
+
+def shard_for(device_key, mac, shards):
+    """
+    Shard that owns a (device, MAC) stream. device_key is the canonical device,
+    so every spelling of a name hashes the same; the MAC is the BLE tag itself,
+    or the AP's BSSID in WiFi mode, so each stream a Kalman filter follows stays
+    in one shard.
+    """
+    return zlib.crc32(f"{device_key}/{mac}".encode()) % shards
+
+
+def shard_writer(shard, path, tables, run_id, keep_runs, max_batch, inbox, results):
+    """Writer process: owns one shard database and commits whatever the front sends it."""
+    # Ctrl+C is handled by the front process, which then sends the stop marker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    for table in tables:
+        conn.execute(RAW_TABLE_SCHEMA.format(table=table))
+    conn.commit()
+    ensure_run_partitioning(conn, tables)
+    ensure_epoch_columns(conn, tables)  # Shards written before ts_ms existed
+    # Same run id as the catalog, so retention and run filters line up
+    conn.execute("INSERT OR IGNORE INTO runs (run_id, started_at, source) VALUES (?, ?, 'sharded_ingest')",
+                 (run_id, time.strftime("%Y-%m-%d %H:%M:%S")))
+    conn.commit()
+    if keep_runs:
+        expire_runs_in_background(path, tables, keep_runs)
+    insert_sql = {table: INSERT_SQL.format(table=table, run_id=int(run_id)) for table in tables}
+
+    written = 0
+    commits = 0
+    total_commit_ms = 0.0
+    max_commit_ms = 0.0
+    stopping = False
+    while not stopping:
+        chunk = inbox.get()
+        if chunk is None:
+            break
+
+        # Fold whatever else is already waiting into the same commit
+        pending = [chunk]
+        pending_rows = sum(len(rows) for rows in chunk.values())
+        while pending_rows < max_batch:
+            try:
+                chunk = inbox.get_nowait()
+            except queue.Empty:
+                break
+            if chunk is None:
+                stopping = True
+                break
+            pending.append(chunk)
+            pending_rows += sum(len(rows) for rows in chunk.values())
+
+        start = time.perf_counter()
+        rows_per_table = {}
+        try:
+            for chunk in pending:
+                for table, rows in chunk.items():
+                    conn.executemany(insert_sql[table], rows)
+                    rows_per_table[table] = rows_per_table.get(table, 0) + len(rows)
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            print(f"Shard {shard} insert failed ({pending_rows} rows): {e}")
+            continue
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        written += pending_rows
+        commits += 1
+        total_commit_ms += elapsed_ms
+        max_commit_ms = max(max_commit_ms, elapsed_ms)
+        # Feeds the front process's commit metrics
+        results.put(("commit", shard, rows_per_table, elapsed_ms / 1000))
+
+    conn.close()
+    results.put(("done", shard, {
+        "written": written,
+        "commits": commits,
+        "avg_commit_ms": total_commit_ms / commits if commits else 0.0,
+        "max_commit_ms": max_commit_ms,
+    }))
+
+
+class ShardedIngestService(IngestService):
+    """
+    IngestService whose writer thread decodes and routes instead of inserting.
+
+    Producer side, batching and backpressure are inherited: the worker thread
+    blocks on a full shard queue, run() stops draining, and once queue_size
+    messages are waiting the MQTT source is paused. The catalog database keeps
+    the runs and device/AP identity tables; raw rows only go to the shards.
+    """
+
+    def __init__(self, database, routes=None, shards=4, queue_size=10000, max_batch=500, max_delay=0.5,
+                 keep_runs=DEFAULT_KEEP_RUNS, metrics=None, clock=None):
+        super().__init__(database, routes, queue_size, max_batch, max_delay, keep_runs, metrics, clock)
+        if not 1 <= shards <= MAX_SHARDS:
+            raise ValueError(f"shards must be between 1 and {MAX_SHARDS}")
+        self.shards = shards
+        self.shard_stats = {}
+        self._context = multiprocessing.get_context("spawn")
+        self._inboxes = []
+        self._workers = []
+        self._results = None
+        self._collector = None
+        self._shard_of = {}
+
+    # === Writer thread ===
+    def _open(self):
+        self._conn = sqlite3.connect(self.database)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        ensure_identity_tables(self._conn)
+        ensure_run_partitioning(self._conn, [])
+        self.run_id = start_run(self._conn, "sharded_ingest")
+        self._identity = IdentityResolver(self._conn)
+        print(f"Started run {self.run_id} across {self.shards} shards")
+        if self.keep_runs:
+            expire_runs_in_background(self.database, [], self.keep_runs)
+
+        tables = sorted(set(self.routes.values()))
+        self._results = self._context.Queue()
+        for shard in range(self.shards):
+            inbox = self._context.Queue(maxsize=SHARD_QUEUE_CHUNKS)
+            worker = self._context.Process(
+                target=shard_writer,
+                args=(shard, shard_path(self.database, shard), tables, self.run_id, self.keep_runs,
+                      self.max_batch, inbox, self._results),
+                name=f"shard-writer-{shard}",
+                daemon=True,
+            )
+            worker.start()
+            self._inboxes.append(inbox)
+            self._workers.append(worker)
+        self._collector = threading.Thread(target=self._collect_results, name="shard-results", daemon=True)
+        self._collector.start()
+
+    def _collect_results(self):
+        """Turns the writers' commit reports into metrics until every writer is done."""
+        done = 0
+        while done < self.shards:
+            kind, shard, payload, *rest = self._results.get()
+            if kind == "commit":
+                self.metrics.commit_seconds.observe(rest[0])
+                for table, count in payload.items():
+                    self.metrics.rows_written.inc(table, amount=count)
+            else:
+                self.shard_stats[shard] = payload
+                done += 1
+
+    def _close(self):
+        for inbox in self._inboxes:
+            inbox.put(None)
+        if self._collector is not None:
+            self._collector.join(timeout=30)
+            if self._collector.is_alive():
+                print("A shard writer did not report back")
+        for worker in self._workers:
+            worker.join(timeout=10)
+        self._workers = []
+        self._inboxes = []
+        super()._close()
+
+    def _flush(self, batch):
+        start = time.perf_counter()
+        identity = self._identity
+        shards = self.shards
+        shard_of = self._shard_of
+        chunks = [{} for _ in range(shards)]
+        decode_errors = 0
+        key_errors = 0
+        unrouted = 0
+        for topic, payload, receive_time in batch:
+            table = self.route(topic)
+            if table is None:
+                unrouted += 1
+                continue
+            rows = decode_rows(payload, receive_time, self.clock, topic)
+            if rows is None:
+                decode_errors += 1
+                self.metrics.decode_errors.inc(topic)
+                continue
+            record_readings(self.metrics, topic, rows)
+            try:
+                keyed = [row + (identity.device_key(row[3]), identity.ap_key(row[1])) for row in rows]
+            except sqlite3.Error as e:
+                # Registering a new spelling failed: drop this message, keep the batch
+                key_errors += 1
+                self.metrics.key_errors.inc(topic)
+                print(f"Could not store device/AP keys, message dropped: {e}")
+                continue
+            for row in keyed:
+                device_key = row[-2]
+                stream = (device_key, row[2])
+                shard = shard_of.get(stream)
+                if shard is None:
+                    shard = shard_of[stream] = shard_for(device_key, row[2], shards)
+                chunks[shard].setdefault(table, []).append(row)
+
+        for shard, chunk in enumerate(chunks):
+            if chunk:
+                self._send(shard, chunk)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        self.decode_errors += decode_errors
+        self.key_errors += key_errors
+        self.unrouted += unrouted
+        for chunk in chunks:
+            for table, rows in chunk.items():
+                self.written[table] = self.written.get(table, 0) + len(rows)
+        self.commits += 1
+        self.last_commit_ms = elapsed_ms
+        self.max_commit_ms = max(self.max_commit_ms, elapsed_ms)
+        self._total_commit_ms += elapsed_ms
+
+    def _send(self, shard, chunk):
+        """Blocks while that writer is SHARD_QUEUE_CHUNKS behind (backpressure)."""
+        while True:
+            try:
+                self._inboxes[shard].put(chunk, timeout=1.0)
+                return
+            except queue.Full:
+                if not self._workers[shard].is_alive():
+                    raise RuntimeError(f"Shard writer {shard} exited")
+
+    def stats(self):
+        stats = super().stats()
+        # On the front, "written" means handed to a shard; shard_stats has the commits
+        stats["routed"] = stats.pop("written")
+        stats["shard_stats"] = dict(self.shard_stats)
+        return stats
+
+
+async def main(args):
+    service = ShardedIngestService(
+        args.db,
+        routes=parse_routes(args.route),
+        shards=args.shards,
+        queue_size=args.queue_size,
+        max_batch=args.batch_size,
+        max_delay=args.batch_delay,
+        keep_runs=args.keep_runs,
+    )
+
+    if args.metrics_port:
+        service.metrics.serve(args.metrics_port)
+
+    source = MqttSource(service, broker=args.broker, port=args.port, use_tls=not args.no_tls,
+                        ping_interval=args.ping_interval)
+    writer_task = asyncio.create_task(service.run())
+    source_task = asyncio.create_task(source.run())
+    try:
+        await asyncio.wait([writer_task, source_task], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        source.stop()
+        source_task.cancel()
+        await service.stop()
+        await writer_task
+        print("Ingestion stats:", service.stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest RSSI readings from MQTT into N SQLite shards.")
+    parser.add_argument("--db", default="positioning.db", help="Catalog database; shards are written next to it")
+    parser.add_argument("--shards", type=int, default=4, help=f"Writer processes / shard files (max {MAX_SHARDS})")
+    parser.add_argument("--route", action="append", help="Extra topic=table routing (repeatable)")
+    parser.add_argument("--broker", default=MQTT_BROKER)
+    parser.add_argument("--port", type=int, default=MQTT_PORT)
+    parser.add_argument("--no-tls", action="store_true", help="Connect without TLS (e.g. port 1883)")
+    parser.add_argument("--queue-size", type=int, default=10000, help="Readings buffered before pausing the broker")
+    parser.add_argument("--batch-size", type=int, default=500, help="Max messages per routing batch")
+    parser.add_argument("--batch-delay", type=float, default=0.5, help="Max seconds a message waits before routing")
+    parser.add_argument("--keep-runs", type=int, default=DEFAULT_KEEP_RUNS,
+                        help="Runs kept in each shard; older ones are expired (0 keeps everything)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Serve Prometheus metrics on this local port (0 disables)")
+    parser.add_argument("--ping-interval", type=float, default=PING_INTERVAL,
+                        help="Seconds between clock-offset pings to the publishers (0 disables)")
+    args = parser.parse_args()
+
+    # paho needs add_reader/add_writer, which the default Windows loop lacks
+    if sys.platform == "win32":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print("Stopping sharded ingestion...")
@@ -0,0 +1,53 @@
+# The full, parallel and incremental runs of the BLE and WiFi filters step
+# every Kalman filter through its readings oldest first, so all three store
+# the same filtered RSSI for the shipped recordings.
+#
+# python -m pytest tests/test_filter_order.py
+
+import os
+import shutil
+import sqlite3
+import sys
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+for folder in ("BLE_only", "Wifi_only"):
+    sys.path.append(os.path.join(BASE_DIR, "..", folder))
+import rssi_filter
+import wifi_rssi_filter
+from kalman_bank import KalmanBank
+
+FILTERS = [
+    ("BLE_only", rssi_filter, "SELECT timestamp, ap_id, mac, filtered_rssi FROM filtered_rssi"),
+    ("Wifi_only", wifi_rssi_filter, "SELECT timestamp, ap_id, mac, device_name, filtered_rssi FROM wifi_filtered_rssi"),
+]
+
+
+def filtered_rows(folder, module, query, mode, tmp_path, monkeypatch):
+    """Filtered rows of one run of `module` in `mode` on a copy of the shipped database."""
+    database = str(tmp_path / f"{mode}.db")
+    shutil.copy(os.path.join(BASE_DIR, "..", folder, "positioning.db"), database)
+    monkeypatch.setattr(module, "DATABASE", database)
+    monkeypatch.setattr(module, "kalman_bank", KalmanBank())
+    module.create_tables()  # The shipped filtered table goes, as in a full run
+    if mode == "full":
+        module.process_rssi()
+    elif mode == "parallel":
+        module.process_rssi_parallel(workers=2)
+    else:
+        module.create_tables(reset=False)
+        module.process_rssi_incremental()
+    conn = sqlite3.connect(database)
+    rows = sorted(conn.execute(query).fetchall())
+    conn.close()
+    return rows
+
+
+@pytest.mark.parametrize("folder, module, query", FILTERS, ids=[spec[0] for spec in FILTERS])
+def test_full_parallel_and_incremental_runs_agree(tmp_path, monkeypatch, folder, module, query):
+    full = filtered_rows(folder, module, query, "full", tmp_path, monkeypatch)
+    assert full
+    assert filtered_rows(folder, module, query, "parallel", tmp_path, monkeypatch) == full
+    assert filtered_rows(folder, module, query, "incremental", tmp_path, monkeypatch) == full
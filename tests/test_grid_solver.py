@@ -0,0 +1,52 @@
+# Grid-likelihood fixes (common/grid_solver.py): the BLE and WiFi estimators
+# search the whole room, and the windows scored per matrix product follow the
+# cell count without changing any fix.
+#
+# python -m pytest tests/test_grid_solver.py
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+for folder in ("BLE_only", "Wifi_only"):
+    sys.path.append(os.path.join(BASE_DIR, "..", folder))
+import grid_solver
+import position_estimator
+import wifi_position_estimator
+from grid_solver import GridSolver
+
+TAG = np.array([2.0, 4.0])
+
+
+def expected_rssi(module, aps):
+    """Noise-free RSSI of TAG at the estimator's APs, in the model the grid scores."""
+    distances = np.linalg.norm(np.array([module.AP_COORDINATES[ap] for ap in aps]) - TAG, axis=1)
+    return module.PATH_LOSS_A - 10 * module.PATH_LOSS_N * np.log10(distances)
+
+
+@pytest.mark.parametrize("module, aps", [
+    (position_estimator, ["xypi", "pierre"]),
+    (wifi_position_estimator, ["RPi_AP_XY", "RPi_AP_Pierre"]),
+], ids=["BLE_only", "Wifi_only"])
+def test_two_aps_on_one_wall_still_search_the_room(module, aps):
+    # The two APs' bounding box is the wall x = 4.96 itself
+    positions, located = module.grid_positions(expected_rssi(module, aps)[None, :], aps)
+    assert located.all()
+    assert np.linalg.norm(positions[0] - TAG) < 0.1
+
+
+def test_windows_per_product_follow_the_cell_count(monkeypatch):
+    aps = [(4.96, 0), (4.96, 8.06), (0, 8.06), (0, 0)]
+    coarse = GridSolver(aps, -55.525, 0.735, bounds=([0, 0], [4.96, 8.06]), cell=0.1)
+    fine = GridSolver(aps, -55.525, 0.735, bounds=([0, 0], [4.96, 8.06]), cell=0.02)
+    assert fine.batch < coarse.batch
+    assert fine.batch * len(fine) <= grid_solver.GRID_SCORES
+
+    rssi = np.random.default_rng(0).uniform(-80, -50, size=(300, 4))
+    positions, _ = coarse.locate(rssi)
+    coarse.batch = 7
+    np.testing.assert_allclose(coarse.locate(rssi)[0], positions, atol=1e-9)
@@ -0,0 +1,48 @@
+# Streaming fusion (BLE+Wifi/hybrid_fusion.py): per-source watermarks and the ticker.
+#
+# python -m pytest tests/test_hybrid_fusion.py
+
+import os
+import sys
+import threading
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+sys.path.append(os.path.join(BASE_DIR, "..", "BLE+Wifi"))
+from hybrid_fusion import FusionOperator, start_ticker
+
+START_MS = 1743888727000
+NOW = 1743888727.0
+
+
+def test_clock_ahead_does_not_make_other_sources_late():
+    fusion = FusionOperator()
+    # The Pi stamping BLE runs 10 s ahead of the tag stamping WiFi; both report the same moments
+    for second in range(20):
+        fusion.add(START_MS + second * 1000, 1, 1, "WiFi", -70.0, 0.02, now=NOW + second, source="tag")
+        fusion.add(START_MS + 10000 + second * 1000, 1, 1, "BLE", -60.0, 0.01, now=NOW + second, source="pi")
+    assert fusion.late == 0
+
+
+def test_single_source_readings_behind_the_watermark_are_late():
+    fusion = FusionOperator(lateness=3)
+    fusion.add(START_MS + 10000, 1, 1, "BLE", -60.0, 0.01, now=NOW, source="pi")
+    fusion.add(START_MS, 1, 1, "WiFi", -70.0, 0.02, now=NOW, source="pi")
+    assert fusion.late == 1
+
+
+def test_quiet_source_is_moved_on_by_wall_clock():
+    fusion = FusionOperator(window=2, lateness=3)
+    fusion.add(START_MS, 1, 1, "BLE", -60.0, 0.01, now=NOW, source="pi")
+    fusion.add(START_MS, 1, 1, "WiFi", -70.0, 0.02, now=NOW, source="tag")
+    assert fusion.tick(now=NOW + 1) == []
+    rows = fusion.tick(now=NOW + 6)  # 6 s idle: past lateness plus the window
+    assert [row[1] for row in rows] == [START_MS]
+
+
+def test_ticker_stops():
+    stop = threading.Event()
+    ticker = start_ticker(FusionOperator(), lambda rows: None, interval=0.01, stop=stop)
+    stop.set()
+    ticker.join(timeout=1)
+    assert not ticker.is_alive()
@@ -0,0 +1,60 @@
+# Registering a new device / AP spelling (common/identity.py) can fail in
+# SQLite, e.g. while another connection holds the write lock. The resolver
+# then rolls back and caches nothing, and the ingest service drops only the
+# message whose keys could not be stored.
+#
+# python -m pytest tests/test_identity_keys.py
+
+import json
+import os
+import sqlite3
+import sys
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+sys.path.append(os.path.join(BASE_DIR, "..", "ingestion"))
+from identity import IdentityResolver
+from ingest_service import IngestService
+
+
+def payload(device_name, ap_id="xypi"):
+    return json.dumps({"mac_address": "AA:BB:CC:DD:EE:FF", "device_name": device_name,
+                       "rssi": -60, "ap_id": ap_id}).encode()
+
+
+def test_failed_registration_rolls_back_and_can_be_retried(tmp_path):
+    database = str(tmp_path / "identity.db")
+    resolver = IdentityResolver(sqlite3.connect(database, timeout=0.05))
+    known = resolver.device_key("M5Stick_BLE_Alicia")
+
+    writer = sqlite3.connect(database, isolation_level=None)
+    writer.execute("BEGIN IMMEDIATE")  # The write lock a busy writer thread holds
+    with pytest.raises(sqlite3.OperationalError):
+        resolver.device_key("M5StickCPlus-XinYi")
+    assert resolver.device_key("M5Stick_BLE_Alicia") == known  # Cached spellings need no write
+    writer.execute("ROLLBACK")
+
+    assert resolver.device_key("M5StickCPlus-XinYi") != known
+    assert not resolver.conn.in_transaction
+
+
+def test_ingest_drops_only_the_message_whose_keys_fail(tmp_path, monkeypatch):
+    service = IngestService(str(tmp_path / "ingest.db"), keep_runs=0)
+    service._open()
+    register = service._identity._register
+
+    def locked(table, key_column, alias_table, canonical, alias):
+        if alias == "M5StickCPlus-XinYi":
+            raise sqlite3.OperationalError("database is locked")
+        return register(table, key_column, alias_table, canonical, alias)
+
+    monkeypatch.setattr(service._identity, "_register", locked)
+    service._flush([("ble/rssi", payload("M5Stick_BLE_Alicia"), 1743888727.0),
+                    ("ble/rssi", payload("M5StickCPlus-XinYi"), 1743888727.5)])
+
+    assert service.key_errors == 1
+    assert service.metrics.key_errors.value("ble/rssi") == 1
+    assert service._conn.execute("SELECT device_name FROM ble_rssi").fetchall() == [("M5Stick_BLE_Alicia",)]
+    service._close()
@@ -0,0 +1,117 @@
+# Incremental estimator runs (common/estimator_state.py) over the shipped
+# recordings, fed in chunks, must end with exactly the positions of one full run.
+#
+# python -m pytest tests/test_incremental_estimator.py
+
+import os
+import shutil
+import sqlite3
+import sys
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+for folder in ("BLE_only", "Wifi_only", "BLE+Wifi"):
+    sys.path.append(os.path.join(BASE_DIR, "..", folder))
+import position_estimator
+import wifi_position_estimator
+import hybrid_position_estimator
+from hybrid_rssi_filter import ensure_filtered_table
+from epoch_time import ms_to_text
+from migrations import migrate
+
+CHUNKS = 3
+
+
+def run_split_estimator(module, incremental):
+    """One command-line run of the BLE or WiFi estimator."""
+    positions, latest = module.estimate_positions(incremental=incremental)
+    module.store_positions(positions, latest, replace=not incremental)
+
+
+def run_hybrid_estimator(module, incremental):
+    module.estimate_positions(incremental=incremental)
+
+
+ESTIMATORS = [
+    ("BLE_only", position_estimator, run_split_estimator, "filtered_rssi", "estimated_positions",
+     "mac, device_name, x, y, timestamp, method"),
+    ("Wifi_only", wifi_position_estimator, run_split_estimator, "wifi_filtered_rssi", "wifi_estimated_positions",
+     "mac, device_name, x, y, timestamp, method"),
+    ("BLE+Wifi", hybrid_position_estimator, run_hybrid_estimator, "hybrid_filtered_rssi", "hybrid_estimated_positions",
+     "device_name, x, y, timestamp, method"),
+]
+
+
+def copy_database(folder, tmp_path, name):
+    database = str(tmp_path / f"{name}.db")
+    shutil.copy(os.path.join(BASE_DIR, "..", folder, "positioning.db"), database)
+    conn = sqlite3.connect(database)
+    migrate(conn)
+    if folder == "BLE+Wifi":
+        ensure_filtered_table(conn)  # The shipped table is still keyed by names
+    conn.close()
+    return database
+
+
+def stored_positions(database, table, columns):
+    conn = sqlite3.connect(database)
+    rows = sorted(conn.execute(f"SELECT {columns} FROM {table}").fetchall())
+    conn.close()
+    return rows
+
+
+@pytest.mark.parametrize("folder, module, run, filtered, positions, columns", ESTIMATORS,
+                         ids=[spec[0] for spec in ESTIMATORS])
+def test_incremental_runs_match_full_run(tmp_path, monkeypatch, folder, module, run, filtered, positions, columns):
+    monkeypatch.setattr(module, "DATABASE", copy_database(folder, tmp_path, "full"))
+    run(module, incremental=False)
+    full = stored_positions(module.DATABASE, positions, columns)
+    assert full
+
+    # The same filtered readings, added in CHUNKS slices of event time with an incremental run after each
+    monkeypatch.setattr(module, "DATABASE", copy_database(folder, tmp_path, "incremental"))
+    conn = sqlite3.connect(module.DATABASE)
+    table_columns = [row[1] for row in conn.execute(f"PRAGMA table_info({filtered})") if row[1] != "id"]
+    rows = conn.execute(f"SELECT {', '.join(table_columns)} FROM {filtered} ORDER BY ts_ms, id").fetchall()
+    conn.execute(f"DELETE FROM {filtered}")
+    conn.commit()
+    conn.close()
+    run(module, incremental=False)  # Nothing to estimate yet: an empty table of the current layout
+
+    ts_ms = table_columns.index("ts_ms")
+    first, last = rows[0][ts_ms], rows[-1][ts_ms]
+    start = 0
+    for chunk in range(CHUNKS):
+        bound = first + (last - first) * (chunk + 1) // CHUNKS
+        end = start
+        while end < len(rows) and rows[end][ts_ms] <= bound:
+            end += 1
+        conn = sqlite3.connect(module.DATABASE)
+        conn.executemany(f"INSERT INTO {filtered} ({', '.join(table_columns)}) "
+                         f"VALUES ({', '.join('?' * len(table_columns))})", rows[start:end])
+        conn.commit()
+        conn.close()
+        start = end
+        run(module, incremental=True)
+
+    assert stored_positions(module.DATABASE, positions, columns) == full
+
+
+@pytest.mark.parametrize("folder, module, run, filtered, positions, columns", ESTIMATORS[1:],
+                         ids=[spec[0] for spec in ESTIMATORS[1:]])
+def test_whole_second_keys_are_upgraded(tmp_path, monkeypatch, folder, module, run, filtered, positions, columns):
+    # Fixes stored by the estimators that keyed windows by whole-second text
+    monkeypatch.setattr(module, "DATABASE", copy_database(folder, tmp_path, "upgraded"))
+    run(module, incremental=False)
+    full = stored_positions(module.DATABASE, positions, columns)
+    conn = sqlite3.connect(module.DATABASE)
+    conn.executemany(f"UPDATE {positions} SET timestamp = ? WHERE id = ?",
+                     [(ms_to_text(ts_ms), row_id) for row_id, ts_ms in conn.execute(f"SELECT id, ts_ms FROM {positions}")])
+    conn.commit()
+    conn.close()
+
+    # The trailing windows are re-opened, and update their fixes
+    run(module, incremental=True)
+    assert stored_positions(module.DATABASE, positions, columns) == full
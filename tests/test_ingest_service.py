@@ -0,0 +1,78 @@
+# Readings published through the in-process LocalBroker (ingestion/local_broker.py)
+# into an IngestService on a temporary database: after the final flush every
+# reading is in its raw table, with the device/AP keys of its canonical names.
+#
+# python -m pytest tests/test_ingest_service.py
+
+import asyncio
+import os
+import sqlite3
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+sys.path.append(os.path.join(BASE_DIR, "..", "ingestion"))
+from ingest_service import IngestService
+from local_broker import LocalBroker
+from rssi_codec import encode_batch, encode_json_reading
+
+SEND_TIME = 1743888727.0
+
+# (topic, payload): JSON readings, one per message, and a malformed one
+MESSAGES = [
+    ("ble/rssi", encode_json_reading(SEND_TIME, "xypi", "AA:BB:CC:DD:EE:01", "M5Stick_BLE_Alicia", -61)),
+    ("ble/rssi", encode_json_reading(SEND_TIME + 1, "RPi_Hybrid_XinYi", "AA:BB:CC:DD:EE:01", "M5StickCPlus-Alicia", -63)),
+    ("wifi/rssi", encode_json_reading(SEND_TIME + 2, "RPi_AP_Pierre", "AA:BB:CC:DD:EE:02", "M5StickCPlus-XinYi", -70)),
+    ("ble/rssi", b"not a reading"),
+]
+
+
+async def publish_all(database, messages):
+    broker = LocalBroker()
+    service = IngestService(database, keep_runs=0, max_delay=0.01)
+    for pattern in service.routes:
+        broker.subscribe(pattern, service.submit)
+    writer = asyncio.create_task(service.run())
+    for topic, payload in messages:
+        await broker.publish(topic, payload)
+    await service.stop()
+    await writer
+    return service
+
+
+def test_published_readings_are_stored_with_their_keys(tmp_path):
+    database = str(tmp_path / "ingest.db")
+    # One binary scan of two tags
+    payload, rejected = encode_batch(SEND_TIME + 3, "pierre", [("AA:BB:CC:DD:EE:03", "M5Stick_BLE_Alicia", -58),
+                                                             ("AA:BB:CC:DD:EE:04", "M5StickCPlus-XinYi", -66)])
+    assert payload is not None and not rejected
+    service = asyncio.run(publish_all(database, MESSAGES + [("ble/rssi", payload)]))
+    assert service.decode_errors == 1
+    assert service.written == {"ble_rssi": 4, "wifi_rssi": 1}
+
+    conn = sqlite3.connect(database)
+    keys = {
+        "M5_Alicia": conn.execute("SELECT device_key FROM devices WHERE name = 'M5_Alicia'").fetchone()[0],
+        "M5_XinYi": conn.execute("SELECT device_key FROM devices WHERE name = 'M5_XinYi'").fetchone()[0],
+        "RPi_AP_XY": conn.execute("SELECT ap_key FROM access_points WHERE name = 'RPi_AP_XY'").fetchone()[0],
+        "RPi_AP_Pierre": conn.execute("SELECT ap_key FROM access_points WHERE name = 'RPi_AP_Pierre'").fetchone()[0],
+    }
+    ble = conn.execute("SELECT ap_id, mac, device_name, rssi, ts_ms, device_key, ap_key, run_id "
+                       "FROM ble_rssi ORDER BY ts_ms, mac").fetchall()
+    wifi = conn.execute("SELECT ap_id, mac, device_name, rssi, ts_ms, device_key, ap_key, run_id FROM wifi_rssi").fetchall()
+    conn.close()
+
+    ms = int(SEND_TIME * 1000)
+    run_id = service.run_id
+    # Both spellings of a tag or an AP share its key
+    assert ble == [
+        ("xypi", "AA:BB:CC:DD:EE:01", "M5Stick_BLE_Alicia", -61, ms, keys["M5_Alicia"], keys["RPi_AP_XY"], run_id),
+        ("RPi_Hybrid_XinYi", "AA:BB:CC:DD:EE:01", "M5StickCPlus-Alicia", -63, ms + 1000,
+         keys["M5_Alicia"], keys["RPi_AP_XY"], run_id),
+        ("pierre", "AA:BB:CC:DD:EE:03", "M5Stick_BLE_Alicia", -58, ms + 3000,
+         keys["M5_Alicia"], keys["RPi_AP_Pierre"], run_id),
+        ("pierre", "AA:BB:CC:DD:EE:04", "M5StickCPlus-XinYi", -66, ms + 3000,
+         keys["M5_XinYi"], keys["RPi_AP_Pierre"], run_id),
+    ]
+    assert wifi == [("RPi_AP_Pierre", "AA:BB:CC:DD:EE:02", "M5StickCPlus-XinYi", -70, ms + 2000,
+                     keys["M5_XinYi"], keys["RPi_AP_Pierre"], run_id)]
@@ -0,0 +1,107 @@
+# The filters' and estimators' own SQL (imported from the scripts) through
+# EXPLAIN QUERY PLAN on copies of the shipped databases, with the tables
+# created and migrated the way a filter run does it: every table a query reads
+# must be read through the index named here, and no query may sort in a
+# temporary B-tree. A query change that loses its index fails here.
+#
+# python -m pytest tests/test_query_plans.py
+
+import os
+import re
+import shutil
+import sqlite3
+import sys
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+for folder in ("BLE_only", "Wifi_only", "BLE+Wifi"):
+    sys.path.append(os.path.join(BASE_DIR, "..", folder))
+import rssi_filter
+import position_estimator
+import wifi_rssi_filter
+import wifi_position_estimator
+import hybrid_rssi_filter
+import hybrid_position_estimator
+from migrations import migrate
+
+SINCE_MS = 1743879838000
+
+# (name, module, sql, params, {table or alias in the plan: index it must use})
+QUERIES = [
+    ("BLE raw -> filtered anti-join", rssi_filter, rssi_filter.UNFILTERED_ROWS_SQL, (0,),
+     {"r": "idx_ble_rssi_run", "f": "sqlite_autoindex_filtered_rssi_1"}),
+    ("BLE parallel backfill range", rssi_filter, rssi_filter.UNFILTERED_RANGE_SQL, (0, "", "~"),
+     {"r": "idx_ble_rssi_run_mac", "f": "sqlite_autoindex_filtered_rssi_1"}),
+    ("BLE estimator read", position_estimator, position_estimator.FILTERED_ROWS_SQL, (),
+     {"filtered_rssi": "idx_filtered_rssi_ms_ap_mac"}),
+    ("BLE incremental estimator read", position_estimator, position_estimator.FILTERED_ROWS_SINCE_SQL, (SINCE_MS,),
+     {"filtered_rssi": "idx_filtered_rssi_ms_ap_mac"}),
+    ("WiFi raw -> filtered anti-join", wifi_rssi_filter, wifi_rssi_filter.UNFILTERED_ROWS_SQL, (0,),
+     {"r": "idx_wifi_rssi_run", "f": "idx_wifi_filtered_rssi_ts_ap_mac"}),
+    ("WiFi parallel backfill range", wifi_rssi_filter, wifi_rssi_filter.UNFILTERED_RANGE_SQL, (0, "", "~"),
+     {"r": "idx_wifi_rssi_run_mac", "f": "idx_wifi_filtered_rssi_ts_ap_mac"}),
+    ("WiFi estimator read", wifi_position_estimator, wifi_position_estimator.FILTERED_ROWS_SQL, (),
+     {"wifi_filtered_rssi": "idx_wifi_filtered_rssi_ms_ap_mac"}),
+    ("WiFi incremental estimator read", wifi_position_estimator, wifi_position_estimator.FILTERED_ROWS_SINCE_SQL,
+     (SINCE_MS,), {"wifi_filtered_rssi": "idx_wifi_filtered_rssi_ms_ap_mac"}),
+    ("Hybrid raw read", hybrid_rssi_filter, hybrid_rssi_filter.RAW_ROWS_SQL, (0, 0),
+     {"ble_rssi": "idx_ble_rssi_run", "wifi_rssi": "idx_wifi_rssi_run"}),
+    ("Hybrid parallel backfill range", hybrid_rssi_filter, hybrid_rssi_filter.RAW_RANGE_SQL, (0, 1, 1, 9, 9) * 2,
+     {"ble_rssi": "idx_ble_rssi_run_keys", "wifi_rssi": "idx_wifi_rssi_run_keys"}),
+    ("Hybrid estimator read", hybrid_position_estimator, hybrid_position_estimator.DEVICE_ROWS_SQL, (1,),
+     {"hybrid_filtered_rssi": "idx_hybrid_filtered_rssi_device_ms"}),
+    ("Hybrid incremental estimator read", hybrid_position_estimator, hybrid_position_estimator.RECENT_ROWS_SQL,
+     (SINCE_MS,), {"hybrid_filtered_rssi": "sqlite_autoindex_hybrid_filtered_rssi_1"}),
+]
+
+# "SEARCH r USING COVERING INDEX name (run_id=?)" / "SCAN t USING INDEX name"
+PLAN_STEP = re.compile(r"^(SEARCH|SCAN) (\S+)(?: USING (?:COVERING )?INDEX (\S+))?")
+
+
+def query_plan(conn, sql, params=()):
+    """EXPLAIN QUERY PLAN detail lines of one statement."""
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def plan_indexes(plan):
+    """{table or alias: index it is read through, None for a full table scan}."""
+    indexes = {}
+    for step in plan:
+        match = PLAN_STEP.match(step)
+        if match and match.group(2) != "CONSTANT":
+            indexes[match.group(2)] = match.group(3)
+    return indexes
+
+
+@pytest.fixture(scope="module")
+def databases(tmp_path_factory):
+    """Every module's DATABASE pointed at one migrated copy of its shipped database."""
+    workdir = tmp_path_factory.mktemp("query_plans")
+    modules = {module: None for _, module, _, _, _ in QUERIES}
+    with pytest.MonkeyPatch.context() as patch:
+        copies = {}
+        for module in modules:
+            original = os.path.abspath(module.DATABASE)
+            if original not in copies:
+                copies[original] = str(workdir / f"{len(copies)}_{os.path.basename(original)}")
+                shutil.copy(original, copies[original])
+            patch.setattr(module, "DATABASE", copies[original])
+        for module in modules:
+            if hasattr(module, "create_tables"):
+                module.create_tables()
+        for database in copies.values():
+            conn = sqlite3.connect(database)
+            migrate(conn)
+            conn.close()
+        yield copies
+
+
+@pytest.mark.parametrize("name, module, sql, params, expected", QUERIES, ids=[query[0] for query in QUERIES])
+def test_query_uses_its_index(databases, name, module, sql, params, expected):
+    conn = sqlite3.connect(module.DATABASE)
+    plan = query_plan(conn, sql, params)
+    conn.close()
+    assert plan_indexes(plan) == expected, plan
+    assert not [step for step in plan if "USE TEMP B-TREE" in step], plan
@@ -0,0 +1,101 @@
+# solve_positions() (common/trilateration.py) against the per-window
+# scipy.optimize.least_squares solve it replaces, with each estimator's loss,
+# bounds and starting point, on seeded three-AP windows of the shop floor.
+#
+# python -m pytest tests/test_trilateration.py
+
+import os
+import sys
+
+import numpy as np
+import pytest
+from scipy.optimize import least_squares
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from trilateration import range_weights, solve_positions
+
+FLOOR_BOUNDS = ([0, 0], [4.96, 8.06])
+WINDOWS = 500
+# A window may end in the other (mirrored) minimum of its three ranges than
+# least_squares does; that is allowed in this share of windows, and only there
+COST_TOLERANCE = 1e-9
+OTHER_MINIMUM_SHARE = 0.05
+
+# (estimator, loss, bounds, starting point)
+SETTINGS = [
+    ("BLE", "soft_l1", None, "mean"),
+    ("WiFi", "linear", None, "mean"),
+    ("hybrid", "soft_l1", FLOOR_BOUNDS, "median"),
+]
+
+
+def floor_windows(seed):
+    """(APs K x 3 x 2, noisy ranges K x 3) of tags anywhere on the floor."""
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(FLOOR_BOUNDS[0], FLOOR_BOUNDS[1], size=(WINDOWS, 3, 2))
+    truth = rng.uniform(FLOOR_BOUNDS[0], FLOOR_BOUNDS[1], size=(WINDOWS, 2))
+    ranges = np.linalg.norm(points - truth[:, None, :], axis=2)
+    return points, ranges * rng.lognormal(0.0, 0.4, size=ranges.shape) + 0.05
+
+
+def costs(positions, points, distances, loss):
+    r = range_weights(distances) * (np.linalg.norm(points - positions[:, None, :], axis=2) - distances)
+    if loss == "soft_l1":
+        return np.sum(np.sqrt(1.0 + r * r) - 1.0, axis=1)
+    return 0.5 * np.sum(r * r, axis=1)
+
+
+def least_squares_positions(points, distances, x0, loss, bounds):
+    """Every window solved on its own, the way the estimators did before the batch solver."""
+    positions = []
+    for k in range(len(distances)):
+        weights = range_weights(distances[k])
+
+        def residuals(point):
+            return weights * (np.linalg.norm(points[k] - point, axis=1) - distances[k])
+
+        if bounds is None:
+            positions.append(least_squares(residuals, x0=x0[k], loss=loss).x)
+        else:
+            positions.append(least_squares(residuals, x0=x0[k], bounds=bounds, loss=loss).x)
+    return np.array(positions)
+
+
+def starting_points(points, start):
+    return np.mean(points, axis=1) if start == "mean" else np.median(points, axis=1)
+
+
+@pytest.mark.parametrize("name, loss, bounds, start", SETTINGS, ids=[setting[0] for setting in SETTINGS])
+def test_converges_to_the_least_squares_minimum_next_to_its_start(name, loss, bounds, start):
+    points, distances = floor_windows(1)
+    reference = least_squares_positions(points, distances, starting_points(points, start), loss, bounds)
+    x0 = reference + np.random.default_rng(2).normal(0.0, 0.05, size=reference.shape)
+    if bounds is not None:
+        x0 = np.clip(x0, bounds[0], bounds[1])
+    positions, converged = solve_positions(points, distances, x0, loss=loss, bounds=bounds)
+    assert converged.all()
+    reference_costs = costs(reference, points, distances, loss)
+    assert np.all(costs(positions, points, distances, loss) <= reference_costs + COST_TOLERANCE)
+    assert np.linalg.norm(positions - reference, axis=1).max() < 0.01
+
+
+@pytest.mark.parametrize("name, loss, bounds, start", SETTINGS, ids=[setting[0] for setting in SETTINGS])
+def test_estimator_starts_end_in_the_least_squares_minimum(name, loss, bounds, start):
+    points, distances = floor_windows(3)
+    x0 = starting_points(points, start)
+    positions, converged = solve_positions(points, distances, x0, loss=loss, bounds=bounds)
+    reference = least_squares_positions(points, distances, x0, loss, bounds)
+    higher = costs(positions, points, distances, loss) > costs(reference, points, distances, loss) + COST_TOLERANCE
+    assert converged.all()
+    assert np.mean(higher) <= OTHER_MINIMUM_SHARE
+
+
+@pytest.mark.parametrize("name, loss, bounds, start", SETTINGS, ids=[setting[0] for setting in SETTINGS])
+def test_unconverged_windows_are_solved_by_least_squares(name, loss, bounds, start):
+    points, distances = floor_windows(4)
+    points, distances = points[:50], distances[:50]
+    x0 = starting_points(points, start)
+    positions, converged = solve_positions(points, distances, x0, loss=loss, bounds=bounds, max_iterations=1)
+    assert converged.all()
+    np.testing.assert_allclose(positions, least_squares_positions(points, distances, x0, loss, bounds))
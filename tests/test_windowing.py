@@ -0,0 +1,72 @@
+# resample_windows() (common/windowing.py) on a small hand-built stream: which
+# readings land in which window, the NaN slots of APs a window did not hear,
+# the partial window the stream ends in, and windows narrower than a second.
+#
+# python -m pytest tests/test_windowing.py
+
+import os
+import sys
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, "..", "common"))
+from epoch_time import ms_to_isoformat, ms_to_text
+from windowing import resample_windows
+
+# A whole second of epoch time, so the grid ticks fall on the offsets below
+START = 1743888720000
+
+# (device, ap, ms after START, rssi)
+STREAM = [
+    # 1000-2000 ms: a twice (the last one is kept), b, c; d not heard
+    ("tag", "a", 1100, -50.0), ("tag", "b", 1200, -60.0), ("tag", "c", 1900, -70.0), ("tag", "a", 1950, -55.0),
+    # 2000-3000 ms: a, b, d; c not heard
+    ("tag", "d", 2500, -80.0), ("tag", "a", 2300, -52.0), ("tag", "b", 2400, -61.0),
+    # 3000-4000 ms: the stream ends at 3400, in the middle of the window
+    ("tag", "a", 3200, -53.0), ("tag", "b", 3300, -62.0), ("tag", "c", 3400, -72.0),
+    # Two APs only: below MIN_APS, no window
+    ("other", "a", 1500, -40.0), ("other", "b", 1600, -41.0),
+]
+
+
+def stream(readings):
+    return [(device, ap, START + offset, rssi) for device, ap, offset, rssi in readings]
+
+
+def test_readings_land_in_the_window_that_covers_them():
+    devices, ts_ms, rssi, aps = resample_windows(stream(STREAM), window_ms=1000)
+    assert aps == ["a", "b", "c", "d"]
+    assert list(devices) == ["tag", "tag", "tag"]
+    # Window centres; the last window is kept although the stream ends 600 ms before it closes
+    assert list(ts_ms - START) == [1500, 2500, 3500]
+    np.testing.assert_array_equal(rssi, [
+        [-55.0, -60.0, -70.0, np.nan],
+        [-52.0, -61.0, np.nan, -80.0],
+        [-53.0, -62.0, -72.0, np.nan],
+    ])
+
+
+def test_readings_of_other_aps_are_ignored():
+    devices, ts_ms, rssi, aps = resample_windows(stream(STREAM), window_ms=1000, aps=["a", "b", "c"])
+    assert aps == ["a", "b", "c"]
+    # 2000-3000 ms heard only a and b of these
+    assert list(ts_ms - START) == [1500, 3500]
+    np.testing.assert_array_equal(rssi, [[-55.0, -60.0, -70.0], [-53.0, -62.0, -72.0]])
+
+
+def test_overlapping_windows_share_readings():
+    devices, ts_ms, rssi, aps = resample_windows(stream(STREAM), window_ms=2000, step_ms=1000)
+    # 1000-3000 ms holds the last reading of every AP of both seconds
+    row = list(ts_ms - START).index(2000)
+    np.testing.assert_array_equal(rssi[row], [-52.0, -61.0, -70.0, -80.0])
+
+
+def test_sub_second_windows_get_distinct_keys():
+    readings = [("tag", ap, offset + shift, -60.0) for offset in (1100, 1600) for shift, ap in enumerate("abc")]
+    devices, ts_ms, rssi, aps = resample_windows(stream(readings), window_ms=500)
+    assert list(ts_ms - START) == [1250, 1750]
+    assert np.isfinite(rssi).all()
+    # Both centres fall in one second: whole-second text would give the two windows one key
+    assert ms_to_text(int(ts_ms[0])) == ms_to_text(int(ts_ms[1]))
+    assert ms_to_isoformat(int(ts_ms[0])) != ms_to_isoformat(int(ts_ms[1]))